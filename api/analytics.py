@@ -0,0 +1,207 @@
+"""Rollup delle vendite: ricavi e quantità per ora, giorno, prodotto e categoria.
+
+Le tabelle `sales_*` sono aggiornate nella stessa transazione che crea, cancella
+o elimina un ordine, così le dashboard leggono poche righe già aggregate invece
+di scorrere tutto lo storico. Ogni negozio ha i propri bucket (`store_id` nella
+chiave), anche quando condivide lo shard con altri. Un ordine conta nelle vendite
+se non è cancellato; i bucket usano la data di creazione dell'ordine.
+"""
+
+from datetime import time, timedelta
+
+PLACEHOLDERS = {'mysql': '%s', 'sqlite': '?'}
+
+# Il bucket orario è salvato come inizio dell'ora ('YYYY-MM-DD HH:00:00'), quello giornaliero come data
+HOUR = {
+    'sqlite': "strftime('%Y-%m-%d %H:00:00', o.created_at)",
+    'mysql': "DATE_FORMAT(o.created_at, '%Y-%m-%d %H:00:00')",
+}
+DAY = {
+    'sqlite': "date(o.created_at)",
+    'mysql': "DATE(o.created_at)",
+}
+
+COUNTED = "o.status <> 'cancelled'"
+
+TABLE_NAMES = ['sales_hourly', 'sales_daily', 'sales_products_daily', 'sales_categories_daily']
+
+TABLES = {
+    'sqlite': [
+        """CREATE TABLE IF NOT EXISTS sales_hourly (
+               store_id INTEGER NOT NULL,
+               hour TEXT NOT NULL,
+               orders INTEGER NOT NULL DEFAULT 0,
+               quantity INTEGER NOT NULL DEFAULT 0,
+               revenue REAL NOT NULL DEFAULT 0,
+               PRIMARY KEY (store_id, hour)
+           )""",
+        """CREATE TABLE IF NOT EXISTS sales_daily (
+               store_id INTEGER NOT NULL,
+               day TEXT NOT NULL,
+               orders INTEGER NOT NULL DEFAULT 0,
+               quantity INTEGER NOT NULL DEFAULT 0,
+               revenue REAL NOT NULL DEFAULT 0,
+               PRIMARY KEY (store_id, day)
+           )""",
+        """CREATE TABLE IF NOT EXISTS sales_products_daily (
+               store_id INTEGER NOT NULL,
+               day TEXT NOT NULL,
+               product_id INTEGER NOT NULL,
+               quantity INTEGER NOT NULL DEFAULT 0,
+               revenue REAL NOT NULL DEFAULT 0,
+               PRIMARY KEY (store_id, day, product_id)
+           )""",
+        """CREATE TABLE IF NOT EXISTS sales_categories_daily (
+               store_id INTEGER NOT NULL,
+               day TEXT NOT NULL,
+               category_id INTEGER NOT NULL,
+               quantity INTEGER NOT NULL DEFAULT 0,
+               revenue REAL NOT NULL DEFAULT 0,
+               PRIMARY KEY (store_id, day, category_id)
+           )""",
+    ],
+    'mysql': [
+        """CREATE TABLE IF NOT EXISTS sales_hourly (
+               store_id INT NOT NULL,
+               hour DATETIME NOT NULL,
+               orders INT NOT NULL DEFAULT 0,
+               quantity INT NOT NULL DEFAULT 0,
+               revenue DECIMAL(12, 2) NOT NULL DEFAULT 0,
+               PRIMARY KEY (store_id, hour)
+           ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4""",
+        """CREATE TABLE IF NOT EXISTS sales_daily (
+               store_id INT NOT NULL,
+               day DATE NOT NULL,
+               orders INT NOT NULL DEFAULT 0,
+               quantity INT NOT NULL DEFAULT 0,
+               revenue DECIMAL(12, 2) NOT NULL DEFAULT 0,
+               PRIMARY KEY (store_id, day)
+           ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4""",
+        """CREATE TABLE IF NOT EXISTS sales_products_daily (
+               store_id INT NOT NULL,
+               day DATE NOT NULL,
+               product_id INT NOT NULL,
+               quantity INT NOT NULL DEFAULT 0,
+               revenue DECIMAL(12, 2) NOT NULL DEFAULT 0,
+               PRIMARY KEY (store_id, day, product_id)
+           ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4""",
+        """CREATE TABLE IF NOT EXISTS sales_categories_daily (
+               store_id INT NOT NULL,
+               day DATE NOT NULL,
+               category_id INT NOT NULL,
+               quantity INT NOT NULL DEFAULT 0,
+               revenue DECIMAL(12, 2) NOT NULL DEFAULT 0,
+               PRIMARY KEY (store_id, day, category_id)
+           ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4""",
+    ],
+}
+
+
+def _accumulate(dialect, table, keys, columns):
+    """Clausola di upsert che somma i nuovi valori a quelli della riga esistente"""
+    # Le colonne sono qualificate: la SELECT legge anche order_items.quantity
+    if dialect == 'mysql':
+        return "ON DUPLICATE KEY UPDATE " + ", ".join(
+            f"{table}.{c} = {table}.{c} + VALUES({c})" for c in columns)
+    return (f"ON CONFLICT({', '.join(keys)}) DO UPDATE SET "
+            + ", ".join(f"{c} = {table}.{c} + excluded.{c}" for c in columns))
+
+
+def rollup_statements(dialect, order_id, sign):
+    """Istruzioni (sql, parametri) che aggiungono (sign=1) o tolgono (sign=-1) un ordine dai rollup.
+    Vanno eseguite nella transazione che modifica l'ordine, prima di eliminarne gli articoli."""
+    ph = PLACEHOLDERS[dialect]
+    # Con i parametri pymysql interpreta i '%': quelli di DATE_FORMAT vanno raddoppiati
+    hour = HOUR[dialect].replace('%', '%%') if dialect == 'mysql' else HOUR[dialect]
+    totals = ['orders', 'quantity', 'revenue']
+    items = ['quantity', 'revenue']
+    order_totals = f"""
+        SELECT o.store_id, {{bucket}}, {ph},
+               {ph} * (SELECT COALESCE(SUM(quantity), 0) FROM order_items WHERE order_id = o.id),
+               {ph} * o.total_price
+        FROM orders o
+        WHERE o.id = {ph}
+    """
+    return [
+        (f"INSERT INTO sales_hourly (store_id, hour, orders, quantity, revenue) {order_totals.format(bucket=hour)} "
+         f"{_accumulate(dialect, 'sales_hourly', ['store_id', 'hour'], totals)}",
+         (sign, sign, sign, order_id)),
+        (f"INSERT INTO sales_daily (store_id, day, orders, quantity, revenue) "
+         f"{order_totals.format(bucket=DAY[dialect])} "
+         f"{_accumulate(dialect, 'sales_daily', ['store_id', 'day'], totals)}",
+         (sign, sign, sign, order_id)),
+        (f"""INSERT INTO sales_products_daily (store_id, day, product_id, quantity, revenue)
+             SELECT o.store_id, {DAY[dialect]}, oi.product_id, {ph} * SUM(oi.quantity),
+                    {ph} * SUM(oi.quantity * oi.unit_price)
+             FROM order_items oi
+             JOIN orders o ON o.id = oi.order_id
+             WHERE oi.order_id = {ph}
+             GROUP BY o.store_id, oi.product_id, o.created_at
+             {_accumulate(dialect, 'sales_products_daily', ['store_id', 'day', 'product_id'], items)}""",
+         (sign, sign, order_id)),
+        (f"""INSERT INTO sales_categories_daily (store_id, day, category_id, quantity, revenue)
+             SELECT o.store_id, {DAY[dialect]}, p.category_id, {ph} * SUM(oi.quantity),
+                    {ph} * SUM(oi.quantity * oi.unit_price)
+             FROM order_items oi
+             JOIN orders o ON o.id = oi.order_id
+             JOIN products p ON p.id = oi.product_id
+             WHERE oi.order_id = {ph}
+             GROUP BY o.store_id, p.category_id, o.created_at
+             {_accumulate(dialect, 'sales_categories_daily', ['store_id', 'day', 'category_id'], items)}""",
+         (sign, sign, order_id)),
+    ]
+
+
+def rebuild_statements(dialect):
+    """Istruzioni che ricalcolano da zero tutti i rollup dagli ordini esistenti"""
+    order_totals = f"""
+        SELECT o.store_id, {{bucket}} AS bucket, COUNT(*), COALESCE(SUM(q.quantity), 0), SUM(o.total_price)
+        FROM orders o
+        LEFT JOIN (SELECT order_id, SUM(quantity) AS quantity FROM order_items GROUP BY order_id) q
+               ON q.order_id = o.id
+        WHERE {COUNTED}
+        GROUP BY o.store_id, bucket
+    """
+    return [f"DELETE FROM {table}" for table in TABLE_NAMES] + [
+        f"INSERT INTO sales_hourly (store_id, hour, orders, quantity, revenue) "
+        f"{order_totals.format(bucket=HOUR[dialect])}",
+        f"INSERT INTO sales_daily (store_id, day, orders, quantity, revenue) "
+        f"{order_totals.format(bucket=DAY[dialect])}",
+        f"""INSERT INTO sales_products_daily (store_id, day, product_id, quantity, revenue)
+            SELECT o.store_id, {DAY[dialect]} AS bucket, oi.product_id, SUM(oi.quantity),
+                   SUM(oi.quantity * oi.unit_price)
+            FROM order_items oi
+            JOIN orders o ON o.id = oi.order_id
+            WHERE {COUNTED}
+            GROUP BY o.store_id, bucket, oi.product_id""",
+        f"""INSERT INTO sales_categories_daily (store_id, day, category_id, quantity, revenue)
+            SELECT o.store_id, {DAY[dialect]} AS bucket, p.category_id, SUM(oi.quantity),
+                   SUM(oi.quantity * oi.unit_price)
+            FROM order_items oi
+            JOIN orders o ON o.id = oi.order_id
+            JOIN products p ON p.id = oi.product_id
+            WHERE {COUNTED}
+            GROUP BY o.store_id, bucket, p.category_id""",
+    ]
+
+
+def status_change_sign(old_status, new_status):
+    """+1 se l'ordine torna a contare nelle vendite, -1 se viene cancellato, 0 altrimenti"""
+    was_counted = old_status != 'cancelled'
+    is_counted = new_status != 'cancelled'
+    return int(is_counted) - int(was_counted)
+
+
+def apply_rollups(cursor, dialect, order_id, sign):
+    """Esegue rollup_statements() sul cursore della transazione corrente"""
+    for statement, params in rollup_statements(dialect, order_id, sign):
+        cursor.execute(statement, params)
+
+
+def day_bound(timestamp):
+    """Primo giorno il cui inizio (mezzanotte) è >= timestamp, come 'YYYY-MM-DD'.
+    Con SQLite i giorni sono testo: serve a selezionare i bucket che iniziano in [from, to)."""
+    day = timestamp.date()
+    if timestamp.time() != time.min:
+        day += timedelta(days=1)
+    return day.isoformat()
@@ -1,42 +1,174 @@
-from flask import Flask, jsonify, request
+import asyncio
+import os
+from datetime import datetime, timezone
+from decimal import Decimal
+from flask import Blueprint, Flask, Response, current_app, g, jsonify, request, send_file
 from flask_cors import CORS
-from database_wrapper_sqlite import DatabaseWrapper
+from config import Config
+from migrations import apply_migrations
+from menu_snapshot import MenuSnapshot
+from pricing import PricingError, price_order
+from events import EventBroker, format_sse
+from kitchen import KitchenQueue
+from shards import DEFAULT_SHARD, Shard, ShardRouter, parse_shards, parse_store_shards
+import stores
+import idempotency
+import encoding
+import images
+from search import ProductSearchIndex
+from outbox import OrderOutbox, entry_body as outbox_entry_body
+from order_status import ACTIVE_STATUSES, InvalidStatusTransition, normalize_status
+import metrics
+from order_export import CSV_FIELDS as ORDER_CSV_FIELDS, ORDER_FIELDS, chunked, group_orders, gzip_stream
+from catalog_io import (
+    CATEGORY_FIELDS, FORMATS, MIMETYPES, PRODUCT_FIELDS,
+    export_lines, parse_category, parse_product, read_rows
+)
 import logging
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Initialize Flask app
-app = Flask(__name__)
-app.config['JSON_SORT_KEYS'] = False
-app.config['DEBUG'] = True
-CORS(app)
+# Le route sono registrate sull'app da create_app()
+api = Blueprint('api', __name__, cli_group=None)
 
 # Initialize database
-db = DatabaseWrapper()
+# Il backend è scelto da DB_BACKEND: ogni wrapper riceve solo la destinazione (file SQLite o
+# nome del database MySQL), quindi shard e view async funzionano con entrambi
+if Config.DB_BACKEND == 'mysql':
+    from database_wrapper import DatabaseWrapper
+    from async_database_wrapper import AsyncDatabaseWrapper
+    DEFAULT_TARGET = Config.DB_NAME
+elif Config.DB_BACKEND == 'sqlite':
+    from database_wrapper_sqlite import DatabaseWrapper
+    from async_database_wrapper_sqlite import AsyncDatabaseWrapper
+    DEFAULT_TARGET = Config.SQLITE_DB
+else:
+    raise ValueError(f"Invalid DB_BACKEND '{Config.DB_BACKEND}', expected sqlite or mysql")
+
+# Le connessioni vengono aperte solo alla prima richiesta: con gunicorn ogni worker
+# (dopo la fork) ha il proprio pool. Le migrazioni sono applicate all'avvio del server.
+db = DatabaseWrapper(DEFAULT_TARGET)
+# Variante asincrona per le view async: condivide la cache del menu con quella sincrona
+adb = AsyncDatabaseWrapper(DEFAULT_TARGET, menu_cache=db.menu_cache)
+
+def open_shard(name, target):
+    """Wrapper sincrono e asincrono di uno shard (file SQLite o database MySQL)"""
+    shard_db = DatabaseWrapper(target)
+    return Shard(name, shard_db, AsyncDatabaseWrapper(target, menu_cache=shard_db.menu_cache))
+
+# Ordini per negozio: lo shard 'default' usa db/adb, che ospitano anche il catalogo
+shard_targets = parse_shards(Config.DB_SHARDS)
+shards = ShardRouter(
+    [Shard(DEFAULT_SHARD, db, adb)] + [open_shard(name, target) for name, target in shard_targets.items()],
+    parse_store_shards(Config.STORE_SHARDS, {DEFAULT_SHARD, *shard_targets})
+)
+
+@api.before_request
+def resolve_store():
+    """Negozio della richiesta (header X-Store-Id o parametro store_id) e shard dei suoi ordini"""
+    value = request.headers.get(stores.HEADER) or request.args.get('store_id')
+    try:
+        g.store_id = stores.parse_store_id(value) if value else stores.DEFAULT_STORE_ID
+    except ValueError:
+        return jsonify({"error": f"Invalid store id: {value}"}), 400
+    g.shard = shards.for_store(g.store_id)
+
+# Risposte del menu pre-serializzate, ricostruite solo dopo scritture sul catalogo
+menu_snapshot = MenuSnapshot(
+    db.menu_cache,
+    lambda data: current_app.json.dumpb(data),
+    ttl=Config.MENU_CACHE_TTL,
+    compress=Config.MENU_SNAPSHOT_GZIP,
+    packb=encoding.packb if encoding.MSGPACK else None
+)
+
+def load_menu(loader, *args):
+    """Esegue una lettura del menu in una sessione database"""
+    with db.session():
+        return loader(*args)
+
+def store_overrides():
+    """Prezzi e disponibilità personalizzati del negozio della richiesta"""
+    return load_menu(db.get_store_overrides, g.store_id)
+
+def menu_key(overrides, *key):
+    """Chiave dello snapshot: i negozi senza personalizzazioni condividono il menu del catalogo"""
+    return (*key, 'store', g.store_id) if overrides else key
+
+def menu_response(key, loader):
+    """Risponde con lo snapshot del menu gestendo ETag/If-None-Match e gzip.
+    Ritorna None se il loader non trova dati."""
+    return snapshot_response(menu_snapshot.get(key, loader))
+
+def snapshot_response(entry):
+    """Costruisce la risposta HTTP di uno SnapshotEntry (None se entry è None)"""
+    if entry is None:
+        return None
+    if entry.packed is not None and encoding.wants_msgpack():
+        etag = entry.packed_etag
+        response = Response(entry.packed, mimetype=encoding.MSGPACK_MIMETYPES[0])
+    elif entry.gzip_body is not None and 'gzip' in request.accept_encodings:
+        etag = entry.gzip_etag
+        response = Response(entry.gzip_body, mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        etag = entry.etag
+        response = Response(entry.body, mimetype='application/json')
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding, Accept' if entry.packed is not None else 'Accept-Encoding'
+    # Il client deve sempre rivalidare: con l'ETag invariato riceve un 304 senza corpo
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+# Eventi degli ordini per le dashboard collegate in streaming (un broker per negozio)
+brokers = stores.StoreRegistry(lambda store_id: EventBroker(buffer_size=Config.EVENTS_BUFFER_SIZE))
+
+def publish_order_event(event, data, store_id=None):
+    """Serializza una volta l'evento e lo invia agli iscritti del negozio (di default quello della richiesta)"""
+    store_id = g.store_id if store_id is None else store_id
+    brokers.get(store_id).publish(format_sse(event, current_app.json.dumps(data, separators=(',', ':'))))
+
+# ==================== MENU ====================
+
+@api.route('/api/menu', methods=['GET'])
+def get_menu():
+    """Recupera categorie e prodotti (con i prezzi del negozio) in un'unica risposta"""
+    async def load():
+        # Le due letture vengono eseguite in parallelo
+        async with adb.session():
+            categories, products = await asyncio.gather(adb.get_all_categories(), adb.get_all_products())
+        return {"categories": categories, "products": stores.apply_overrides(products, overrides)}
+    
+    try:
+        # Con lo snapshot valido la risposta non passa dall'event loop del database:
+        # solo la ricostruzione usa il wrapper asincrono
+        overrides = store_overrides()
+        return menu_response(menu_key(overrides, 'menu'), lambda: adb.db_loop.run_sync(load()))
+    except Exception as e:
+        logger.error(f"Error getting menu: {e}")
+        return jsonify({"error": str(e)}), 500
 
 # ==================== CATEGORIE ====================
 
-@app.route('/api/categories', methods=['GET'])
+@api.route('/api/categories', methods=['GET'])
 def get_categories():
     """Recupera tutte le categorie"""
     try:
-        db.connect()
-        categories = db.get_all_categories()
-        db.disconnect()
-        return jsonify(categories)
+        return menu_response(('categories',), lambda: load_menu(db.get_all_categories))
     except Exception as e:
         logger.error(f"Error getting categories: {e}")
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/categories/<int:category_id>', methods=['GET'])
+@api.route('/api/categories/<int:category_id>', methods=['GET'])
 def get_category(category_id):
     """Recupera una categoria specifica"""
     try:
-        db.connect()
-        category = db.get_category_by_id(category_id)
-        db.disconnect()
+        with db.session():
+            category = db.get_category_by_id(category_id)
         if not category:
             return jsonify({"error": "Category not found"}), 404
         return jsonify(category)
@@ -44,7 +176,7 @@ def get_category(category_id):
         logger.error(f"Error getting category: {e}")
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/categories', methods=['POST'])
+@api.route('/api/categories', methods=['POST'])
 def create_category():
     """Crea una nuova categoria"""
     try:
@@ -52,15 +184,15 @@ def create_category():
         if not data or 'name' not in data:
             return jsonify({"error": "Missing required field: name"}), 400
         
-        db.connect()
-        category_id = db.create_category(data['name'], data.get('description', ''))
-        db.disconnect()
+        with db.session():
+            category_id = db.create_category(data['name'], data.get('description', ''))
+        shards.sync_catalog()
         return jsonify({"id": category_id, "message": "Category created successfully"}), 201
     except Exception as e:
         logger.error(f"Error creating category: {e}")
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/categories/<int:category_id>', methods=['PUT'])
+@api.route('/api/categories/<int:category_id>', methods=['PUT'])
 def update_category(category_id):
     """Aggiorna una categoria"""
     try:
@@ -68,21 +200,23 @@ def update_category(category_id):
         if not data or 'name' not in data:
             return jsonify({"error": "Missing required field: name"}), 400
         
-        db.connect()
-        db.update_category(category_id, data['name'], data.get('description', ''))
-        db.disconnect()
+        with db.session():
+            db.update_category(category_id, data['name'], data.get('description', ''))
+        shards.sync_catalog()
+        product_search.invalidate()
         return jsonify({"message": "Category updated successfully"})
     except Exception as e:
         logger.error(f"Error updating category: {e}")
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/categories/<int:category_id>', methods=['DELETE'])
+@api.route('/api/categories/<int:category_id>', methods=['DELETE'])
 def delete_category(category_id):
     """Elimina una categoria"""
     try:
-        db.connect()
-        db.delete_category(category_id)
-        db.disconnect()
+        with db.session():
+            db.delete_category(category_id)
+        shards.sync_catalog()
+        product_search.invalidate()
         return jsonify({"message": "Category deleted successfully"})
     except Exception as e:
         logger.error(f"Error deleting category: {e}")
@@ -90,45 +224,86 @@ def delete_category(category_id):
 
 # ==================== PRODOTTI ====================
 
-@app.route('/api/products', methods=['GET'])
+# Indice di ricerca in memoria, aggiornato dalle scritture sul catalogo
+product_search = ProductSearchIndex(lambda: load_menu(db.get_all_products), resync_interval=Config.SEARCH_INDEX_RESYNC)
+
+def index_product(product_id):
+    """Aggiorna un prodotto nell'indice di ricerca dopo una scrittura"""
+    with db.session():
+        product = db.get_product_by_id(product_id)
+        category = db.get_category_by_id(product['category_id']) if product else None
+    if product is None:
+        product_search.remove(product_id)
+    else:
+        product_search.upsert(dict(product, category_name=category['name'] if category else None))
+
+@api.route('/api/products/search', methods=['GET'])
+def search_products():
+    """Cerca i prodotti per nome, descrizione e categoria (con i prezzi del negozio)"""
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({"error": "Missing required parameter: q"}), 400
+    try:
+        limit = int(request.args.get('limit', 20))
+        if not 1 <= limit <= Config.SEARCH_MAX_LIMIT:
+            raise ValueError
+    except ValueError:
+        return jsonify({"error": f"limit must be between 1 and {Config.SEARCH_MAX_LIMIT}"}), 400
+    
+    try:
+        overrides = store_overrides()
+        # I prodotti non disponibili nel negozio vengono scartati dopo la ricerca
+        results = product_search.search(query, limit + len(overrides))
+        return jsonify(stores.apply_overrides(results, overrides)[:limit])
+    except Exception as e:
+        logger.error(f"Error searching products: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@api.route('/api/products', methods=['GET'])
 def get_products():
-    """Recupera tutti i prodotti"""
+    """Recupera tutti i prodotti (con i prezzi del negozio)"""
     try:
-        db.connect()
-        products = db.get_all_products()
-        db.disconnect()
-        return jsonify(products)
+        overrides = store_overrides()
+        return menu_response(
+            menu_key(overrides, 'products'),
+            lambda: stores.apply_overrides(load_menu(db.get_all_products), overrides)
+        )
     except Exception as e:
         logger.error(f"Error getting products: {e}")
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/products/category/<int:category_id>', methods=['GET'])
+@api.route('/api/products/category/<int:category_id>', methods=['GET'])
 def get_products_by_category(category_id):
-    """Recupera i prodotti di una categoria"""
+    """Recupera i prodotti di una categoria (con i prezzi del negozio)"""
     try:
-        db.connect()
-        products = db.get_products_by_category(category_id)
-        db.disconnect()
-        return jsonify(products)
+        overrides = store_overrides()
+        return menu_response(
+            menu_key(overrides, 'products_by_category', category_id),
+            lambda: stores.apply_overrides(load_menu(db.get_products_by_category, category_id), overrides)
+        )
     except Exception as e:
         logger.error(f"Error getting products by category: {e}")
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/products/<int:product_id>', methods=['GET'])
+@api.route('/api/products/<int:product_id>', methods=['GET'])
 def get_product(product_id):
-    """Recupera un prodotto specifico"""
+    """Recupera un prodotto specifico (404 se non disponibile nel negozio)"""
+    def load():
+        product = load_menu(db.get_product_by_id, product_id)
+        available = stores.apply_overrides([product], overrides) if product else []
+        return available[0] if available else None
+    
     try:
-        db.connect()
-        product = db.get_product_by_id(product_id)
-        db.disconnect()
-        if not product:
+        overrides = store_overrides()
+        response = menu_response(menu_key(overrides, 'product', product_id), load)
+        if response is None:
             return jsonify({"error": "Product not found"}), 404
-        return jsonify(product)
+        return response
     except Exception as e:
         logger.error(f"Error getting product: {e}")
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/products', methods=['POST'])
+@api.route('/api/products', methods=['POST'])
 def create_product():
     """Crea un nuovo prodotto"""
     try:
@@ -137,21 +312,22 @@ def create_product():
         if not data or not all(field in data for field in required_fields):
             return jsonify({"error": f"Missing required fields: {', '.join(required_fields)}"}), 400
         
-        db.connect()
-        product_id = db.create_product(
-            data['name'],
-            data.get('description', ''),
-            data['price'],
-            data['category_id'],
-            data.get('image_url', '')
-        )
-        db.disconnect()
+        with db.session():
+            product_id = db.create_product(
+                data['name'],
+                data.get('description', ''),
+                data['price'],
+                data['category_id'],
+                data.get('image_url', '')
+            )
+        shards.sync_catalog()
+        index_product(product_id)
         return jsonify({"id": product_id, "message": "Product created successfully"}), 201
     except Exception as e:
         logger.error(f"Error creating product: {e}")
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/products/<int:product_id>', methods=['PUT'])
+@api.route('/api/products/<int:product_id>', methods=['PUT'])
 def update_product(product_id):
     """Aggiorna un prodotto"""
     try:
@@ -160,83 +336,532 @@ def update_product(product_id):
         if not data or not all(field in data for field in required_fields):
             return jsonify({"error": f"Missing required fields: {', '.join(required_fields)}"}), 400
         
-        db.connect()
-        db.update_product(
-            product_id,
-            data['name'],
-            data.get('description', ''),
-            data['price'],
-            data['category_id'],
-            data.get('image_url', '')
-        )
-        db.disconnect()
+        with db.session():
+            db.update_product(
+                product_id,
+                data['name'],
+                data.get('description', ''),
+                data['price'],
+                data['category_id'],
+                data.get('image_url', '')
+            )
+        shards.sync_catalog()
+        index_product(product_id)
         return jsonify({"message": "Product updated successfully"})
     except Exception as e:
         logger.error(f"Error updating product: {e}")
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/products/<int:product_id>', methods=['DELETE'])
+@api.route('/api/products/<int:product_id>', methods=['DELETE'])
 def delete_product(product_id):
     """Elimina un prodotto"""
     try:
-        db.connect()
-        db.delete_product(product_id)
-        db.disconnect()
+        with db.session():
+            db.delete_product(product_id)
+        shards.sync_catalog()
+        product_search.remove(product_id)
         return jsonify({"message": "Product deleted successfully"})
     except Exception as e:
         logger.error(f"Error deleting product: {e}")
         return jsonify({"error": str(e)}), 500
 
+# ==================== IMMAGINI ====================
+
+# Un file dell'archivio non cambia mai (il nome è l'hash del contenuto)
+IMAGE_MAX_AGE = 365 * 24 * 3600
+
+image_store = images.ImageStore(Config.IMAGES_DIR)
+
+def save_image_variants(product_id, original, variants):
+    """Registra le varianti generate in background (thread del pool delle immagini)"""
+    with db.session():
+        updated = db.set_product_variants(product_id, original, variants)
+    if updated:
+        index_product(product_id)
+
+image_pipeline = images.ImagePipeline(image_store, save_image_variants, workers=Config.IMAGES_WORKERS)
+
+@api.route('/api/products/<int:product_id>/image', methods=['PUT'])
+def upload_product_image(product_id):
+    """Carica l'immagine di un prodotto: corpo JPEG/PNG/WebP o form multipart con il campo `image`.
+    Le varianti (thumb, tile, tile_webp) sono generate in background: la risposta è 202"""
+    if request.content_length is not None and request.content_length > Config.IMAGES_MAX_BYTES:
+        return jsonify({"error": f"Image too large (max {Config.IMAGES_MAX_BYTES} bytes)"}), 413
+    try:
+        upload = request.files.get('image')
+        data = (upload or request.stream).read(Config.IMAGES_MAX_BYTES + 1)
+        if len(data) > Config.IMAGES_MAX_BYTES:
+            return jsonify({"error": f"Image too large (max {Config.IMAGES_MAX_BYTES} bytes)"}), 413
+        image_format = images.sniff_format(data)
+        if image_format is None:
+            return jsonify({"error": "Unsupported image format, use JPEG, PNG or WebP"}), 415
+        
+        with db.session():
+            if db.get_product_by_id(product_id) is None:
+                return jsonify({"error": "Product not found"}), 404
+            original = image_store.put(data, image_format)
+            db.set_product_image(product_id, original)
+        index_product(product_id)
+        # Senza Pillow viene servito solo l'originale
+        if images.PILLOW:
+            image_pipeline.submit(product_id, original)
+        return jsonify({
+            "images": images.image_urls(Config.IMAGES_BASE_URL, {images.ORIGINAL: original}),
+            "message": "Image uploaded successfully"
+        }), 202 if images.PILLOW else 201
+    except Exception as e:
+        logger.error(f"Error uploading product image: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@api.route('/api/products/<int:product_id>/image', methods=['DELETE'])
+def delete_product_image(product_id):
+    """Rimuove l'immagine di un prodotto (i file restano nell'archivio)"""
+    try:
+        with db.session():
+            if not db.delete_product_image(product_id):
+                return jsonify({"error": "Product image not found"}), 404
+        index_product(product_id)
+        return jsonify({"message": "Product image deleted successfully"})
+    except Exception as e:
+        logger.error(f"Error deleting product image: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@api.route('/api/images/<name>', methods=['GET'])
+def get_image(name):
+    """Serve un file dell'archivio immagini con cache immutabile (supporta Range e If-None-Match)"""
+    path = image_store.path(name)
+    if path is None or not os.path.isfile(path):
+        return jsonify({"error": "Image not found"}), 404
+    response = send_file(
+        path,
+        mimetype=images.MIMETYPES[name.rsplit('.', 1)[1]],
+        conditional=True,
+        etag=name.rsplit('.', 1)[0],
+        max_age=IMAGE_MAX_AGE
+    )
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+# ==================== IMPORT/EXPORT CATALOGO ====================
+
+def read_catalog_rows(fmt, parse):
+    """Legge e valida in streaming le righe dell'import.
+    Ritorna le righe valide come (numero riga, valore) e gli errori per riga"""
+    valid, errors = [], []
+    for line_number, row, error in read_rows(request.stream, fmt):
+        if len(valid) + len(errors) >= Config.CATALOG_IMPORT_MAX_ROWS:
+            raise ValueError(f"Too many rows (max {Config.CATALOG_IMPORT_MAX_ROWS})")
+        if error is None:
+            try:
+                valid.append((line_number, parse(row)))
+            except ValueError as e:
+                error = str(e)
+        if error is not None:
+            errors.append({"line": line_number, "error": error})
+    return valid, errors
+
+def unsupported_format():
+    return jsonify({"error": f"Unsupported Content-Type, use one of: {', '.join(FORMATS)}"}), 415
+
+def export_response(rows, fields, name):
+    """Risposta in streaming dell'export (?format=ndjson di default, oppure csv)"""
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in MIMETYPES:
+        return jsonify({"error": f"Invalid format, use one of: {', '.join(MIMETYPES)}"}), 400
+    dumps = current_app.json.dumps
+    lines = export_lines(rows, fields, fmt, lambda data: dumps(data, separators=(',', ':')))
+    return Response(lines, mimetype=MIMETYPES[fmt], headers={
+        'Content-Disposition': f'attachment; filename={name}.{fmt}'
+    })
+
+@api.route('/api/categories/import', methods=['POST'])
+def import_categories():
+    """Importa categorie da NDJSON o CSV (inserite o aggiornate per nome)"""
+    fmt = FORMATS.get(request.mimetype)
+    if fmt is None:
+        return unsupported_format()
+    try:
+        valid, errors = read_catalog_rows(fmt, parse_category)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    try:
+        with db.session():
+            imported = db.import_categories([category for _, category in valid])
+        shards.sync_catalog()
+        product_search.invalidate()
+        return jsonify({"imported": imported, "errors": errors})
+    except Exception as e:
+        logger.error(f"Error importing categories: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@api.route('/api/products/import', methods=['POST'])
+def import_products():
+    """Importa prodotti da NDJSON o CSV (inseriti o aggiornati per nome e categoria)"""
+    fmt = FORMATS.get(request.mimetype)
+    if fmt is None:
+        return unsupported_format()
+    try:
+        valid, errors = read_catalog_rows(fmt, parse_product)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    try:
+        with db.session():
+            imported, category_errors = db.import_products(valid)
+        shards.sync_catalog()
+        product_search.invalidate()
+        errors = sorted(errors + category_errors, key=lambda error: error['line'])
+        return jsonify({"imported": imported, "errors": errors})
+    except Exception as e:
+        logger.error(f"Error importing products: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@api.route('/api/categories/export', methods=['GET'])
+def export_categories():
+    """Esporta tutte le categorie (NDJSON o CSV)"""
+    try:
+        with db.session():
+            categories = db.export_categories()
+        return export_response(categories, CATEGORY_FIELDS, 'categories')
+    except Exception as e:
+        logger.error(f"Error exporting categories: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@api.route('/api/products/export', methods=['GET'])
+def export_products():
+    """Esporta tutti i prodotti con il nome della categoria (NDJSON o CSV)"""
+    try:
+        with db.session():
+            products = db.export_products()
+        return export_response(products, PRODUCT_FIELDS, 'products')
+    except Exception as e:
+        logger.error(f"Error exporting products: {e}")
+        return jsonify({"error": str(e)}), 500
+
 # ==================== ORDINI ====================
 
-@app.route('/api/orders', methods=['GET'])
+def parse_timestamp(value):
+    """Converte un timestamp ISO 8601 in datetime UTC naive, come created_at (ValueError se non valido)"""
+    timestamp = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+def parse_period(args):
+    """Legge l'intervallo [from, to) dalla query string (ValueError se non valido)"""
+    start = parse_timestamp(args['from']) if args.get('from') else None
+    end = parse_timestamp(args['to']) if args.get('to') else None
+    return start, end
+
+def parse_orders_filters(args):
+    """Legge i filtri di /api/orders dalla query string (ValueError se non validi)"""
+    filters = {}
+    if args.get('status'):
+        filters['statuses'] = [normalize_status(status) for status in args['status'].split(',') if status]
+    if args.get('since'):
+        filters['since'] = parse_timestamp(args['since'])
+    if args.get('limit'):
+        limit = int(args['limit'])
+        if not 1 <= limit <= Config.ORDERS_MAX_LIMIT:
+            raise ValueError(f"limit must be between 1 and {Config.ORDERS_MAX_LIMIT}")
+        filters['limit'] = limit
+    if args.get('before_id'):
+        filters['before_id'] = int(args['before_id'])
+    return filters
+
+def load_orders(shard_db, store_id, filters):
+    """Carica gli ordini filtrati del negozio con i loro articoli (query costanti, non N+1)"""
+    orders = shard_db.get_orders(store_id=store_id, **filters) if filters else shard_db.get_all_orders(store_id)
+    # Carichiamo gli articoli di tutti gli ordini con una sola query
+    items_by_order = shard_db.get_order_items_bulk(order['id'] for order in orders)
+    for order in orders:
+        order['items'] = items_by_order[order['id']]
+    return orders
+
+def load_order_rows(shard_db, store_id, filters):
+    """Come load_orders, in forma colonnare: una tupla per ordine, articoli compresi, senza dict per riga"""
+    orders = shard_db.get_orders(store_id=store_id, rows=True, **filters) if filters else shard_db.get_all_orders(store_id, rows=True)
+    # La prima colonna è l'id dell'ordine
+    item_columns, items_by_order = shard_db.get_order_items_rows(row[0] for row in orders.rows)
+    return {
+        "columns": orders.columns + ['items'],
+        "item_columns": item_columns,
+        "rows": [(*row, items_by_order[row[0]]) for row in orders.rows]
+    }
+
+@api.route('/api/orders', methods=['GET'])
 def get_orders():
-    """Recupera tutti gli ordini"""
+    """Recupera gli ordini (filtri opzionali: status, since, limit, before_id).
+    Con ?shape=rows la risposta è colonnare: {"columns", "item_columns", "rows"}"""
+    shape = request.args.get('shape', 'objects')
+    if shape not in ('objects', 'rows'):
+        return jsonify({"error": "Invalid shape, use one of: objects, rows"}), 400
+    try:
+        filters = parse_orders_filters(request.args)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid filter: {e}"}), 400
+    
     try:
-        db.connect()
-        orders = db.get_all_orders()
-        # Aggiungiamo gli articoli per ogni ordine
-        for order in orders:
-            order['items'] = db.get_order_items(order['id'])
-        db.disconnect()
-        return jsonify(orders)
+        with g.shard.db.session():
+            if shape == 'rows':
+                body = load_order_rows(g.shard.db, g.store_id, filters)
+                ids = [row[0] for row in body['rows']]
+            else:
+                body = load_orders(g.shard.db, g.store_id, filters)
+                ids = [order['id'] for order in body]
+        response = jsonify(body)
+        # Pagina piena: il client può chiedere la successiva con before_id
+        if 'limit' in filters and len(ids) == filters['limit']:
+            response.headers['X-Next-Before-Id'] = str(ids[-1])
+        return response
     except Exception as e:
         logger.error(f"Error getting orders: {e}")
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/orders/<int:order_id>', methods=['GET'])
-def get_order(order_id):
+@api.route('/api/orders/stream', methods=['GET'])
+def stream_orders():
+    """Stream SSE: snapshot iniziale degli ordini (stessi filtri di /api/orders), poi gli eventi"""
+    try:
+        filters = parse_orders_filters(request.args)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid filter: {e}"}), 400
+    
+    # Ci iscriviamo prima di leggere lo snapshot per non perdere eventi intermedi
+    broker = brokers.get(g.store_id)
+    subscription = broker.subscribe()
+    try:
+        with g.shard.db.session():
+            orders = load_orders(g.shard.db, g.store_id, filters)
+    except Exception as e:
+        broker.unsubscribe(subscription)
+        logger.error(f"Error streaming orders: {e}")
+        return jsonify({"error": str(e)}), 500
+    snapshot = format_sse('snapshot', current_app.json.dumps(orders, separators=(',', ':')))
+    
+    def generate():
+        try:
+            yield snapshot
+            while not subscription.closed:
+                payload = subscription.get(timeout=Config.SSE_KEEPALIVE)
+                # Commento SSE periodico per tenere aperta la connessione
+                yield payload if payload is not None else ": keepalive\n\n"
+        finally:
+            broker.unsubscribe(subscription)
+    
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@api.route('/api/orders/export', methods=['GET'])
+def export_orders():
+    """Esporta in streaming gli ordini dell'intervallo [from, to) in NDJSON o CSV (gzip se accettato)"""
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in MIMETYPES:
+        return jsonify({"error": f"Invalid format, use one of: {', '.join(MIMETYPES)}"}), 400
+    try:
+        start, end = parse_period(request.args)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid filter: {e}"}), 400
+    
+    # Il generatore gira dopo la fine della richiesta: fuori dal contesto di `g`
+    shard_db, store_id = g.shard.db, g.store_id
+    
+    def rows():
+        # La sessione resta aperta mentre la risposta viene inviata: le righe arrivano
+        # dal cursore a blocchi e in memoria c'è sempre un solo blocco
+        try:
+            with shard_db.session():
+                yield from shard_db.iter_orders_export(start, end, batch_size=Config.ORDERS_EXPORT_BATCH,
+                                                       store_id=store_id)
+        except Exception as e:
+            logger.error(f"Error exporting orders: {e}")
+            raise
+    
+    if fmt == 'csv':
+        lines = export_lines(rows(), ORDER_CSV_FIELDS, fmt, None)
+    else:
+        dumps = current_app.json.dumps
+        lines = export_lines(group_orders(rows()), ORDER_FIELDS, fmt, lambda data: dumps(data, separators=(',', ':')))
+    lines = chunked(lines)
+    headers = {'Content-Disposition': f'attachment; filename=orders.{fmt}', 'Vary': 'Accept-Encoding'}
+    if 'gzip' in request.accept_encodings:
+        lines = gzip_stream(lines)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(lines, mimetype=MIMETYPES[fmt], headers=headers)
+
+@api.route('/api/orders/<int:order_id>', methods=['GET'])
+async def get_order(order_id):
     """Recupera un ordine specifico"""
     try:
-        db.connect()
-        order = db.get_order_by_id(order_id)
+        # Ordine e articoli vengono letti in parallelo
+        async with g.shard.adb.session():
+            order, items = await asyncio.gather(
+                g.shard.adb.get_order_by_id(order_id, g.store_id), g.shard.adb.get_order_items(order_id)
+            )
         if not order:
-            db.disconnect()
             return jsonify({"error": "Order not found"}), 404
-        order['items'] = db.get_order_items(order_id)
-        db.disconnect()
+        order['items'] = items
         return jsonify(order)
     except Exception as e:
         logger.error(f"Error getting order: {e}")
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/orders', methods=['POST'])
+# Risposte di POST /api/orders per Idempotency-Key (i retry dello stesso worker non toccano il DB)
+idempotent_responses = idempotency.IdempotencyCache(maxsize=Config.IDEMPOTENCY_CACHE_SIZE, ttl=Config.IDEMPOTENCY_TTL)
+
+def order_created_response(body, replayed=False):
+    """Risposta 201 di un ordine; un retry con la stessa Idempotency-Key riceve la stessa risposta"""
+    response = jsonify(body)
+    if replayed:
+        response.headers[idempotency.REPLAYED_HEADER] = 'true'
+    return response, 201
+
+def deliver_outbox_order(entry):
+    """Scrive sullo shard del negozio un ordine dell'outbox (dal thread di consegna)"""
+    store_id = entry['store_id']
+    shard_db = shards.for_store(store_id).db
+    with shard_db.session():
+        # La chiave rende sicura una seconda consegna dello stesso ordine
+        order_id, created = shard_db.create_order_idempotent(
+            entry['idempotency_key'], entry['fingerprint'], entry['total_price'], entry['items'], store_id=store_id
+        )
+        order = shard_db.get_order_by_id(order_id, store_id)
+        if order is None:
+            # Consegnato in precedenza e poi eliminato
+            return {"id": order_id, "order_number": None}
+        if created:
+            order['items'] = shard_db.get_order_items(order_id)
+    if created:
+        kitchen_queues.get(store_id).add(order)
+        if brokers.get(store_id).subscriber_count():
+            publish_order_event('order_created', order, store_id)
+    return order
+
+# Con ORDER_OUTBOX gli ordini vengono accettati nel file locale e scritti sugli shard in background.
+# Un retry oltre la scadenza della Idempotency-Key potrebbe duplicare un ordine già scritto
+if Config.ORDER_OUTBOX and Config.ORDER_OUTBOX_MAX_AGE >= Config.IDEMPOTENCY_TTL:
+    raise ValueError("ORDER_OUTBOX_MAX_AGE must be lower than IDEMPOTENCY_TTL")
+
+order_outbox = OrderOutbox(
+    Config.ORDER_OUTBOX_DB,
+    deliver_outbox_order,
+    batch_size=Config.ORDER_OUTBOX_BATCH,
+    retry_base=Config.ORDER_OUTBOX_RETRY,
+    retry_max=Config.ORDER_OUTBOX_RETRY_MAX,
+    retention=Config.ORDER_OUTBOX_RETENTION,
+    failed_retention=Config.ORDER_OUTBOX_FAILED_RETENTION,
+    max_age=Config.ORDER_OUTBOX_MAX_AGE
+) if Config.ORDER_OUTBOX else None
+
+def order_queued_response(entry, replayed=False):
+    """Risposta 202 di un ordine in outbox: il totem mostra il numero provvisorio"""
+    response = jsonify(dict(outbox_entry_body(entry), message="Order queued"))
+    response.headers['Location'] = f"/api/orders/outbox/{entry['provisional_number']}"
+    if replayed:
+        response.headers[idempotency.REPLAYED_HEADER] = 'true'
+    return response, 202
+
+def load_price_index():
+    """Listino del negozio della richiesta. Con l'outbox, se il catalogo non risponde,
+    si usa l'ultimo listino valido salvato nel file dell'outbox"""
+    try:
+        with db.session():
+            price_index = stores.apply_price_overrides(db.get_price_index(), db.get_store_overrides(g.store_id))
+    except Exception as e:
+        price_index = order_outbox.last_prices(g.store_id) if order_outbox is not None else None
+        if price_index is None:
+            raise
+        logger.warning(f"Catalog unavailable, pricing order with the last known prices: {e}")
+        return price_index
+    if order_outbox is not None:
+        order_outbox.remember_prices(g.store_id, price_index)
+    return price_index
+
+@api.route('/api/orders', methods=['POST'])
 def create_order():
-    """Crea un nuovo ordine"""
+    """Crea un nuovo ordine (header opzionale Idempotency-Key per i retry dei totem)"""
     try:
         data = request.get_json()
-        if not data or 'items' not in data or 'total_price' not in data:
-            return jsonify({"error": "Missing required fields: items, total_price"}), 400
+        if not data or 'items' not in data:
+            return jsonify({"error": "Missing required field: items"}), 400
+        
+        key = request.headers.get(idempotency.HEADER)
+        if key is not None:
+            try:
+                key = idempotency.validate_key(key)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            request_fingerprint = idempotency.fingerprint(data)
+            body = idempotent_responses.lookup(g.store_id, key, request_fingerprint)
+            if body is not None:
+                return order_created_response(body, replayed=True)
+        
+        # I prezzi arrivano dal listino del server (con i prezzi del negozio), non dal client
+        price_index = load_price_index()
+        try:
+            total_price, items = price_order(data['items'], price_index)
+        except PricingError as e:
+            return jsonify({"error": str(e)}), 400
+        client_total = data.get('total_price')
+        if isinstance(client_total, (int, float)) and Decimal(str(client_total)) != total_price:
+            logger.warning(f"Client total {client_total} differs from server total {total_price}")
+        
+        if order_outbox is not None:
+            # Senza Idempotency-Key l'outbox genera una chiave per la consegna
+            entry, created = order_outbox.enqueue(
+                g.store_id, key, request_fingerprint if key is not None else idempotency.fingerprint(data),
+                total_price, items
+            )
+            return order_queued_response(entry, replayed=not created)
+        
+        # L'ordine viene scritto sullo shard del negozio
+        shard_db = g.shard.db
+        with shard_db.session():
+            if key is None:
+                order_id, created = shard_db.create_order(total_price, items, store_id=g.store_id), True
+            else:
+                order_id, created = shard_db.create_order_idempotent(
+                    key, request_fingerprint, total_price, items, store_id=g.store_id
+                )
+            order = shard_db.get_order_by_id(order_id, g.store_id)
+            if order is None:
+                # Retry di un ordine creato e poi eliminato
+                return jsonify({"error": "Order not found"}), 404
+            if created:
+                order['items'] = shard_db.get_order_items(order_id)
         
-        db.connect()
-        order_id = db.create_order(data['total_price'], data['items'])
-        db.disconnect()
-        return jsonify({"id": order_id, "message": "Order created successfully"}), 201
+        # Un retry (anche arrivato a un altro worker) riceve il totale registrato con l'ordine originale
+        body = {"id": order_id, "total_price": float(order['total_price']), "message": "Order created successfully"}
+        if key is not None:
+            idempotent_responses.remember(g.store_id, key, request_fingerprint, body)
+        if not created:
+            return order_created_response(body, replayed=True)
+        kitchen_queues.get(g.store_id).add(order)
+        if brokers.get(g.store_id).subscriber_count():
+            publish_order_event('order_created', order)
+        return order_created_response(body)
+    except idempotency.IdempotencyKeyMismatch as e:
+        return jsonify({"error": str(e)}), 422
     except Exception as e:
         logger.error(f"Error creating order: {e}")
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/orders/<int:order_id>/status', methods=['PUT'])
+@api.route('/api/orders/outbox/<provisional_number>', methods=['GET'])
+def get_outbox_order(provisional_number):
+    """Stato di un ordine in outbox: 'queued', 'delivered' (con id e numero definitivi) o 'failed'"""
+    try:
+        entry = order_outbox.get(provisional_number) if order_outbox is not None else None
+        if entry is None or entry['store_id'] != g.store_id:
+            return jsonify({"error": "Order not found"}), 404
+        return jsonify(outbox_entry_body(entry))
+    except Exception as e:
+        logger.error(f"Error getting outbox order: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@api.route('/api/orders/<int:order_id>/status', methods=['PUT'])
 def update_order_status(order_id):
     """Aggiorna lo stato di un ordine"""
     try:
@@ -244,32 +869,289 @@ def update_order_status(order_id):
         if not data or 'status' not in data:
             return jsonify({"error": "Missing required field: status"}), 400
         
-        db.connect()
-        db.update_order_status(order_id, data['status'])
-        db.disconnect()
+        status = normalize_status(data['status'])
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    try:
+        with g.shard.db.session():
+            updated = g.shard.db.update_order_status(order_id, status, store_id=g.store_id)
+        if not updated:
+            return jsonify({"error": "Order not found"}), 404
+        kitchen_queues.get(g.store_id).update_status(order_id, status)
+        publish_order_event('order_updated', {"id": order_id, "status": status})
         return jsonify({"message": "Order status updated successfully"})
+    except InvalidStatusTransition as e:
+        return jsonify({"error": str(e), "status": e.current}), 409
     except Exception as e:
         logger.error(f"Error updating order status: {e}")
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/orders/<int:order_id>', methods=['DELETE'])
+@api.route('/api/orders/<int:order_id>', methods=['DELETE'])
 def delete_order(order_id):
     """Elimina un ordine"""
     try:
-        db.connect()
-        db.delete_order(order_id)
-        db.disconnect()
+        with g.shard.db.session():
+            deleted = g.shard.db.delete_order(order_id, store_id=g.store_id)
+        if not deleted:
+            return jsonify({"error": "Order not found"}), 404
+        kitchen_queues.get(g.store_id).remove(order_id)
+        publish_order_event('order_deleted', {"id": order_id})
         return jsonify({"message": "Order deleted successfully"})
     except Exception as e:
         logger.error(f"Error deleting order: {e}")
         return jsonify({"error": str(e)}), 500
 
+# ==================== CUCINA ====================
+
+def load_kitchen_orders(store_id):
+    """Ordini attivi del negozio con articoli, per ricaricare la sua coda della cucina"""
+    shard_db = shards.for_store(store_id).db
+    with shard_db.session():
+        return load_orders(shard_db, store_id, {'statuses': list(ACTIVE_STATUSES)})
+
+# Code degli ordini attivi per negozio, aggiornate dalle route degli ordini
+kitchen_queues = stores.StoreRegistry(lambda store_id: KitchenQueue(
+    lambda: load_kitchen_orders(store_id), resync_interval=Config.KITCHEN_QUEUE_RESYNC
+))
+
+@api.route('/api/kitchen/queue', methods=['GET'])
+def get_kitchen_queue():
+    """Ordini da preparare o da consegnare, in ordine di numero"""
+    try:
+        return jsonify(kitchen_queues.get(g.store_id).snapshot())
+    except Exception as e:
+        logger.error(f"Error getting kitchen queue: {e}")
+        return jsonify({"error": str(e)}), 500
+
+# ==================== ANALYTICS ====================
+
+@api.route('/api/analytics/sales', methods=['GET'])
+def get_sales():
+    """Ordini, quantità e ricavi per ora o per giorno (parametri: granularity, from, to)"""
+    granularity = request.args.get('granularity', 'day')
+    if granularity not in ('hour', 'day'):
+        return jsonify({"error": "granularity must be 'hour' or 'day'"}), 400
+    try:
+        start, end = parse_period(request.args)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid filter: {e}"}), 400
+    
+    try:
+        with g.shard.db.session():
+            return jsonify(g.shard.db.get_sales(granularity, start, end, g.store_id))
+    except Exception as e:
+        logger.error(f"Error getting sales: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@api.route('/api/analytics/products', methods=['GET'])
+def get_product_sales():
+    """Prodotti più venduti nel periodo (parametri: from, to, limit)"""
+    try:
+        start, end = parse_period(request.args)
+        limit = int(request.args.get('limit', 20))
+        if not 1 <= limit <= Config.ORDERS_MAX_LIMIT:
+            raise ValueError(f"limit must be between 1 and {Config.ORDERS_MAX_LIMIT}")
+    except ValueError as e:
+        return jsonify({"error": f"Invalid filter: {e}"}), 400
+    
+    try:
+        with g.shard.db.session():
+            return jsonify(g.shard.db.get_product_sales(start, end, limit, g.store_id))
+    except Exception as e:
+        logger.error(f"Error getting product sales: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@api.route('/api/analytics/categories', methods=['GET'])
+def get_category_sales():
+    """Vendite per categoria nel periodo (parametri: from, to)"""
+    try:
+        start, end = parse_period(request.args)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid filter: {e}"}), 400
+    
+    try:
+        with g.shard.db.session():
+            return jsonify(g.shard.db.get_category_sales(start, end, g.store_id))
+    except Exception as e:
+        logger.error(f"Error getting category sales: {e}")
+        return jsonify({"error": str(e)}), 500
+
+# ==================== NEGOZI ====================
+
+@api.route('/api/stores/<int:store_id>/products', methods=['GET'])
+def get_store_products(store_id):
+    """Prezzi e disponibilità personalizzati di un negozio"""
+    try:
+        with db.session():
+            overrides = db.get_store_overrides(store_id)
+        return jsonify([{"product_id": product_id, **override} for product_id, override in overrides.items()])
+    except Exception as e:
+        logger.error(f"Error getting store products: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@api.route('/api/stores/<int:store_id>/products/<int:product_id>', methods=['PUT'])
+def set_store_product(store_id, product_id):
+    """Imposta prezzo (null = quello del catalogo) e disponibilità di un prodotto nel negozio"""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not ('price' in data or 'available' in data):
+        return jsonify({"error": "Missing required field: price or available"}), 400
+    price, available = data.get('price'), data.get('available', True)
+    if price is not None and (isinstance(price, bool) or not isinstance(price, (int, float)) or price < 0):
+        return jsonify({"error": "price must be a non-negative number or null"}), 400
+    if not isinstance(available, bool):
+        return jsonify({"error": "available must be a boolean"}), 400
+    
+    try:
+        with db.session():
+            if db.get_product_by_id(product_id) is None:
+                return jsonify({"error": "Product not found"}), 404
+            db.set_store_override(store_id, product_id, price, available)
+        return jsonify({"message": "Store product updated successfully"})
+    except Exception as e:
+        logger.error(f"Error updating store product: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@api.route('/api/stores/<int:store_id>/products/<int:product_id>', methods=['DELETE'])
+def delete_store_product(store_id, product_id):
+    """Riporta un prodotto del negozio al prezzo e alla disponibilità del catalogo"""
+    try:
+        with db.session():
+            db.delete_store_override(store_id, product_id)
+        return jsonify({"message": "Store product reset successfully"})
+    except Exception as e:
+        logger.error(f"Error resetting store product: {e}")
+        return jsonify({"error": str(e)}), 500
+
+# ==================== COMANDI ====================
+
+def migrate_shards():
+    """Applica le migrazioni a tutti gli shard e allinea le loro copie del catalogo"""
+    applied = {shard.name: apply_migrations(shard.db) for shard in shards}
+    shards.sync_catalog()
+    return applied
+
+@api.cli.command('migrate')
+def migrate_command():
+    """Applica le migrazioni di schema mancanti (su tutti gli shard)"""
+    for name, applied in migrate_shards().items():
+        print(f"{name}: applied migrations {applied}" if applied else f"{name}: schema already up to date")
+
+@api.cli.command('purge-idempotency-keys')
+def purge_idempotency_keys_command():
+    """Elimina dal database le Idempotency-Key scadute (IDEMPOTENCY_TTL)"""
+    for shard in shards:
+        with shard.db.session():
+            deleted = shard.db.purge_idempotency_keys()
+        print(f"{shard.name}: deleted {deleted} expired idempotency keys")
+
+@api.cli.command('backfill-analytics')
+def backfill_analytics_command():
+    """Ricalcola i rollup delle vendite da tutti gli ordini esistenti"""
+    for shard in shards:
+        with shard.db.session():
+            shard.db.rebuild_analytics()
+        print(f"{shard.name}: sales rollups rebuilt")
+
+@api.cli.command('rebuild-images')
+def rebuild_images_command():
+    """Rigenera le varianti delle immagini dei prodotti (es. dopo un riavvio o l'installazione di Pillow)"""
+    if not images.PILLOW:
+        print("Pillow is not installed: variants cannot be generated")
+        return
+    with db.session():
+        originals = db.get_product_originals()
+    for product_id, original in originals.items():
+        variants = image_pipeline.process(product_id, original)
+        print(f"product {product_id}: {', '.join(variants) if variants else 'failed'}")
+
+# ==================== METRICHE ====================
+
+@api.before_app_request
+def start_request_metrics():
+    metrics.start_request()
+
+@api.after_app_request
+def finish_request_metrics(response):
+    """Aggiunge l'header Server-Timing e registra latenza e query della richiesta"""
+    stats = metrics.current_request()
+    if stats is None:
+        return response
+    # Etichetta per regola (/api/orders/<int:order_id>), non per URL: le serie restano poche
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.observe_request(request.method, route, response.status_code, stats)
+    if Config.SERVER_TIMING:
+        response.headers['Server-Timing'] = metrics.server_timing(stats)
+    return response
+
+def pool_samples(pools):
+    """Campioni (pool, stato) -> connessioni per le metriche dei pool"""
+    samples = []
+    for name, stats in pools.items():
+        samples.append(((name, 'in_use'), stats['in_use']))
+        samples.append(((name, 'idle'), stats['idle']))
+    return samples
+
+@api.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Metriche del processo in formato Prometheus"""
+    pools = {}
+    for shard in shards:
+        # Lo shard 'default' mantiene i nomi dei pool di un'installazione a negozio singolo
+        prefix = '' if shard.name == DEFAULT_SHARD else f"{shard.name} "
+        pools[f"{prefix}primary"] = shard.db.pool.stats()
+        pools[f"{prefix}async"] = shard.adb.pool.stats()
+        # Solo i wrapper MySQL hanno repliche di lettura
+        for kind, wrapper in (('replica', shard.db), ('async replica', shard.adb)):
+            replicas = getattr(wrapper, 'replicas', None)
+            if replicas:
+                for name, stats in replicas.stats().items():
+                    pools[f"{prefix}{kind} {name}"] = stats
+    cache = db.menu_cache.stats()
+    lookups = cache['hits'] + cache['misses']
+    body = metrics.render(
+        metrics.collected('db_pool_size', 'Maximum connections per pool',
+                          [((name,), stats['size']) for name, stats in pools.items()], labels=('pool',)),
+        metrics.collected('db_pool_connections', 'Pool connections by state',
+                          pool_samples(pools), labels=('pool', 'state')),
+        metrics.collected('db_pool_utilization', 'Borrowed connections over pool size',
+                          [((name,), stats['in_use'] / stats['size'] if stats['size'] else 0)
+                           for name, stats in pools.items()], labels=('pool',)),
+        metrics.collected('menu_cache_hits_total', 'Menu cache hits', [((), cache['hits'])], kind='counter'),
+        metrics.collected('menu_cache_misses_total', 'Menu cache misses', [((), cache['misses'])], kind='counter'),
+        metrics.collected('menu_cache_hit_ratio', 'Menu cache hits over lookups',
+                          [((), cache['hits'] / lookups if lookups else 0)]),
+        metrics.collected('menu_cache_entries', 'Entries in the menu cache', [((), cache['size'])]),
+        metrics.collected('order_event_subscribers', 'Dashboards connected to the order stream',
+                          [((), sum(broker.subscriber_count() for broker in brokers.values()))]),
+        metrics.collected('order_outbox_entries', 'Orders in the local outbox by status',
+                          [((status,), count) for status, count in order_outbox.stats().items()]
+                          if order_outbox is not None else [], labels=('status',)),
+    )
+    return Response(body, content_type=metrics.CONTENT_TYPE)
+
 # ==================== HEALTH CHECK ====================
 
-@app.route('/api/health', methods=['GET'])
+@api.route('/api/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
     return jsonify({"status": "ok"}), 200
 
+def create_app():
+    """Crea e configura l'applicazione Flask"""
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    # orjson per il JSON, MessagePack per i client che lo chiedono con Accept
+    app.json = encoding.JSONProvider(app)
+    # Il client deve poter leggere gli header custom delle risposte
+    CORS(app, expose_headers=[idempotency.REPLAYED_HEADER, 'X-Next-Before-Id', 'Location'])
+    app.register_blueprint(api)
+    if order_outbox is not None:
+        # Il thread di consegna usa current_app.json per gli eventi
+        order_outbox.start(app.app_context)
+    return app
+
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    # Server di sviluppo: in produzione usare gunicorn (vedi gunicorn.conf.py)
+    migrate_shards()
+    create_app().run(debug=Config.DEBUG, host=Config.HOST, port=Config.PORT)
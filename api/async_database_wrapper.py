@@ -0,0 +1,471 @@
+import contextvars
+from contextlib import asynccontextmanager
+import aiomysql
+from config import Config
+from metrics import timed_query
+from async_pool import AsyncConnectionPool, DatabaseLoop, on_db_loop
+from cache import MenuCache
+from replicas import ReplicaSet, parse_endpoint, primary_hold
+from pricing import build_price_index
+from analytics import rollup_statements, status_change_sign
+from order_status import InvalidStatusTransition, check_transition, normalize_status
+from database_wrapper import DOMAIN_ERRORS
+from stores import DEFAULT_STORE_ID
+from images import attach_images
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Immagini dei prodotti, aggiunte alle letture del catalogo come URL per variante
+PRODUCT_IMAGES_QUERY = "SELECT product_id, variant, file FROM product_images"
+
+class AsyncDatabaseWrapper:
+    """Wrapper asincrono (aiomysql): letture e scritture di catalogo e ordini di DatabaseWrapper.
+
+    Import del catalogo, immagini, analytics, idempotenza ed export restano solo nel
+    wrapper sincrono (vedi README, "Database asincrono").
+    """
+
+    dialect = 'mysql'
+
+    def __init__(self, database=None, menu_cache=None):
+        self.database = database or Config.DB_NAME
+        self.db_loop = DatabaseLoop()
+        self.pool = AsyncConnectionPool(
+            self._create_connection,
+            size=Config.DB_POOL_SIZE,
+            timeout=Config.DB_POOL_TIMEOUT,
+            idle_timeout=Config.DB_POOL_IDLE_TIMEOUT,
+            ping=lambda connection: connection.ping(reconnect=False),
+            pre_ping=Config.DB_POOL_PRE_PING
+        )
+        # Repliche di lettura con le stesse regole del wrapper sincrono (vedi session())
+        self.replicas = ReplicaSet(
+            [parse_endpoint(endpoint, Config.DB_PORT) for endpoint in Config.DB_REPLICAS],
+            self._create_connection,
+            retry_after=Config.DB_REPLICA_RETRY,
+            pool_class=AsyncConnectionPool,
+            size=Config.DB_POOL_SIZE,
+            timeout=Config.DB_POOL_TIMEOUT,
+            idle_timeout=Config.DB_POOL_IDLE_TIMEOUT,
+            ping=lambda connection: connection.ping(reconnect=False),
+            pre_ping=Config.DB_POOL_PRE_PING
+        )
+        # Condiviso con il wrapper sincrono: le sue modifiche al catalogo valgono anche qui
+        self.primary_hold = primary_hold(self.database)
+        # Stato della sessione corrente ({wrote, replica}); il contesto segue la richiesta
+        # anche sul loop del database
+        self._session = contextvars.ContextVar(f"async_db_session_{self.database}", default=None)
+        # Passando la cache del wrapper sincrono le due versioni condividono le invalidazioni
+        self.menu_cache = menu_cache or MenuCache(maxsize=Config.MENU_CACHE_SIZE, ttl=Config.MENU_CACHE_TTL)
+
+    async def _create_connection(self, host=None, port=None):
+        """Apre una nuova connessione MySQL al primario o a una replica (usata dai pool)"""
+        try:
+            # autocommit: le letture non lasciano transazioni aperte sulle connessioni del pool,
+            # le scritture su più tabelle usano run_in_transaction()
+            return await aiomysql.connect(
+                host=host or Config.DB_HOST,
+                user=Config.DB_USER,
+                password=Config.DB_PASSWORD,
+                db=self.database,
+                port=port or Config.DB_PORT,
+                charset='utf8mb4',
+                cursorclass=aiomysql.DictCursor,
+                autocommit=True
+            )
+        except aiomysql.Error as e:
+            logger.error(f"Database connection error: {e}")
+            raise
+
+    @asynccontextmanager
+    async def session(self):
+        """Contesto per-richiesta: solo dentro una sessione le letture possono andare alle repliche"""
+        if self._session.get() is not None:
+            yield self
+            return
+        token = self._session.set({'wrote': False, 'replica': None})
+        try:
+            yield self
+        finally:
+            self._session.reset(token)
+
+    def _read_replica(self):
+        """Replica per le letture della sessione corrente, o None se si legge dal primario"""
+        state = self._session.get()
+        if not self.replicas or state is None:
+            return None
+        # Read-your-writes: dopo una scrittura la sessione legge solo dal primario
+        if state['wrote'] or self.primary_hold.active:
+            return None
+        # La sessione resta sulla stessa replica finché è sana
+        if state['replica'] is None or not state['replica'].healthy:
+            state['replica'] = self.replicas.choose()
+        return state['replica']
+
+    def _mark_write(self):
+        state = self._session.get()
+        if state is not None:
+            state['wrote'] = True
+
+    def _hold_reads_on_primary(self):
+        """Dopo una modifica al catalogo legge dal primario per DB_REPLICA_MAX_LAG secondi"""
+        if self.replicas:
+            self.primary_hold.hold(Config.DB_REPLICA_MAX_LAG)
+
+    async def _cached(self, key, loader):
+        """Ritorna il valore dalla cache del menu o lo carica (senza passare dal loop del database)"""
+        missing = object()
+        value = self.menu_cache.get(key, missing)
+        if value is missing:
+            version = self.menu_cache.version
+            value = await loader()
+            if value is not None:
+                self.menu_cache.set(key, value, version)
+        return value
+
+    @timed_query
+    @on_db_loop
+    async def execute_query(self, query, params=None):
+        """Esegue una query (su una replica se disponibile) e ritorna i risultati"""
+        replica = self._read_replica()
+        if replica is not None:
+            try:
+                async with replica.pool.connection() as connection:
+                    async with connection.cursor() as cursor:
+                        await cursor.execute(query, params)
+                        return await cursor.fetchall()
+            except aiomysql.OperationalError as e:
+                # Replica non raggiungibile: la escludiamo e ripieghiamo sul primario
+                self.replicas.mark_down(replica, e)
+        try:
+            async with self.pool.connection() as connection:
+                async with connection.cursor() as cursor:
+                    await cursor.execute(query, params)
+                    return await cursor.fetchall()
+        except aiomysql.Error as e:
+            logger.error(f"Query execution error: {e}")
+            raise
+
+    @timed_query
+    @on_db_loop
+    async def execute_update(self, query, params=None):
+        """Esegue un INSERT/UPDATE/DELETE e ritorna le righe modificate"""
+        self._mark_write()
+        try:
+            async with self.pool.connection() as connection:
+                async with connection.cursor() as cursor:
+                    await cursor.execute(query, params)
+                    return cursor.rowcount
+        except aiomysql.Error as e:
+            logger.error(f"Update execution error: {e}")
+            raise
+
+    @timed_query
+    @on_db_loop
+    async def execute_insert(self, query, params=None):
+        """Esegue un INSERT e ritorna l'ID del nuovo record"""
+        self._mark_write()
+        try:
+            async with self.pool.connection() as connection:
+                async with connection.cursor() as cursor:
+                    await cursor.execute(query, params)
+                    return cursor.lastrowid
+        except aiomysql.Error as e:
+            logger.error(f"Insert execution error: {e}")
+            raise
+
+    @timed_query
+    @on_db_loop
+    async def run_in_transaction(self, work):
+        """Esegue await work(cursor) in un'unica transazione: commit alla fine, rollback in caso di errore"""
+        self._mark_write()
+        async with self.pool.connection() as connection:
+            try:
+                await connection.begin()
+                async with connection.cursor() as cursor:
+                    result = await work(cursor)
+                await connection.commit()
+                return result
+            except DOMAIN_ERRORS:
+                # Errori previsti (gestiti dalle route con 409/422): nessun log di errore
+                await connection.rollback()
+                raise
+            except Exception as e:
+                await connection.rollback()
+                logger.error(f"Transaction error: {e}")
+                raise
+
+    # === CATEGORIE ===
+    async def get_all_categories(self):
+        """Recupera tutte le categorie"""
+        query = "SELECT id, name, description FROM categories ORDER BY name"
+        return await self._cached(('categories',), lambda: self.execute_query(query))
+
+    async def get_category_by_id(self, category_id):
+        """Recupera una categoria per ID"""
+        query = "SELECT id, name, description FROM categories WHERE id = %s"
+        result = await self.execute_query(query, (category_id,))
+        return result[0] if result else None
+
+    async def create_category(self, name, description=""):
+        """Crea una nuova categoria"""
+        query = "INSERT INTO categories (name, description) VALUES (%s, %s)"
+        category_id = await self.execute_insert(query, (name, description))
+        self.menu_cache.invalidate_categories()
+        self._hold_reads_on_primary()
+        return category_id
+
+    async def update_category(self, category_id, name, description):
+        """Aggiorna una categoria"""
+        query = "UPDATE categories SET name = %s, description = %s WHERE id = %s"
+        result = await self.execute_update(query, (name, description, category_id))
+        self.menu_cache.invalidate_categories()
+        self._hold_reads_on_primary()
+        return result
+
+    async def delete_category(self, category_id):
+        """Elimina una categoria"""
+        query = "DELETE FROM categories WHERE id = %s"
+        result = await self.execute_update(query, (category_id,))
+        self.menu_cache.invalidate_categories()
+        self._hold_reads_on_primary()
+        return result
+
+    # === PRODOTTI ===
+    async def get_all_products(self):
+        """Recupera tutti i prodotti con le loro categorie"""
+        query = """
+            SELECT p.id, p.name, p.description, p.price, p.image_url, p.category_id, c.name as category_name
+            FROM products p
+            LEFT JOIN categories c ON p.category_id = c.id
+            ORDER BY c.name, p.name
+        """
+
+        async def load():
+            return attach_images(
+                await self.execute_query(query),
+                await self.execute_query(PRODUCT_IMAGES_QUERY),
+                Config.IMAGES_BASE_URL
+            )
+        return await self._cached(('products',), load)
+
+    async def get_products_by_category(self, category_id):
+        """Recupera i prodotti di una categoria specifica"""
+        query = """
+            SELECT id, name, description, price, image_url, category_id
+            FROM products
+            WHERE category_id = %s
+            ORDER BY name
+        """
+        images_query = PRODUCT_IMAGES_QUERY + " WHERE product_id IN (SELECT id FROM products WHERE category_id = %s)"
+
+        async def load():
+            return attach_images(
+                await self.execute_query(query, (category_id,)),
+                await self.execute_query(images_query, (category_id,)),
+                Config.IMAGES_BASE_URL
+            )
+        return await self._cached(('products_by_category', category_id), load)
+
+    async def get_product_by_id(self, product_id):
+        """Recupera un prodotto per ID"""
+        query = "SELECT id, name, description, price, image_url, category_id FROM products WHERE id = %s"
+
+        async def load():
+            result = await self.execute_query(query, (product_id,))
+            if not result:
+                return None
+            images = await self.execute_query(PRODUCT_IMAGES_QUERY + " WHERE product_id = %s", (product_id,))
+            return attach_images(result, images, Config.IMAGES_BASE_URL)[0]
+        return await self._cached(('product', product_id), load)
+
+    async def get_price_index(self):
+        """Recupera il listino {product_id: prezzo} usato per prezzare gli ordini"""
+        async def load():
+            return build_price_index(await self.execute_query("SELECT id, price FROM products"))
+        return await self._cached(('price_index',), load)
+
+    async def create_product(self, name, description, price, category_id, image_url=""):
+        """Crea un nuovo prodotto"""
+        query = """
+            INSERT INTO products (name, description, price, category_id, image_url)
+            VALUES (%s, %s, %s, %s, %s)
+        """
+        product_id = await self.execute_insert(query, (name, description, price, category_id, image_url))
+        self.menu_cache.invalidate_products(product_id)
+        self._hold_reads_on_primary()
+        return product_id
+
+    async def update_product(self, product_id, name, description, price, category_id, image_url):
+        """Aggiorna un prodotto"""
+        query = """
+            UPDATE products
+            SET name = %s, description = %s, price = %s, category_id = %s, image_url = %s
+            WHERE id = %s
+        """
+        result = await self.execute_update(query, (name, description, price, category_id, image_url, product_id))
+        self.menu_cache.invalidate_products(product_id)
+        self._hold_reads_on_primary()
+        return result
+
+    async def delete_product(self, product_id):
+        """Elimina un prodotto"""
+        query = "DELETE FROM products WHERE id = %s"
+        result = await self.execute_update(query, (product_id,))
+        self.menu_cache.invalidate_products(product_id)
+        self._hold_reads_on_primary()
+        return result
+
+    # === PREZZI PER NEGOZIO ===
+    async def get_store_overrides(self, store_id):
+        """Prezzi e disponibilità personalizzati del negozio: {product_id: {price, available}}"""
+        async def load():
+            rows = await self.execute_query(
+                "SELECT product_id, price, available FROM store_products WHERE store_id = %s", (store_id,)
+            )
+            return {row['product_id']: {"price": row['price'], "available": bool(row['available'])} for row in rows}
+        return await self._cached(('store_overrides', store_id), load)
+
+    # === ORDINI ===
+    async def get_all_orders(self, store_id=DEFAULT_STORE_ID):
+        """Recupera tutti gli ordini del negozio"""
+        query = """
+            SELECT id, order_number, status, total_price, created_at, updated_at
+            FROM orders
+            WHERE store_id = %s
+            ORDER BY created_at DESC
+        """
+        return await self.execute_query(query, (store_id,))
+
+    async def get_orders(self, statuses=None, since=None, limit=None, before_id=None, store_id=DEFAULT_STORE_ID):
+        """Recupera gli ordini del negozio filtrati per stato e data, paginati per id decrescente (keyset)"""
+        conditions = ["store_id = %s"]
+        params = [store_id]
+        if statuses:
+            conditions.append(f"status IN ({', '.join(['%s'] * len(statuses))})")
+            params.extend(statuses)
+        if since is not None:
+            conditions.append("created_at >= %s")
+            params.append(since)
+        if before_id is not None:
+            conditions.append("id < %s")
+            params.append(before_id)
+        query = "SELECT id, order_number, status, total_price, created_at, updated_at FROM orders"
+        query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY id DESC"
+        if limit is not None:
+            query += " LIMIT %s"
+            params.append(limit)
+        return await self.execute_query(query, tuple(params))
+
+    async def get_order_by_id(self, order_id, store_id=DEFAULT_STORE_ID):
+        """Recupera un ordine del negozio per ID"""
+        query = """
+            SELECT id, order_number, status, total_price, created_at, updated_at
+            FROM orders WHERE id = %s AND store_id = %s
+        """
+        result = await self.execute_query(query, (order_id, store_id))
+        return result[0] if result else None
+
+    async def get_order_items(self, order_id):
+        """Recupera gli articoli di un ordine"""
+        query = """
+            SELECT oi.id, oi.product_id, oi.quantity, oi.unit_price, p.name, p.description
+            FROM order_items oi
+            LEFT JOIN products p ON oi.product_id = p.id
+            WHERE oi.order_id = %s
+            ORDER BY oi.id
+        """
+        return await self.execute_query(query, (order_id,))
+
+    async def get_order_items_bulk(self, order_ids):
+        """Recupera gli articoli di più ordini con una sola query, raggruppati per ordine"""
+        items_by_order = {order_id: [] for order_id in order_ids}
+        if not items_by_order:
+            return items_by_order
+        placeholders = ", ".join(["%s"] * len(items_by_order))
+        query = f"""
+            SELECT oi.order_id, oi.id, oi.product_id, oi.quantity, oi.unit_price, p.name, p.description
+            FROM order_items oi
+            LEFT JOIN products p ON oi.product_id = p.id
+            WHERE oi.order_id IN ({placeholders})
+            ORDER BY oi.order_id, oi.id
+        """
+        for item in await self.execute_query(query, tuple(items_by_order)):
+            items_by_order[item.pop('order_id')].append(item)
+        return items_by_order
+
+    async def create_order(self, total_price, items, store_id=DEFAULT_STORE_ID):
+        """Crea un nuovo ordine con gli articoli in un'unica transazione"""
+        async def work(cursor):
+            counter = f"orders:{store_id}"
+            next_number = "UPDATE order_counters SET value = LAST_INSERT_ID(value + 1) WHERE name = %s"
+            await cursor.execute(next_number, (counter,))
+            if not cursor.rowcount:
+                # Primo ordine del negozio su questo shard: si riparte dal numero più alto già usato
+                await cursor.execute(
+                    "INSERT IGNORE INTO order_counters (name, value) SELECT %s, COALESCE(MAX(order_number), 0) FROM orders WHERE store_id = %s",
+                    (counter, store_id)
+                )
+                await cursor.execute(next_number, (counter,))
+            await cursor.execute("SELECT LAST_INSERT_ID() AS next_number")
+            order_number = (await cursor.fetchone())['next_number']
+            await cursor.execute(
+                "INSERT INTO orders (store_id, order_number, status, total_price) VALUES (%s, %s, %s, %s)",
+                (store_id, order_number, 'pending', total_price)
+            )
+            order_id = cursor.lastrowid
+            await cursor.executemany(
+                "INSERT INTO order_items (order_id, product_id, quantity, unit_price) VALUES (%s, %s, %s, %s)",
+                [(order_id, item['product_id'], item['quantity'], item['unit_price']) for item in items]
+            )
+            await self._apply_rollups(cursor, order_id, 1)
+            return order_id
+
+        return await self.run_in_transaction(work)
+
+    async def update_order_status(self, order_id, status, store_id=DEFAULT_STORE_ID):
+        """Aggiorna lo stato di un ordine del negozio"""
+        status = normalize_status(status)
+        async def work(cursor):
+            await cursor.execute("SELECT status FROM orders WHERE id = %s AND store_id = %s FOR UPDATE",
+                                 (order_id, store_id))
+            order = await cursor.fetchone()
+            if order is None:
+                return 0
+            check_transition(order['status'], status)
+            # Aggiornamento condizionale: vale solo se lo stato è ancora quello letto
+            await cursor.execute("UPDATE orders SET status = %s, updated_at = NOW() WHERE id = %s AND status = %s",
+                                 (status, order_id, order['status']))
+            updated = cursor.rowcount
+            if not updated:
+                # Lo stato è cambiato dopo la lettura
+                raise InvalidStatusTransition(order['status'], status)
+            sign = status_change_sign(order['status'], status)
+            if sign:
+                await self._apply_rollups(cursor, order_id, sign)
+            return updated
+
+        return await self.run_in_transaction(work)
+
+    async def delete_order(self, order_id, store_id=DEFAULT_STORE_ID):
+        """Elimina un ordine del negozio e i suoi articoli"""
+        async def work(cursor):
+            await cursor.execute("SELECT status FROM orders WHERE id = %s AND store_id = %s FOR UPDATE",
+                                 (order_id, store_id))
+            order = await cursor.fetchone()
+            if order is None:
+                return 0
+            if status_change_sign(order['status'], 'cancelled'):
+                await self._apply_rollups(cursor, order_id, -1)
+            await cursor.execute("DELETE FROM order_items WHERE order_id = %s", (order_id,))
+            await cursor.execute("DELETE FROM orders WHERE id = %s", (order_id,))
+            return cursor.rowcount
+
+        return await self.run_in_transaction(work)
+
+    async def _apply_rollups(self, cursor, order_id, sign):
+        """Aggiorna i rollup delle vendite nella transazione dell'ordine (vedi analytics.py)"""
+        for statement, params in rollup_statements(self.dialect, order_id, sign):
+            await cursor.execute(statement, params)
@@ -0,0 +1,214 @@
+import sqlite3
+from contextlib import asynccontextmanager
+from pathlib import Path
+import aiosqlite
+from config import Config
+from metrics import timed_query
+from async_pool import AsyncConnectionPool, DatabaseLoop, on_db_loop
+from cache import MenuCache
+from pricing import build_price_index
+from sqlite_writer import pragma_statements
+from stores import DEFAULT_STORE_ID
+from images import attach_images
+
+MAX_QUERY_PARAMS = 999
+
+# Immagini dei prodotti, aggiunte alle letture del catalogo come URL per variante
+PRODUCT_IMAGES_QUERY = "SELECT product_id, variant, file FROM product_images"
+
+
+class AsyncDatabaseWrapper:
+    """SQLite Wrapper asincrono (aiosqlite) con le letture di DatabaseWrapper usate dalle view async.
+
+    Scritture, import del catalogo, immagini, analytics, idempotenza ed export restano
+    solo nel wrapper sincrono (vedi README, "Database asincrono").
+
+    Le connessioni sono in sola lettura: tutte le scritture passano dal thread di
+    scrittura del wrapper sincrono (sqlite_writer.py), quindi nessuna transazione
+    asincrona può contendere il lock del database.
+
+    Lo schema è gestito dal wrapper sincrono e dalle migrazioni. Passando la
+    `menu_cache` del wrapper sincrono le due versioni condividono cache e
+    invalidazioni.
+    """
+
+    dialect = 'sqlite'
+
+    def __init__(self, db_file="hamburgeria.db", menu_cache=None):
+        self.db_file = db_file
+        self.db_loop = DatabaseLoop()
+        self.pool = AsyncConnectionPool(
+            self._create_connection,
+            size=Config.DB_POOL_SIZE,
+            timeout=Config.DB_POOL_TIMEOUT,
+            idle_timeout=Config.DB_POOL_IDLE_TIMEOUT,
+            ping=lambda connection: connection.execute("SELECT 1"),
+            pre_ping=Config.DB_POOL_PRE_PING
+        )
+        self.menu_cache = menu_cache or MenuCache(maxsize=Config.MENU_CACHE_SIZE, ttl=Config.MENU_CACHE_TTL)
+
+    async def _create_connection(self):
+        """Apre una nuova connessione in sola lettura (usata dal pool)"""
+        uri = Path(self.db_file).resolve().as_uri() + '?mode=ro'
+        connection = await aiosqlite.connect(uri, uri=True)
+        connection.row_factory = sqlite3.Row
+        for statement in pragma_statements():
+            await connection.execute(statement)
+        return connection
+
+    @asynccontextmanager
+    async def session(self):
+        """Contesto per-richiesta, come nel wrapper MySQL (senza repliche non c'è altro da fare)"""
+        yield self
+
+    async def _cached(self, key, loader):
+        # La cache viene controllata prima di passare al loop del database
+        missing = object()
+        value = self.menu_cache.get(key, missing)
+        if value is missing:
+            version = self.menu_cache.version
+            value = await loader()
+            if value is not None:
+                self.menu_cache.set(key, value, version)
+        return value
+
+    @timed_query
+    @on_db_loop
+    async def execute_query(self, query, params=None):
+        """Esegue una query e ritorna i risultati"""
+        async with self.pool.connection() as connection:
+            async with connection.execute(query, params or ()) as cursor:
+                return [dict(row) for row in await cursor.fetchall()]
+
+    # === CATEGORIE ===
+    async def get_all_categories(self):
+        return await self._cached(
+            ('categories',),
+            lambda: self.execute_query("SELECT id, name, description FROM categories ORDER BY name")
+        )
+
+    async def get_category_by_id(self, category_id):
+        result = await self.execute_query("SELECT id, name, description FROM categories WHERE id = ?", (category_id,))
+        return result[0] if result else None
+
+    # === PRODOTTI ===
+    async def get_all_products(self):
+        query = """
+            SELECT p.id, p.name, p.description, p.price, p.image_url, p.category_id, c.name as category_name
+            FROM products p
+            LEFT JOIN categories c ON p.category_id = c.id
+            ORDER BY c.name, p.name
+        """
+
+        async def load():
+            return attach_images(
+                await self.execute_query(query),
+                await self.execute_query(PRODUCT_IMAGES_QUERY),
+                Config.IMAGES_BASE_URL
+            )
+        return await self._cached(('products',), load)
+
+    async def get_products_by_category(self, category_id):
+        query = """
+            SELECT id, name, description, price, image_url, category_id
+            FROM products
+            WHERE category_id = ?
+            ORDER BY name
+        """
+        images_query = PRODUCT_IMAGES_QUERY + " WHERE product_id IN (SELECT id FROM products WHERE category_id = ?)"
+
+        async def load():
+            return attach_images(
+                await self.execute_query(query, (category_id,)),
+                await self.execute_query(images_query, (category_id,)),
+                Config.IMAGES_BASE_URL
+            )
+        return await self._cached(('products_by_category', category_id), load)
+
+    async def get_product_by_id(self, product_id):
+        async def load():
+            result = await self.execute_query("SELECT id, name, description, price, image_url, category_id FROM products WHERE id = ?", (product_id,))
+            if not result:
+                return None
+            images = await self.execute_query(PRODUCT_IMAGES_QUERY + " WHERE product_id = ?", (product_id,))
+            return attach_images(result, images, Config.IMAGES_BASE_URL)[0]
+        return await self._cached(('product', product_id), load)
+
+    async def get_price_index(self):
+        async def load():
+            return build_price_index(await self.execute_query("SELECT id, price FROM products"))
+        return await self._cached(('price_index',), load)
+
+    # === PREZZI PER NEGOZIO ===
+    async def get_store_overrides(self, store_id):
+        """Prezzi e disponibilità personalizzati del negozio: {product_id: {price, available}}"""
+        async def load():
+            rows = await self.execute_query(
+                "SELECT product_id, price, available FROM store_products WHERE store_id = ?", (store_id,)
+            )
+            return {row['product_id']: {"price": row['price'], "available": bool(row['available'])} for row in rows}
+        return await self._cached(('store_overrides', store_id), load)
+
+    # === ORDINI ===
+    async def get_all_orders(self, store_id=DEFAULT_STORE_ID):
+        query = """
+            SELECT id, order_number, status, total_price, created_at, updated_at
+            FROM orders WHERE store_id = ? ORDER BY created_at DESC
+        """
+        return await self.execute_query(query, (store_id,))
+
+    async def get_orders(self, statuses=None, since=None, limit=None, before_id=None, store_id=DEFAULT_STORE_ID):
+        """Recupera gli ordini del negozio filtrati per stato e data, paginati per id decrescente (keyset)"""
+        conditions = ["store_id = ?"]
+        params = [store_id]
+        if statuses:
+            conditions.append(f"status IN ({', '.join(['?'] * len(statuses))})")
+            params.extend(statuses)
+        if since is not None:
+            conditions.append("created_at >= ?")
+            params.append(since.strftime('%Y-%m-%d %H:%M:%S') if hasattr(since, 'strftime') else since)
+        if before_id is not None:
+            conditions.append("id < ?")
+            params.append(before_id)
+        query = "SELECT id, order_number, status, total_price, created_at, updated_at FROM orders"
+        query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY +id DESC" if since is not None else " ORDER BY id DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        return await self.execute_query(query, tuple(params))
+
+    async def get_order_by_id(self, order_id, store_id=DEFAULT_STORE_ID):
+        query = """
+            SELECT id, order_number, status, total_price, created_at, updated_at
+            FROM orders WHERE id = ? AND store_id = ?
+        """
+        result = await self.execute_query(query, (order_id, store_id))
+        return result[0] if result else None
+
+    async def get_order_items(self, order_id):
+        query = """
+            SELECT oi.id, oi.product_id, oi.quantity, oi.unit_price, p.name, p.description
+            FROM order_items oi
+            LEFT JOIN products p ON oi.product_id = p.id
+            WHERE oi.order_id = ?
+            ORDER BY oi.id
+        """
+        return await self.execute_query(query, (order_id,))
+
+    async def get_order_items_bulk(self, order_ids):
+        """Recupera gli articoli di più ordini con una sola query, raggruppati per ordine"""
+        items_by_order = {order_id: [] for order_id in order_ids}
+        ids = list(items_by_order)
+        for start in range(0, len(ids), MAX_QUERY_PARAMS):
+            chunk = ids[start:start + MAX_QUERY_PARAMS]
+            query = f"""
+                SELECT oi.order_id, oi.id, oi.product_id, oi.quantity, oi.unit_price, p.name, p.description
+                FROM order_items oi
+                LEFT JOIN products p ON oi.product_id = p.id
+                WHERE oi.order_id IN ({", ".join("?" * len(chunk))})
+                ORDER BY oi.order_id, oi.id
+            """
+            for item in await self.execute_query(query, chunk):
+                items_by_order[item.pop('order_id')].append(item)
+        return items_by_order
@@ -0,0 +1,169 @@
+import asyncio
+import functools
+import os
+import threading
+import time
+import weakref
+import logging
+from contextlib import asynccontextmanager
+from connection_pool import PoolTimeout
+
+logger = logging.getLogger(__name__)
+
+
+class DatabaseLoop:
+    """Event loop dedicato al database, in un thread separato.
+
+    I pool asincroni sono legati al loop in cui sono creati, mentre Flask esegue
+    ogni view `async` in un loop nuovo. Tutte le operazioni del wrapper vengono
+    quindi eseguite su questo loop, che vive quanto il processo: il pool resta
+    aperto tra una richiesta e l'altra e le query di richieste diverse
+    procedono in parallelo senza un thread ciascuna.
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._lock = threading.Lock()
+        if hasattr(os, 'register_at_fork'):
+            reset = weakref.WeakMethod(self._reset)
+            os.register_at_fork(after_in_child=lambda: reset() and reset()())
+
+    def _reset(self):
+        # Il thread del loop non sopravvive alla fork: il figlio ne avvia uno nuovo
+        self._loop = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name='db-loop', daemon=True).start()
+            return self._loop
+
+    async def run(self, coro):
+        """Esegue la coroutine sul loop del database e ne attende il risultato dal loop corrente"""
+        loop = self.loop
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            return await coro
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, loop))
+
+    def run_sync(self, coro):
+        """Esegue la coroutine sul loop del database da codice sincrono e ne ritorna il risultato"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+
+def on_db_loop(method):
+    """Decoratore per i metodi async del wrapper: li esegue sul DatabaseLoop"""
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        return await self.db_loop.run(method(self, *args, **kwargs))
+    return wrapper
+
+
+class AsyncConnectionPool:
+    """Versione asincrona di ConnectionPool: stesse regole di dimensione,
+    health-check al prestito ed eliminazione delle connessioni inattive."""
+
+    def __init__(self, factory, size=5, timeout=10, idle_timeout=300, ping=None, pre_ping=True):
+        self.factory = factory
+        self.size = size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.ping = ping
+        self.pre_ping = pre_ping
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            reset = weakref.WeakMethod(self._reset)
+            os.register_at_fork(after_in_child=lambda: reset() and reset()())
+
+    def _reset(self):
+        # Le connessioni e il semaforo appartengono al loop del processo padre
+        self._idle = []  # lista di (connessione, istante di rilascio), LIFO
+        self._in_use = 0
+        self._semaphore = None
+
+    async def acquire(self):
+        """Prende in prestito una connessione dal pool"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.size)
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            raise PoolTimeout(f"No connection available after {self.timeout}s")
+        self._in_use += 1
+        try:
+            await self._evict_idle()
+            while self._idle:
+                connection, _ = self._idle.pop()
+                if await self._is_healthy(connection):
+                    return connection
+                await self._close(connection)
+            return await self.factory()
+        except BaseException:
+            self._in_use -= 1
+            self._semaphore.release()
+            raise
+
+    async def release(self, connection, discard=False):
+        """Restituisce una connessione al pool (o la chiude se `discard`)"""
+        if discard:
+            await self._close(connection)
+        else:
+            self._idle.append((connection, time.monotonic()))
+        self._in_use -= 1
+        self._semaphore.release()
+
+    @asynccontextmanager
+    async def connection(self):
+        """Contesto che presta una connessione e la restituisce all'uscita"""
+        connection = await self.acquire()
+        discard = False
+        try:
+            yield connection
+        except BaseException:
+            # Dopo un errore la connessione potrebbe avere una transazione aperta
+            discard = True
+            raise
+        finally:
+            await self.release(connection, discard=discard)
+
+    async def close(self):
+        """Chiude tutte le connessioni inattive"""
+        idle, self._idle = self._idle, []
+        for connection, _ in idle:
+            await self._close(connection)
+
+    def stats(self):
+        return {"size": self.size, "in_use": self._in_use, "idle": len(self._idle)}
+
+    async def _evict_idle(self):
+        if not self.idle_timeout:
+            return
+        cutoff = time.monotonic() - self.idle_timeout
+        while self._idle and self._idle[0][1] < cutoff:
+            connection, _ = self._idle.pop(0)
+            await self._close(connection)
+
+    async def _is_healthy(self, connection):
+        if not self.pre_ping or self.ping is None:
+            return True
+        try:
+            await self.ping(connection)
+            return True
+        except Exception as e:
+            logger.warning(f"Discarding broken pooled connection: {e}")
+            return False
+
+    @staticmethod
+    async def _close(connection):
+        try:
+            result = connection.close()
+            if asyncio.iscoroutine(result):
+                await result
+        except Exception:
+            pass
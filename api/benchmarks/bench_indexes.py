@@ -0,0 +1,121 @@
+"""Benchmark degli indici: costo delle query principali prima e dopo le migrazioni.
+
+Uso (dalla cartella api/):
+    python benchmarks/bench_indexes.py [--items 1000000] [--repeat 200]
+
+Crea un database SQLite temporaneo con lo schema completo (tutte le migrazioni),
+toglie gli indici secondari di ordini, articoli e prodotti, lo popola con il
+numero di order_items richiesto e misura le query dei wrapper; poi ricrea gli
+indici e ripete le misure. Lo schema è sempre quello atteso dai wrapper.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database_wrapper_sqlite import DatabaseWrapper  # noqa: E402
+from migrations import apply_migrations  # noqa: E402
+
+ITEMS_PER_ORDER = 5
+STATUSES = ['pending', 'preparing', 'ready', 'completed', 'completed', 'completed', 'cancelled']
+
+
+def seed(db, n_items):
+    """Popola ordini e articoli direttamente con executemany"""
+    n_orders = n_items // ITEMS_PER_ORDER
+    rng = random.Random(42)
+    with db.session():
+        product_ids = [row['id'] for row in db.execute_query("SELECT id FROM products")]
+    
+    def work(cursor):
+        cursor.executemany(
+            "INSERT INTO orders (id, order_number, status, total_price, created_at) VALUES (?, ?, ?, ?, ?)",
+            ((i, i, rng.choice(STATUSES), 20.0,
+              time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(1700000000 + i * 30)))
+             for i in range(1, n_orders + 1))
+        )
+        # Gli articoli vengono inseriti in ordine casuale, come accade con molti totem concorrenti
+        order_ids = list(range(1, n_orders + 1)) * ITEMS_PER_ORDER
+        rng.shuffle(order_ids)
+        cursor.executemany(
+            "INSERT INTO order_items (order_id, product_id, quantity, unit_price) VALUES (?, ?, ?, ?)",
+            ((order_id, rng.choice(product_ids), 1, 4.0) for order_id in order_ids)
+        )
+    db.run_in_transaction(work)
+    return n_orders
+
+
+def drop_indexes(db):
+    """Toglie gli indici secondari (non UNIQUE) delle tabelle misurate e ritorna le loro CREATE INDEX"""
+    with db.session():
+        indexes = db.execute_query(
+            """SELECT name, sql FROM sqlite_master
+               WHERE type = 'index' AND sql IS NOT NULL AND sql NOT LIKE 'CREATE UNIQUE%'
+                 AND tbl_name IN ('orders', 'order_items', 'products')"""
+        )
+        for index in indexes:
+            db.execute_update(f"DROP INDEX {index['name']}")
+    return [index['sql'] for index in indexes]
+
+
+def measure(db, n_orders, repeat):
+    """Ritorna il tempo medio in ms per ciascuna query"""
+    rng = random.Random(7)
+    cases = {
+        'get_order_items': lambda: db.get_order_items(rng.randint(1, n_orders)),
+        'get_order_items_bulk (50 ordini)': lambda: db.get_order_items_bulk(
+            rng.sample(range(1, n_orders + 1), 50)),
+        'get_products_by_category': lambda: db.get_products_by_category(rng.randint(1, 4)),
+        "get_orders(status='pending', limit=50)": lambda: db.get_orders(statuses=['pending'], limit=50),
+        'get_orders(since=ultima ora)': lambda: db.get_orders(
+            since=time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(1700000000 + (n_orders - 120) * 30))),
+        'next order_number (MAX)': lambda: db.execute_query("SELECT MAX(order_number) FROM orders"),
+    }
+    results = {}
+    with db.session():
+        for name, case in cases.items():
+            runs = repeat if 'since' not in name and 'status' not in name else max(repeat // 10, 5)
+            case()  # warm-up
+            start = time.perf_counter()
+            for _ in range(runs):
+                case()
+            results[name] = (time.perf_counter() - start) * 1000 / runs
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--items', type=int, default=1_000_000, help='numero di order_items')
+    parser.add_argument('--repeat', type=int, default=200, help='ripetizioni per query')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DatabaseWrapper(os.path.join(tmp, 'bench.db'))
+        # Le migrazioni cambiano anche lo schema (store_id, product_images...): si applicano
+        # tutte e per la misura "prima" si tolgono solo gli indici
+        apply_migrations(db)
+        indexes = drop_indexes(db)
+        start = time.perf_counter()
+        n_orders = seed(db, args.items)
+        print(f"Seeded {n_orders} orders / {args.items} order_items in {time.perf_counter() - start:.1f}s")
+
+        before = measure(db, n_orders, args.repeat)
+        start = time.perf_counter()
+        with db.session():
+            for statement in indexes:
+                db.execute_update(statement)
+        print(f"Created {len(indexes)} indexes in {time.perf_counter() - start:.1f}s")
+        after = measure(db, n_orders, args.repeat)
+
+    print()
+    print(f"{'query':<42}{'prima (ms)':>12}{'dopo (ms)':>12}{'speedup':>10}")
+    for name in before:
+        print(f"{name:<42}{before[name]:>12.3f}{after[name]:>12.3f}{before[name] / after[name]:>9.0f}x")
+
+
+if __name__ == '__main__':
+    main()
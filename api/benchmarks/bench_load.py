@@ -0,0 +1,278 @@
+"""Benchmark di carico in-process: traffico di totem e dashboard contro app.py.
+
+Uso (dalla cartella api/):
+    python benchmarks/bench_load.py [--orders 100000] [--duration 30] [--output risultati.json]
+
+Popola un database SQLite (per default temporaneo) con prodotti, ordini e
+articoli generati con un seme fisso, poi esegue in parallelo per `--duration`
+secondi:
+- totem: sfogliano il menu (con If-None-Match, come i client reali) e ordinano;
+- raffiche: ogni `--burst-every` secondi `--burst-size` ordini partono insieme;
+- dashboard: ogni `--poll` secondi leggono gli ordini aperti e le vendite del
+  giorno e fanno avanzare un ordine, come la cucina.
+Le richieste passano dal test client di Flask (niente rete): il risultato misura
+app e database, con il generatore di carico sullo stesso processo. L'output è un
+JSON con throughput e latenze p50/p95/p99 per endpoint, più tempo DB e query
+medie lette dall'header Server-Timing.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, API_DIR)
+
+STATUSES = ['completed'] * 18 + ['cancelled']
+OPEN_STATUSES = ['pending', 'preparing', 'ready']
+NEXT_STATUS = {'pending': 'preparing', 'preparing': 'ready', 'ready': 'completed'}
+SERVER_TIMING = re.compile(r'db;dur=([\d.]+);desc="(\d+) queries"')
+
+
+def seed(db, n_products, n_orders, items_per_order, days, rng):
+    """Porta il catalogo a n_products prodotti e inserisce gli ordini degli ultimi `days` giorni"""
+    with db.session():
+        categories = [row['id'] for row in db.execute_query("SELECT id FROM categories")]
+        existing = db.execute_query("SELECT COUNT(*) AS n FROM products")[0]['n']
+
+    def add_products(cursor):
+        cursor.executemany(
+            "INSERT INTO products (name, description, price, category_id) VALUES (?, ?, ?, ?)",
+            ((f"Prodotto {i}", f"Prodotto di prova {i}", round(rng.uniform(1.5, 15), 2), rng.choice(categories))
+             for i in range(existing + 1, n_products + 1))
+        )
+    db.run_in_transaction(add_products)
+    with db.session():
+        prices = {row['id']: row['price'] for row in db.execute_query("SELECT id, price FROM products")}
+    product_ids = list(prices)
+
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    first = now - timedelta(days=days)
+    step = (now - first) / n_orders
+
+    def add_orders(cursor):
+        orders, items = [], []
+        for order_id in range(1, n_orders + 1):
+            lines = [(rng.choice(product_ids), rng.randint(1, 3))
+                     for _ in range(rng.randint(1, 2 * items_per_order - 1))]
+            total = sum(prices[product_id] * quantity for product_id, quantity in lines)
+            # Gli ordini più recenti sono ancora in lavorazione
+            status = rng.choice(OPEN_STATUSES) if order_id > n_orders - 100 else rng.choice(STATUSES)
+            created_at = (first + step * order_id).strftime('%Y-%m-%d %H:%M:%S')
+            orders.append((order_id, order_id, status, round(total, 2), created_at, created_at))
+            items.extend((order_id, product_id, quantity, prices[product_id], created_at)
+                         for product_id, quantity in lines)
+        cursor.executemany(
+            "INSERT INTO orders (id, order_number, status, total_price, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)", orders)
+        cursor.executemany(
+            "INSERT INTO order_items (order_id, product_id, quantity, unit_price, created_at) "
+            "VALUES (?, ?, ?, ?, ?)", items)
+        # Contatore dei numeri ordine e rollup come se gli ordini fossero stati creati dall'API
+        cursor.execute("UPDATE order_counters SET value = ? WHERE name = 'orders:1'", (n_orders,))
+        return len(items)
+    n_items = db.run_in_transaction(add_orders)
+    db.rebuild_analytics()
+    return len(product_ids), n_items
+
+
+class Recorder:
+    """Raccoglie latenze, errori e Server-Timing per endpoint"""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.db_ms = defaultdict(float)
+        self.queries = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def request(self, client, label, method, path, **kwargs):
+        start = time.perf_counter()
+        response = client.open(path, method=method, **kwargs)
+        elapsed = time.perf_counter() - start
+        timing = SERVER_TIMING.search(response.headers.get('Server-Timing', ''))
+        with self._lock:
+            self.latencies[label].append(elapsed)
+            if response.status_code >= 400:
+                self.errors[label] += 1
+            if timing:
+                self.db_ms[label] += float(timing.group(1))
+                self.queries[label] += int(timing.group(2))
+        return response
+
+    def report(self, duration):
+        endpoints = {}
+        for label, latencies in sorted(self.latencies.items()):
+            endpoints[label] = dict(summarize(latencies, duration),
+                                    errors=self.errors[label],
+                                    db_ms_mean=round(self.db_ms[label] / len(latencies), 2),
+                                    queries_mean=round(self.queries[label] / len(latencies), 2))
+        total = [latency for latencies in self.latencies.values() for latency in latencies]
+        return endpoints, dict(summarize(total, duration), errors=sum(self.errors.values()))
+
+
+def summarize(latencies, duration):
+    latencies = sorted(latencies)
+    quantiles = statistics.quantiles(latencies, n=100, method='inclusive') if len(latencies) > 1 else latencies * 99
+    return {
+        "requests": len(latencies),
+        "rps": round(len(latencies) / duration, 1),
+        "p50_ms": round(quantiles[49] * 1000, 2),
+        "p95_ms": round(quantiles[94] * 1000, 2),
+        "p99_ms": round(quantiles[98] * 1000, 2),
+        "max_ms": round(latencies[-1] * 1000, 2),
+    }
+
+
+def order_payload(rng, product_ids):
+    return {"items": [{"product_id": product_id, "quantity": rng.randint(1, 3)}
+                      for product_id in rng.sample(product_ids, rng.randint(1, 4))]}
+
+
+def totem(app, recorder, product_ids, category_ids, deadline, seed):
+    """Un totem: menu (rivalidato con l'ETag), una categoria, un prodotto, poi l'ordine"""
+    rng = random.Random(seed)
+    client = app.test_client()
+    etag = None
+    while time.perf_counter() < deadline:
+        headers = {'If-None-Match': etag} if etag else {}
+        response = recorder.request(client, 'GET /api/menu', 'GET', '/api/menu', headers=headers)
+        etag = response.headers.get('ETag', etag)
+        recorder.request(client, 'GET /api/products/category/<id>', 'GET',
+                         f"/api/products/category/{rng.choice(category_ids)}")
+        recorder.request(client, 'GET /api/products/<id>', 'GET', f"/api/products/{rng.choice(product_ids)}")
+        recorder.request(client, 'POST /api/orders', 'POST', '/api/orders', json=order_payload(rng, product_ids))
+
+
+def burst_worker(app, recorder, product_ids, barrier, stop, seed):
+    """Partecipa a ogni raffica con un ordine"""
+    rng = random.Random(seed)
+    client = app.test_client()
+    while True:
+        barrier.wait()  # partenza
+        if stop.is_set():
+            return
+        recorder.request(client, 'POST /api/orders (burst)', 'POST', '/api/orders',
+                         json=order_payload(rng, product_ids))
+        barrier.wait()  # raffica completata
+
+
+def dashboard(app, recorder, poll, deadline, seed):
+    """Una dashboard: ordini aperti, vendite di oggi e avanzamento di un ordine"""
+    rng = random.Random(seed)
+    client = app.test_client()
+    today = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        response = recorder.request(client, 'GET /api/orders?status=open', 'GET',
+                                    '/api/orders?status=pending,preparing,ready&limit=50')
+        recorder.request(client, 'GET /api/analytics/sales', 'GET',
+                         f"/api/analytics/sales?granularity=hour&from={today}")
+        orders = response.get_json() if response.status_code == 200 else []
+        if orders:
+            order = rng.choice(orders)
+            recorder.request(client, 'PUT /api/orders/<id>/status', 'PUT', f"/api/orders/{order['id']}/status",
+                             json={"status": NEXT_STATUS[order['status']]})
+        time.sleep(max(0.0, poll - (time.perf_counter() - started)))
+
+
+def run(app, args, product_ids, category_ids):
+    recorder = Recorder()
+    started = time.perf_counter()
+    deadline = started + args.duration
+    # Prima i thread che restano in attesa: con i totem già attivi l'avvio dei thread rallenta (GIL)
+    threads = []
+    barrier = threading.Barrier(args.burst_size + 1) if args.burst_size else None
+    stop = threading.Event()
+    if barrier:
+        threads += [threading.Thread(target=burst_worker, args=(app, recorder, product_ids, barrier, stop, 2000 + i))
+                    for i in range(args.burst_size)]
+    threads += [threading.Thread(target=dashboard, args=(app, recorder, args.poll, deadline, 1000 + i))
+                for i in range(args.dashboards)]
+    threads += [threading.Thread(target=totem, args=(app, recorder, product_ids, category_ids, deadline, i))
+                for i in range(args.totems)]
+    for thread in threads:
+        thread.start()
+    if barrier:
+        # Il thread principale fa partire le raffiche e ne attende la fine;
+        # l'ultima partenza, con `stop` impostato, termina i partecipanti
+        while time.perf_counter() + args.burst_every < deadline:
+            time.sleep(args.burst_every)
+            barrier.wait()
+            barrier.wait()
+        stop.set()
+        barrier.wait()
+    for thread in threads:
+        thread.join()
+    # Il throughput usa la durata effettiva: le ultime richieste finiscono dopo la scadenza
+    elapsed = time.perf_counter() - started
+    return elapsed, recorder.report(elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--products', type=int, default=50, help='prodotti nel catalogo')
+    parser.add_argument('--orders', type=int, default=100_000, help='ordini storici')
+    parser.add_argument('--items-per-order', type=int, default=5, help='articoli medi per ordine')
+    parser.add_argument('--days', type=int, default=90, help='giorni coperti dagli ordini storici')
+    parser.add_argument('--db', help='file SQLite da riusare tra le esecuzioni (popolato solo se nuovo)')
+    parser.add_argument('--duration', type=float, default=30, help='durata del carico in secondi')
+    parser.add_argument('--totems', type=int, default=16, help='totem concorrenti')
+    parser.add_argument('--dashboards', type=int, default=4, help='dashboard concorrenti')
+    parser.add_argument('--poll', type=float, default=2, help='intervallo di polling delle dashboard (s)')
+    parser.add_argument('--burst-size', type=int, default=20, help='ordini per raffica (0 = nessuna)')
+    parser.add_argument('--burst-every', type=float, default=5, help='secondi tra le raffiche')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='file JSON dei risultati (default: stdout)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.abspath(args.db or os.path.join(tmp, 'bench.db'))
+        is_new = not os.path.exists(db_file)
+        # app.py apre il database indicato da SQLITE_DB all'import
+        os.environ['SQLITE_DB'] = db_file
+        import app as api_app
+        from migrations import apply_migrations
+
+        # Lo schema (e il catalogo di esempio) viene dalle migrazioni: il seed va fatto dopo
+        apply_migrations(api_app.db)
+        seeded = None
+        if is_new:
+            start = time.perf_counter()
+            n_products, n_items = seed(api_app.db, args.products, args.orders, args.items_per_order,
+                                       args.days, random.Random(args.seed))
+            seeded = {"products": n_products, "orders": args.orders, "order_items": n_items,
+                      "seconds": round(time.perf_counter() - start, 1)}
+            print(f"Seeded {args.orders} orders / {n_items} order_items in {seeded['seconds']}s", file=sys.stderr)
+
+        with api_app.db.session():
+            product_ids = [row['id'] for row in api_app.db.execute_query("SELECT id FROM products")]
+            category_ids = [row['id'] for row in api_app.db.execute_query("SELECT id FROM categories")]
+        app = api_app.create_app()
+        elapsed, (endpoints, total) = run(app, args, product_ids, category_ids)
+
+    result = {
+        "config": {key: value for key, value in vars(args).items() if key not in ('output', 'db')},
+        "seed": seeded,
+        "duration_s": round(elapsed, 2),
+        "total": total,
+        "endpoints": endpoints,
+    }
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
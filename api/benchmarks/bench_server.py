@@ -0,0 +1,73 @@
+"""Benchmark HTTP di un server già avviato: throughput e latenze per alcuni endpoint.
+
+Uso (dalla cartella api/):
+    python benchmarks/bench_server.py --url http://127.0.0.1:5000 [--clients 32] [--duration 10]
+
+Ogni client è un thread con una connessione HTTP keep-alive che ripete le
+richieste in ciclo per la durata indicata.
+"""
+import argparse
+import http.client
+import json
+import statistics
+import threading
+import time
+from urllib.parse import urlparse
+
+PATHS = ['/api/products', '/api/categories', '/api/orders?status=pending&limit=50']
+
+
+def client(host, port, paths, deadline, latencies, errors):
+    connection = http.client.HTTPConnection(host, port, timeout=30)
+    i = 0
+    while time.perf_counter() < deadline:
+        path = paths[i % len(paths)]
+        i += 1
+        start = time.perf_counter()
+        try:
+            connection.request('GET', path)
+            response = connection.getresponse()
+            response.read()
+            if response.status >= 400:
+                errors.append(response.status)
+            latencies.append(time.perf_counter() - start)
+        except (OSError, http.client.HTTPException):
+            errors.append('connection')
+            connection.close()
+            connection = http.client.HTTPConnection(host, port, timeout=30)
+    connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10)
+    args = parser.parse_args()
+
+    url = urlparse(args.url)
+    latencies, errors = [], []
+    deadline = time.perf_counter() + args.duration
+    threads = [
+        threading.Thread(target=client, args=(url.hostname, url.port or 80, PATHS, deadline, latencies, errors))
+        for _ in range(args.clients)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    latencies.sort()
+    quantiles = statistics.quantiles(latencies, n=100, method='inclusive') if len(latencies) > 1 else latencies * 99
+    print(json.dumps({
+        "requests": len(latencies),
+        "errors": len(errors),
+        "rps": round(len(latencies) / args.duration, 1),
+        "p50_ms": round(quantiles[49] * 1000, 2),
+        "p95_ms": round(quantiles[94] * 1000, 2),
+        "p99_ms": round(quantiles[98] * 1000, 2),
+    }))
+
+
+if __name__ == '__main__':
+    main()
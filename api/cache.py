@@ -0,0 +1,112 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Cache LRU thread-safe con scadenza (TTL) e numero massimo di elementi.
+
+    Le chiavi sono tuple il cui primo elemento è il namespace, così un intero
+    gruppo di chiavi può essere invalidato con `invalidate(namespace)`.
+    """
+
+    def __init__(self, maxsize=256, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # Cresce a ogni invalidazione (vedi MenuCache): un valore letto prima non va salvato
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # chiave -> (scadenza, valore)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Ritorna il valore in cache o `default` se assente o scaduto"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, version=None):
+        """Salva un valore, eliminando il meno usato se la cache è piena.
+        Con `version` il valore viene scartato se nel frattempo la cache è stata invalidata."""
+        with self._lock:
+            if version is not None and version != self.version:
+                return
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get_or_load(self, key, loader):
+        """Ritorna il valore in cache, altrimenti lo carica con `loader()` e lo salva.
+        I risultati None non vengono salvati."""
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            # Un loader più lento di una scrittura sul catalogo non deve salvare dati vecchi
+            version = self.version
+            value = loader()
+            if value is not None:
+                self.set(key, value, version)
+        return value
+
+    def invalidate(self, namespace, *key):
+        """Elimina una chiave precisa o, senza `key`, tutto il namespace"""
+        with self._lock:
+            self._discard(namespace, *key)
+
+    def _discard(self, namespace, *key):
+        # Da chiamare con il lock
+        if key:
+            self._data.pop((namespace, *key), None)
+        else:
+            for cached_key in [k for k in self._data if k[0] == namespace]:
+                del self._data[cached_key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """Ritorna dimensione e hit/miss della cache"""
+        with self._lock:
+            return {"size": len(self._data), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+
+class MenuCache(TTLCache):
+    """Cache di categorie e prodotti con le regole di invalidazione del catalogo.
+
+    `version` cresce a ogni scrittura sul catalogo, insieme all'invalidazione (con il
+    lock): chi mantiene dati derivati dal menu (es. lo snapshot serializzato) lo usa per
+    sapere quando ricostruirli e un loader iniziato prima della scrittura non salva il suo
+    risultato.
+    """
+
+    def invalidate_categories(self):
+        # Le liste prodotti contengono il nome della categoria e in MySQL l'eliminazione
+        # di una categoria elimina a cascata i suoi prodotti: svuotiamo tutto il menu
+        with self._lock:
+            self.version += 1
+            self._data.clear()
+
+    def invalidate_products(self, product_id=None):
+        # Senza product_id (es. import massivo) invalida tutti i singoli prodotti
+        namespaces = [('products',), ('products_by_category',), ('price_index',)]
+        namespaces.append(('product',) if product_id is None else ('product', product_id))
+        with self._lock:
+            self.version += 1
+            for key in namespaces:
+                self._discard(*key)
+
+    def invalidate_store(self, store_id):
+        # Le liste del catalogo restano valide: si ricaricano solo gli override del negozio
+        with self._lock:
+            self.version += 1
+            self._discard('store_overrides', store_id)
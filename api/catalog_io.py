@@ -0,0 +1,119 @@
+import csv
+import io
+import json
+from decimal import Decimal, InvalidOperation
+
+# Formati accettati per import/export del catalogo: mimetype -> formato
+FORMATS = {
+    'application/x-ndjson': 'ndjson',
+    'application/jsonl': 'ndjson',
+    'text/csv': 'csv',
+}
+MIMETYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+CATEGORY_FIELDS = ['id', 'name', 'description']
+PRODUCT_FIELDS = ['id', 'name', 'description', 'price', 'image_url', 'category_id', 'category']
+
+
+def read_rows(stream, fmt):
+    """Legge il corpo riga per riga e ritorna (numero riga, dict o None, errore o None)"""
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if fmt == 'csv':
+        reader = csv.DictReader(text)
+        for row in reader:
+            yield reader.line_num, row, None
+        return
+    for line_number, line in enumerate(text, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+            if not isinstance(row, dict):
+                raise ValueError("expected a JSON object")
+            yield line_number, row, None
+        except ValueError as e:
+            yield line_number, None, f"Invalid JSON: {e}"
+
+
+def _text(row, field, max_length, required=False):
+    # Un campo assente resta None: nell'upsert non sovrascrive il valore esistente
+    value = row.get(field)
+    if value is None and not required:
+        return None
+    value = '' if value is None else str(value).strip()
+    if required and not value:
+        raise ValueError(f"Missing required field: {field}")
+    if len(value) > max_length:
+        raise ValueError(f"{field} longer than {max_length} characters")
+    return value
+
+
+def parse_category(row):
+    """Valida una riga di categoria e ritorna (name, description)"""
+    return _text(row, 'name', 100, required=True), _text(row, 'description', 2000)
+
+
+def parse_product(row):
+    """Valida una riga di prodotto; la categoria è indicata da category_id o dal nome in category"""
+    product = {
+        'name': _text(row, 'name', 150, required=True),
+        'description': _text(row, 'description', 2000),
+        'image_url': _text(row, 'image_url', 255),
+    }
+    try:
+        product['price'] = Decimal(str(row.get('price', '')).strip())
+    except InvalidOperation:
+        raise ValueError("price must be a number")
+    if not product['price'].is_finite() or product['price'] < 0:
+        raise ValueError("price must be a non-negative number")
+    category_id = row.get('category_id')
+    if category_id not in (None, ''):
+        try:
+            product['category_id'] = int(category_id)
+        except (TypeError, ValueError):
+            raise ValueError("category_id must be an integer")
+    elif row.get('category'):
+        product['category'] = _text(row, 'category', 100)
+    else:
+        raise ValueError("Missing required field: category_id or category")
+    return product
+
+
+def resolve_categories(products, categories):
+    """Associa ai prodotti l'id della categoria (letta nella transazione di import).
+
+    `products` è una lista di (numero riga, prodotto). Ritorna le tuple
+    (name, description, price, image_url, category_id) da inserire e gli errori
+    per le righe con una categoria inesistente.
+    """
+    ids = {row['id'] for row in categories}
+    by_name = {row['name'].casefold(): row['id'] for row in categories}
+    rows, errors = [], []
+    for line_number, product in products:
+        if 'category_id' in product:
+            category_id = product['category_id'] if product['category_id'] in ids else None
+        else:
+            category_id = by_name.get(product['category'].casefold())
+        if category_id is None:
+            errors.append({"line": line_number, "error": "Unknown category"})
+            continue
+        rows.append((product['name'], product['description'], product['price'], product['image_url'], category_id))
+    return rows, errors
+
+
+def export_lines(rows, fields, fmt, dumps):
+    """Serializza le righe del catalogo una alla volta (NDJSON o CSV con intestazione)"""
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(fields)
+        for row in rows:
+            writer.writerow(['' if row.get(field) is None else row.get(field) for field in fields])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue()
+        return
+    for row in rows:
+        yield dumps({field: row.get(field) for field in fields}) + '\n'
@@ -4,6 +4,9 @@ from dotenv import load_dotenv
 load_dotenv()
 
 class Config:
+    # Database usato dall'app: 'sqlite' (SQLITE_DB) o 'mysql' (DB_NAME su DB_HOST)
+    DB_BACKEND = os.getenv('DB_BACKEND', 'sqlite').lower()
+    
     # MySQL Configuration
     DB_HOST = os.getenv('DB_HOST', 'localhost')
     DB_USER = os.getenv('DB_USER', 'root')
@@ -11,7 +14,93 @@ class Config:
     DB_NAME = os.getenv('DB_NAME', 'hamburgeria')
     DB_PORT = int(os.getenv('DB_PORT', 3306))
     
+    # Connection pool
+    DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 10))
+    DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 10))
+    DB_POOL_IDLE_TIMEOUT = float(os.getenv('DB_POOL_IDLE_TIMEOUT', 300))
+    DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'True') == 'True'
+    
+    # Read replicas (MySQL): elenco "host:porta" separato da virgole
+    DB_REPLICAS = [endpoint for endpoint in os.getenv('DB_REPLICAS', '').split(',') if endpoint.strip()]
+    DB_REPLICA_RETRY = float(os.getenv('DB_REPLICA_RETRY', 30))
+    DB_REPLICA_MAX_LAG = float(os.getenv('DB_REPLICA_MAX_LAG', 5))
+    
+    # SQLite (file, PRAGMA e thread di scrittura)
+    SQLITE_DB = os.getenv('SQLITE_DB', 'hamburgeria.db')
+    SQLITE_JOURNAL_MODE = os.getenv('SQLITE_JOURNAL_MODE', 'WAL')
+    SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+    SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+    SQLITE_CACHE_SIZE = int(os.getenv('SQLITE_CACHE_SIZE', -64000))  # negativo = KiB
+    SQLITE_BUSY_TIMEOUT = int(os.getenv('SQLITE_BUSY_TIMEOUT', 5000))  # millisecondi
+    SQLITE_WRITE_BATCH = int(os.getenv('SQLITE_WRITE_BATCH', 100))
+    
+    # Negozi e shard: "nome=file SQLite (o database MySQL)" e "negozio:shard", separati da virgole.
+    # Lo shard 'default' (SQLITE_DB / DB_NAME) esiste sempre, ospita il catalogo e i negozi non mappati
+    DB_SHARDS = os.getenv('DB_SHARDS', '')
+    STORE_SHARDS = os.getenv('STORE_SHARDS', '')
+    
     # Flask Configuration
     SECRET_KEY = os.getenv('SECRET_KEY', 'dev-secret-key')
     DEBUG = os.getenv('DEBUG', 'False') == 'True'
     JSON_SORT_KEYS = False
+    HOST = os.getenv('HOST', '0.0.0.0')
+    PORT = int(os.getenv('PORT', 5000))
+    
+    # Production server (gunicorn)
+    # Un solo processo: stream SSE, coda della cucina e thread di scrittura SQLite sono per processo.
+    # Si scala con i thread; più worker solo con MySQL e sapendo che gli stream restano per worker
+    WEB_WORKERS = int(os.getenv('WEB_WORKERS', 1))
+    WEB_THREADS = int(os.getenv('WEB_THREADS', 16))
+    WEB_KEEPALIVE = int(os.getenv('WEB_KEEPALIVE', 5))
+    WEB_TIMEOUT = int(os.getenv('WEB_TIMEOUT', 30))
+    WEB_GRACEFUL_TIMEOUT = int(os.getenv('WEB_GRACEFUL_TIMEOUT', 30))
+    WEB_MAX_REQUESTS = int(os.getenv('WEB_MAX_REQUESTS', 0))
+    
+    # Menu cache
+    MENU_CACHE_TTL = float(os.getenv('MENU_CACHE_TTL', 300))
+    MENU_CACHE_SIZE = int(os.getenv('MENU_CACHE_SIZE', 256))
+    MENU_SNAPSHOT_GZIP = os.getenv('MENU_SNAPSHOT_GZIP', 'True') == 'True'
+    
+    # Ricerca prodotti: secondi tra due ricostruzioni dell'indice (per vedere gli altri worker)
+    SEARCH_INDEX_RESYNC = float(os.getenv('SEARCH_INDEX_RESYNC', 300))
+    SEARCH_MAX_LIMIT = int(os.getenv('SEARCH_MAX_LIMIT', 50))
+    
+    # Orders listing
+    ORDERS_MAX_LIMIT = int(os.getenv('ORDERS_MAX_LIMIT', 500))
+    ORDERS_EXPORT_BATCH = int(os.getenv('ORDERS_EXPORT_BATCH', 1000))
+    
+    # Idempotency-Key di POST /api/orders: validità della chiave e risposte tenute in memoria
+    IDEMPOTENCY_TTL = float(os.getenv('IDEMPOTENCY_TTL', 86400))
+    IDEMPOTENCY_CACHE_SIZE = int(os.getenv('IDEMPOTENCY_CACHE_SIZE', 10000))
+    
+    # Outbox degli ordini: POST /api/orders risponde 202 dopo la scrittura nel file locale,
+    # gli ordini arrivano al database a blocchi (retry in secondi, con backoff esponenziale)
+    ORDER_OUTBOX = os.getenv('ORDER_OUTBOX', 'False') == 'True'
+    ORDER_OUTBOX_DB = os.getenv('ORDER_OUTBOX_DB', 'outbox.db')
+    ORDER_OUTBOX_BATCH = int(os.getenv('ORDER_OUTBOX_BATCH', 50))
+    ORDER_OUTBOX_RETRY = float(os.getenv('ORDER_OUTBOX_RETRY', 1))
+    ORDER_OUTBOX_RETRY_MAX = float(os.getenv('ORDER_OUTBOX_RETRY_MAX', 60))
+    ORDER_OUTBOX_RETENTION = float(os.getenv('ORDER_OUTBOX_RETENTION', 86400))
+    ORDER_OUTBOX_FAILED_RETENTION = float(os.getenv('ORDER_OUTBOX_FAILED_RETENTION', 604800))
+    # Età massima di un ordine da consegnare: deve restare sotto IDEMPOTENCY_TTL
+    ORDER_OUTBOX_MAX_AGE = float(os.getenv('ORDER_OUTBOX_MAX_AGE', 43200))
+    
+    # Coda della cucina: secondi tra due ricariche dal database (per vedere gli altri worker)
+    KITCHEN_QUEUE_RESYNC = float(os.getenv('KITCHEN_QUEUE_RESYNC', 5))
+    
+    # Import del catalogo
+    CATALOG_IMPORT_MAX_ROWS = int(os.getenv('CATALOG_IMPORT_MAX_ROWS', 10000))
+    
+    # Immagini dei prodotti: cartella dei file, URL pubblico, thread per le varianti, dimensione massima
+    IMAGES_DIR = os.getenv('IMAGES_DIR', 'images')
+    IMAGES_BASE_URL = os.getenv('IMAGES_BASE_URL', '/api/images').rstrip('/')
+    IMAGES_WORKERS = int(os.getenv('IMAGES_WORKERS', 2))
+    IMAGES_MAX_BYTES = int(os.getenv('IMAGES_MAX_BYTES', 10 * 1024 * 1024))
+    
+    # Strumentazione: soglia (ms) oltre cui una query viene registrata nel log, 0 = disattivata
+    SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', 200))
+    SERVER_TIMING = os.getenv('SERVER_TIMING', 'True') == 'True'
+    
+    # Order events streaming (SSE)
+    EVENTS_BUFFER_SIZE = int(os.getenv('EVENTS_BUFFER_SIZE', 100))
+    SSE_KEEPALIVE = float(os.getenv('SSE_KEEPALIVE', 15))
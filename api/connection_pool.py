@@ -0,0 +1,130 @@
+import os
+import threading
+import time
+import weakref
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+    """Nessuna connessione disponibile entro il timeout"""
+
+
+class ConnectionPool:
+    """Pool di connessioni thread-safe, indipendente dal driver.
+
+    `factory` crea una nuova connessione, `ping` verifica che una connessione
+    prestata sia ancora valida (deve sollevare un'eccezione se non lo è).
+    Le connessioni inattive da più di `idle_timeout` secondi vengono chiuse.
+    Il pool è fork-safe: in un processo figlio (es. worker gunicorn) le connessioni
+    ereditate dal padre vengono abbandonate e ne vengono aperte di nuove.
+    """
+
+    def __init__(self, factory, size=5, timeout=10, idle_timeout=300, ping=None, pre_ping=True):
+        self.factory = factory
+        self.size = size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.ping = ping
+        self.pre_ping = pre_ping
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            reset = weakref.WeakMethod(self._reset)
+            os.register_at_fork(after_in_child=lambda: reset() and reset()())
+
+    def _reset(self):
+        # Dopo una fork socket e file ereditati dal padre non vanno né usati né chiusi
+        # (chiuderli interromperebbe le connessioni del padre): li abbandoniamo
+        self._idle = []  # lista di (connessione, istante di rilascio), LIFO
+        self._in_use = 0
+        self._lock = threading.Condition(threading.Lock())
+
+    def acquire(self):
+        """Prende in prestito una connessione dal pool"""
+        deadline = time.monotonic() + self.timeout
+        expired = []
+        try:
+            with self._lock:
+                while True:
+                    expired.extend(self._evict_idle())
+                    if self._idle:
+                        connection, _ = self._idle.pop()
+                        self._in_use += 1
+                        break
+                    if self._in_use < self.size:
+                        connection = None
+                        self._in_use += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolTimeout(f"No connection available after {self.timeout}s")
+                    self._lock.wait(remaining)
+        finally:
+            # Una chiusura lenta (es. rete verso MySQL) non deve bloccare le altre acquire
+            for stale in expired:
+                self._close(stale)
+
+        # Creazione e health-check avvengono fuori dal lock
+        try:
+            if connection is not None and not self._is_healthy(connection):
+                self._close(connection)
+                connection = None
+            if connection is None:
+                connection = self.factory()
+            return connection
+        except Exception:
+            with self._lock:
+                self._in_use -= 1
+                self._lock.notify()
+            raise
+
+    def release(self, connection, discard=False):
+        """Restituisce una connessione al pool (o la chiude se `discard`)"""
+        if discard:
+            self._close(connection)
+        with self._lock:
+            self._in_use -= 1
+            if not discard:
+                self._idle.append((connection, time.monotonic()))
+            self._lock.notify()
+
+    def close(self):
+        """Chiude tutte le connessioni inattive"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection, _ in idle:
+            self._close(connection)
+
+    def stats(self):
+        """Ritorna lo stato di utilizzo del pool"""
+        with self._lock:
+            return {"size": self.size, "in_use": self._in_use, "idle": len(self._idle)}
+
+    def _evict_idle(self):
+        """Toglie dal pool le connessioni inattive da troppo tempo e le ritorna (da chiudere fuori dal lock)"""
+        # Le connessioni più vecchie sono in testa alla lista
+        if not self.idle_timeout:
+            return []
+        cutoff = time.monotonic() - self.idle_timeout
+        expired = []
+        while self._idle and self._idle[0][1] < cutoff:
+            expired.append(self._idle.pop(0)[0])
+        return expired
+
+    def _is_healthy(self, connection):
+        if not self.pre_ping or self.ping is None:
+            return True
+        try:
+            self.ping(connection)
+            return True
+        except Exception as e:
+            logger.warning(f"Discarding broken pooled connection: {e}")
+            return False
+
+    @staticmethod
+    def _close(connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
@@ -1,44 +1,191 @@
+import threading
+from contextlib import contextmanager
 import pymysql
 from config import Config
+from metrics import timed_query
+from connection_pool import ConnectionPool
+from replicas import ReplicaSet, parse_endpoint, primary_hold
+from cache import MenuCache
+from pricing import build_price_index
+from catalog_io import resolve_categories
+from analytics import apply_rollups, rebuild_statements, status_change_sign
+from idempotency import IdempotencyKeyMismatch
+from order_status import InvalidStatusTransition, check_transition, normalize_status
+from stores import DEFAULT_STORE_ID
+from encoding import Rows
+from images import ORIGINAL, attach_images
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Immagini dei prodotti, aggiunte alle letture del catalogo come URL per variante
+PRODUCT_IMAGES_QUERY = "SELECT product_id, variant, file FROM product_images"
+
+# Colonne degli articoli restituite da get_order_items_rows
+ORDER_ITEM_COLUMNS = ('id', 'product_id', 'quantity', 'unit_price', 'name', 'description')
+
+# Errori del dominio sollevati dentro le transazioni: arrivano alle route senza log di errore
+DOMAIN_ERRORS = (InvalidStatusTransition, IdempotencyKeyMismatch)
+
 class DatabaseWrapper:
-    """Wrapper per tutte le operazioni database"""
+    """Wrapper per tutte le operazioni database (un database MySQL per shard di negozi)"""
     
-    def __init__(self):
-        self.connection = None
-        self.cursor = None
+    dialect = 'mysql'
     
-    def connect(self):
-        """Connette al database MySQL"""
+    def __init__(self, database=None):
+        self.database = database or Config.DB_NAME
+        self.pool = ConnectionPool(
+            self._create_connection,
+            size=Config.DB_POOL_SIZE,
+            timeout=Config.DB_POOL_TIMEOUT,
+            idle_timeout=Config.DB_POOL_IDLE_TIMEOUT,
+            ping=lambda connection: connection.ping(reconnect=False),
+            pre_ping=Config.DB_POOL_PRE_PING
+        )
+        # Repliche di sola lettura: execute_query le usa quando possibile, le scritture vanno al primario
+        self.replicas = ReplicaSet(
+            [parse_endpoint(endpoint, Config.DB_PORT) for endpoint in Config.DB_REPLICAS],
+            self._create_connection,
+            retry_after=Config.DB_REPLICA_RETRY,
+            size=Config.DB_POOL_SIZE,
+            timeout=Config.DB_POOL_TIMEOUT,
+            idle_timeout=Config.DB_POOL_IDLE_TIMEOUT,
+            ping=lambda connection: connection.ping(reconnect=False),
+            pre_ping=Config.DB_POOL_PRE_PING
+        )
+        # Dopo una modifica al catalogo le letture restano sul primario finché le repliche
+        # non si sono allineate, così la cache del menu non si ricarica con dati vecchi
+        self.primary_hold = primary_hold(self.database)
+        # Connessione e cursore sono per-thread: ogni richiesta usa i propri
+        self._local = threading.local()
+        # Cache in memoria delle letture del menu, invalidata dalle scritture sul catalogo
+        self.menu_cache = MenuCache(maxsize=Config.MENU_CACHE_SIZE, ttl=Config.MENU_CACHE_TTL)
+    
+    @property
+    def connection(self):
+        return getattr(self._local, 'connection', None)
+    
+    @property
+    def cursor(self):
+        # Dentro una session() la connessione viene presa dal pool al primo utilizzo
+        if getattr(self._local, 'cursor', None) is None and getattr(self._local, 'depth', 0):
+            self.connect()
+        return getattr(self._local, 'cursor', None)
+    
+    def _create_connection(self, host=None, port=None):
+        """Apre una nuova connessione MySQL al primario o a una replica (usata dai pool)"""
         try:
-            self.connection = pymysql.connect(
-                host=Config.DB_HOST,
+            connection = pymysql.connect(
+                host=host or Config.DB_HOST,
                 user=Config.DB_USER,
                 password=Config.DB_PASSWORD,
-                database=Config.DB_NAME,
-                port=Config.DB_PORT,
+                database=self.database,
+                port=port or Config.DB_PORT,
                 charset='utf8mb4',
                 cursorclass=pymysql.cursors.DictCursor
             )
-            self.cursor = self.connection.cursor()
             logger.info("Connected to database successfully")
+            return connection
         except pymysql.Error as e:
             logger.error(f"Database connection error: {e}")
             raise
     
+    def connect(self):
+        """Prende una connessione dal pool per il thread corrente"""
+        if getattr(self._local, 'connection', None) is not None:
+            return
+        self._local.connection = self.pool.acquire()
+        self._local.cursor = self._local.connection.cursor()
+    
     def disconnect(self):
-        """Chiude la connessione al database"""
-        if self.cursor:
-            self.cursor.close()
-        if self.connection:
-            self.connection.close()
-        logger.info("Disconnected from database")
+        """Restituisce le connessioni del thread corrente ai rispettivi pool"""
+        connection = getattr(self._local, 'connection', None)
+        cursor = getattr(self._local, 'cursor', None)
+        self._local.connection = None
+        self._local.cursor = None
+        self._local.wrote = False
+        self._release_replica()
+        if connection is not None:
+            self.pool.release(connection, discard=not self._reset_connection(connection, cursor))
+    
+    @staticmethod
+    def _reset_connection(connection, cursor):
+        """Prepara una connessione alla restituzione: False se va scartata"""
+        try:
+            if cursor:
+                cursor.close()
+            # Non lasciamo transazioni aperte su una connessione condivisa
+            connection.rollback()
+            return True
+        except pymysql.Error as e:
+            logger.warning(f"Discarding connection on release: {e}")
+            return False
+    
+    def _replica_cursor(self):
+        """Cursore su una replica per le letture della sessione corrente, o None se si legge dal primario"""
+        if not self.replicas or not getattr(self._local, 'depth', 0):
+            return None
+        # Read-your-writes: dopo una scrittura la sessione legge solo dal primario
+        if getattr(self._local, 'wrote', False) or self.primary_hold.active:
+            return None
+        if getattr(self._local, 'replica_cursor', None) is None:
+            replica = self.replicas.choose()
+            if replica is None:
+                return None
+            try:
+                connection = replica.pool.acquire()
+            except Exception as e:
+                self.replicas.mark_down(replica, e)
+                return None
+            # La sessione resta sulla stessa replica: letture successive vedono lo stesso stato
+            self._local.replica = replica
+            self._local.replica_connection = connection
+            self._local.replica_cursor = connection.cursor()
+        return self._local.replica_cursor
     
+    def _release_replica(self, error=None):
+        """Restituisce la connessione alla replica; con `error` la replica viene esclusa"""
+        replica = getattr(self._local, 'replica', None)
+        if replica is None:
+            return
+        connection, cursor = self._local.replica_connection, self._local.replica_cursor
+        self._local.replica = self._local.replica_connection = self._local.replica_cursor = None
+        if error is not None:
+            self.replicas.mark_down(replica, error)
+            replica.pool.release(connection, discard=True)
+        else:
+            replica.pool.release(connection, discard=not self._reset_connection(connection, cursor))
+    
+    def _mark_write(self):
+        self._local.wrote = True
+    
+    def _hold_reads_on_primary(self):
+        """Dopo una modifica al catalogo legge dal primario per DB_REPLICA_MAX_LAG secondi"""
+        if self.replicas:
+            self.primary_hold.hold(Config.DB_REPLICA_MAX_LAG)
+    
+    @contextmanager
+    def session(self):
+        """Contesto per-richiesta: la connessione viene restituita al pool all'uscita"""
+        self._local.depth = getattr(self._local, 'depth', 0) + 1
+        try:
+            yield self
+        finally:
+            self._local.depth -= 1
+            if not self._local.depth:
+                self.disconnect()
+    
+    @timed_query
     def execute_query(self, query, params=None):
-        """Esegue una query e ritorna i risultati"""
+        """Esegue una query (su una replica se disponibile) e ritorna i risultati"""
+        cursor = self._replica_cursor()
+        if cursor is not None:
+            try:
+                cursor.execute(query, params)
+                return cursor.fetchall()
+            except pymysql.OperationalError as e:
+                # Replica non raggiungibile: la escludiamo e ripieghiamo sul primario
+                self._release_replica(error=e)
         try:
             if params:
                 self.cursor.execute(query, params)
@@ -49,8 +196,32 @@ class DatabaseWrapper:
             logger.error(f"Query execution error: {e}")
             raise
     
+    @timed_query
+    def execute_rows(self, query, params=None):
+        """Come execute_query, ma ritorna Rows (nomi delle colonne e tuple) senza creare un dict per riga"""
+        if self._replica_cursor() is not None:
+            try:
+                return self._fetch_rows(self._local.replica_connection, query, params)
+            except pymysql.OperationalError as e:
+                self._release_replica(error=e)
+        try:
+            self.connect()
+            return self._fetch_rows(self.connection, query, params)
+        except pymysql.Error as e:
+            logger.error(f"Query execution error: {e}")
+            raise
+    
+    @staticmethod
+    def _fetch_rows(connection, query, params):
+        # Cursore semplice (tuple) invece del DictCursor della connessione
+        with connection.cursor(pymysql.cursors.Cursor) as cursor:
+            cursor.execute(query, params)
+            return Rows([column[0] for column in cursor.description], list(cursor.fetchall()))
+    
+    @timed_query
     def execute_update(self, query, params=None):
         """Esegue un INSERT/UPDATE/DELETE e committa"""
+        self._mark_write()
         try:
             if params:
                 self.cursor.execute(query, params)
@@ -63,8 +234,10 @@ class DatabaseWrapper:
             logger.error(f"Update execution error: {e}")
             raise
     
+    @timed_query
     def execute_insert(self, query, params=None):
         """Esegue un INSERT e ritorna l'ID del nuovo record"""
+        self._mark_write()
         try:
             if params:
                 self.cursor.execute(query, params)
@@ -77,11 +250,30 @@ class DatabaseWrapper:
             logger.error(f"Insert execution error: {e}")
             raise
     
+    @timed_query
+    def run_in_transaction(self, work):
+        """Esegue work(cursor) in un'unica transazione: commit alla fine, rollback in caso di errore"""
+        self._mark_write()
+        cursor = self.cursor
+        try:
+            self.connection.begin()
+            result = work(cursor)
+            self.connection.commit()
+            return result
+        except DOMAIN_ERRORS:
+            # Errori previsti (gestiti dalle route con 409/422): nessun log di errore
+            self.connection.rollback()
+            raise
+        except Exception as e:
+            self.connection.rollback()
+            logger.error(f"Transaction error: {e}")
+            raise
+    
     # === CATEGORIE ===
     def get_all_categories(self):
         """Recupera tutte le categorie"""
         query = "SELECT id, name, description FROM categories ORDER BY name"
-        return self.execute_query(query)
+        return self.menu_cache.get_or_load(('categories',), lambda: self.execute_query(query))
     
     def get_category_by_id(self, category_id):
         """Recupera una categoria per ID"""
@@ -92,17 +284,26 @@ class DatabaseWrapper:
     def create_category(self, name, description=""):
         """Crea una nuova categoria"""
         query = "INSERT INTO categories (name, description) VALUES (%s, %s)"
-        return self.execute_insert(query, (name, description))
+        category_id = self.execute_insert(query, (name, description))
+        self.menu_cache.invalidate_categories()
+        self._hold_reads_on_primary()
+        return category_id
     
     def update_category(self, category_id, name, description):
         """Aggiorna una categoria"""
         query = "UPDATE categories SET name = %s, description = %s WHERE id = %s"
-        return self.execute_update(query, (name, description, category_id))
+        result = self.execute_update(query, (name, description, category_id))
+        self.menu_cache.invalidate_categories()
+        self._hold_reads_on_primary()
+        return result
     
     def delete_category(self, category_id):
         """Elimina una categoria"""
         query = "DELETE FROM categories WHERE id = %s"
-        return self.execute_update(query, (category_id,))
+        result = self.execute_update(query, (category_id,))
+        self.menu_cache.invalidate_categories()
+        self._hold_reads_on_primary()
+        return result
     
     # === PRODOTTI ===
     def get_all_products(self):
@@ -113,7 +314,10 @@ class DatabaseWrapper:
             LEFT JOIN categories c ON p.category_id = c.id
             ORDER BY c.name, p.name
         """
-        return self.execute_query(query)
+        return self.menu_cache.get_or_load(
+            ('products',),
+            lambda: attach_images(self.execute_query(query), self.execute_query(PRODUCT_IMAGES_QUERY), Config.IMAGES_BASE_URL)
+        )
     
     def get_products_by_category(self, category_id):
         """Recupera i prodotti di una categoria specifica"""
@@ -123,13 +327,34 @@ class DatabaseWrapper:
             WHERE category_id = %s
             ORDER BY name
         """
-        return self.execute_query(query, (category_id,))
+        images_query = PRODUCT_IMAGES_QUERY + " WHERE product_id IN (SELECT id FROM products WHERE category_id = %s)"
+        return self.menu_cache.get_or_load(
+            ('products_by_category', category_id),
+            lambda: attach_images(
+                self.execute_query(query, (category_id,)),
+                self.execute_query(images_query, (category_id,)),
+                Config.IMAGES_BASE_URL
+            )
+        )
     
     def get_product_by_id(self, product_id):
         """Recupera un prodotto per ID"""
         query = "SELECT id, name, description, price, image_url, category_id FROM products WHERE id = %s"
-        result = self.execute_query(query, (product_id,))
-        return result[0] if result else None
+        
+        def load():
+            result = self.execute_query(query, (product_id,))
+            if not result:
+                return None
+            images = self.execute_query(PRODUCT_IMAGES_QUERY + " WHERE product_id = %s", (product_id,))
+            return attach_images(result, images, Config.IMAGES_BASE_URL)[0]
+        return self.menu_cache.get_or_load(('product', product_id), load)
+    
+    def get_price_index(self):
+        """Recupera il listino {product_id: prezzo} usato per prezzare gli ordini"""
+        return self.menu_cache.get_or_load(
+            ('price_index',),
+            lambda: build_price_index(self.execute_query("SELECT id, price FROM products"))
+        )
     
     def create_product(self, name, description, price, category_id, image_url=""):
         """Crea un nuovo prodotto"""
@@ -137,7 +362,10 @@ class DatabaseWrapper:
             INSERT INTO products (name, description, price, category_id, image_url)
             VALUES (%s, %s, %s, %s, %s)
         """
-        return self.execute_insert(query, (name, description, price, category_id, image_url))
+        product_id = self.execute_insert(query, (name, description, price, category_id, image_url))
+        self.menu_cache.invalidate_products(product_id)
+        self._hold_reads_on_primary()
+        return product_id
     
     def update_product(self, product_id, name, description, price, category_id, image_url):
         """Aggiorna un prodotto"""
@@ -146,27 +374,215 @@ class DatabaseWrapper:
             SET name = %s, description = %s, price = %s, category_id = %s, image_url = %s
             WHERE id = %s
         """
-        return self.execute_update(query, (name, description, price, category_id, image_url, product_id))
+        result = self.execute_update(query, (name, description, price, category_id, image_url, product_id))
+        self.menu_cache.invalidate_products(product_id)
+        self._hold_reads_on_primary()
+        return result
     
     def delete_product(self, product_id):
         """Elimina un prodotto"""
         query = "DELETE FROM products WHERE id = %s"
-        return self.execute_update(query, (product_id,))
+        result = self.execute_update(query, (product_id,))
+        self.menu_cache.invalidate_products(product_id)
+        self._hold_reads_on_primary()
+        return result
+    
+    # === IMMAGINI DEI PRODOTTI ===
+    def get_product_originals(self):
+        """Immagine originale di ogni prodotto: {product_id: file}"""
+        rows = self.execute_query("SELECT product_id, file FROM product_images WHERE variant = %s", (ORIGINAL,))
+        return {row['product_id']: row['file'] for row in rows}
+    
+    def set_product_image(self, product_id, original):
+        """Nuova immagine originale del prodotto: le varianti della precedente vengono rimosse"""
+        def work(cursor):
+            cursor.execute("DELETE FROM product_images WHERE product_id = %s", (product_id,))
+            cursor.execute("INSERT INTO product_images (product_id, variant, file) VALUES (%s, %s, %s)",
+                           (product_id, ORIGINAL, original))
+        self.run_in_transaction(work)
+        self.menu_cache.invalidate_products(product_id)
+        self._hold_reads_on_primary()
+    
+    def set_product_variants(self, product_id, original, variants):
+        """Salva le varianti {variante: (file, larghezza, altezza)} generate da `original`.
+        Ritorna False se nel frattempo il prodotto ha cambiato immagine."""
+        def work(cursor):
+            cursor.execute("SELECT file FROM product_images WHERE product_id = %s AND variant = %s", (product_id, ORIGINAL))
+            row = cursor.fetchone()
+            if row is None or row['file'] != original:
+                return False
+            cursor.execute("DELETE FROM product_images WHERE product_id = %s AND variant <> %s", (product_id, ORIGINAL))
+            cursor.executemany(
+                "INSERT INTO product_images (product_id, variant, file, width, height) VALUES (%s, %s, %s, %s, %s)",
+                [(product_id, variant, name, width, height) for variant, (name, width, height) in variants.items()]
+            )
+            return True
+        updated = self.run_in_transaction(work)
+        if updated:
+            self.menu_cache.invalidate_products(product_id)
+            self._hold_reads_on_primary()
+        return updated
+    
+    def delete_product_image(self, product_id):
+        """Rimuove l'immagine del prodotto e le sue varianti"""
+        result = self.execute_update("DELETE FROM product_images WHERE product_id = %s", (product_id,))
+        self.menu_cache.invalidate_products(product_id)
+        self._hold_reads_on_primary()
+        return result
+    
+    # === IMPORT/EXPORT CATALOGO ===
+    def import_categories(self, categories):
+        """Inserisce o aggiorna (per nome) le categorie in un'unica transazione"""
+        def work(cursor):
+            cursor.executemany("""
+                INSERT INTO categories (name, description) VALUES (%s, %s)
+                ON DUPLICATE KEY UPDATE description = COALESCE(VALUES(description), description)
+            """, categories)
+            return len(categories)
+        
+        count = self.run_in_transaction(work) if categories else 0
+        self.menu_cache.invalidate_categories()
+        self._hold_reads_on_primary()
+        return count
+    
+    def import_products(self, products):
+        """Inserisce o aggiorna (per nome e categoria) i prodotti in un'unica transazione.
+        Ritorna il numero di prodotti importati e gli errori delle righe scartate"""
+        def work(cursor):
+            # Le categorie sono lette nella stessa transazione delle scritture
+            cursor.execute("SELECT id, name FROM categories")
+            rows, errors = resolve_categories(products, cursor.fetchall())
+            if rows:
+                cursor.executemany("""
+                INSERT INTO products (name, description, price, image_url, category_id)
+                VALUES (%s, %s, %s, %s, %s)
+                ON DUPLICATE KEY UPDATE
+                    description = COALESCE(VALUES(description), description), price = VALUES(price),
+                    image_url = COALESCE(VALUES(image_url), image_url)
+            """, rows)
+            return len(rows), errors
+        
+        result = self.run_in_transaction(work)
+        self.menu_cache.invalidate_products()
+        self._hold_reads_on_primary()
+        return result
+    
+    def export_categories(self):
+        """Recupera tutte le categorie per l'export"""
+        return self.execute_query("SELECT id, name, description FROM categories ORDER BY id")
+    
+    def export_products(self):
+        """Recupera tutti i prodotti con il nome della categoria per l'export"""
+        query = """
+            SELECT p.id, p.name, p.description, p.price, p.image_url, p.category_id, c.name as category
+            FROM products p
+            LEFT JOIN categories c ON p.category_id = c.id
+            ORDER BY p.id
+        """
+        return self.execute_query(query)
+    
+    def replace_catalog(self, categories, products):
+        """Allinea categorie e prodotti (con i loro id) a quelli dello shard master"""
+        def work(cursor):
+            # Prima le eliminazioni, così un nome riusato da un nuovo id non va in conflitto.
+            # I prodotti ancora negli ordini dello shard restano (la foreign key lo impedisce)
+            product_ids = [product['id'] for product in products]
+            query = "DELETE FROM products WHERE id NOT IN (SELECT product_id FROM order_items)"
+            if product_ids:
+                query += f" AND id NOT IN ({', '.join(['%s'] * len(product_ids))})"
+            cursor.execute(query, product_ids)
+            category_ids = [category['id'] for category in categories]
+            query = "DELETE FROM categories WHERE id NOT IN (SELECT category_id FROM products)"
+            if category_ids:
+                query += f" AND id NOT IN ({', '.join(['%s'] * len(category_ids))})"
+            cursor.execute(query, category_ids)
+            if categories:
+                cursor.executemany("""
+                    INSERT INTO categories (id, name, description) VALUES (%s, %s, %s)
+                    ON DUPLICATE KEY UPDATE name = VALUES(name), description = VALUES(description)
+                """, [(c['id'], c['name'], c['description']) for c in categories])
+            if products:
+                cursor.executemany("""
+                    INSERT INTO products (id, name, description, price, image_url, category_id)
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                    ON DUPLICATE KEY UPDATE name = VALUES(name), description = VALUES(description),
+                        price = VALUES(price), image_url = VALUES(image_url), category_id = VALUES(category_id)
+                """, [(p['id'], p['name'], p['description'], p['price'], p['image_url'], p['category_id'])
+                      for p in products])
+        
+        self.run_in_transaction(work)
+        self.menu_cache.invalidate_categories()
+        self._hold_reads_on_primary()
+    
+    # === PREZZI PER NEGOZIO ===
+    def get_store_overrides(self, store_id):
+        """Prezzi e disponibilità personalizzati del negozio: {product_id: {price, available}}"""
+        query = "SELECT product_id, price, available FROM store_products WHERE store_id = %s"
+        return self.menu_cache.get_or_load(
+            ('store_overrides', store_id),
+            lambda: {row['product_id']: {"price": row['price'], "available": bool(row['available'])}
+                     for row in self.execute_query(query, (store_id,))}
+        )
+    
+    def set_store_override(self, store_id, product_id, price=None, available=True):
+        """Imposta prezzo (None = quello del catalogo) e disponibilità di un prodotto nel negozio"""
+        query = """
+            INSERT INTO store_products (store_id, product_id, price, available) VALUES (%s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE price = VALUES(price), available = VALUES(available)
+        """
+        result = self.execute_update(query, (store_id, product_id, price, available))
+        self.menu_cache.invalidate_store(store_id)
+        self._hold_reads_on_primary()
+        return result
+    
+    def delete_store_override(self, store_id, product_id):
+        """Riporta il prodotto al prezzo e alla disponibilità del catalogo"""
+        query = "DELETE FROM store_products WHERE store_id = %s AND product_id = %s"
+        result = self.execute_update(query, (store_id, product_id))
+        self.menu_cache.invalidate_store(store_id)
+        self._hold_reads_on_primary()
+        return result
     
     # === ORDINI ===
-    def get_all_orders(self):
-        """Recupera tutti gli ordini"""
+    def get_all_orders(self, store_id=DEFAULT_STORE_ID, rows=False):
+        """Recupera tutti gli ordini del negozio (con rows=True come Rows)"""
         query = """
             SELECT id, order_number, status, total_price, created_at, updated_at
             FROM orders
+            WHERE store_id = %s
             ORDER BY created_at DESC
         """
-        return self.execute_query(query)
+        return (self.execute_rows if rows else self.execute_query)(query, (store_id,))
+    
+    def get_orders(self, statuses=None, since=None, limit=None, before_id=None, store_id=DEFAULT_STORE_ID, rows=False):
+        """Recupera gli ordini del negozio filtrati per stato e data, paginati per id decrescente (keyset).
+        Con rows=True ritorna Rows (tuple) invece di una lista di dict."""
+        conditions = ["store_id = %s"]
+        params = [store_id]
+        if statuses:
+            conditions.append(f"status IN ({', '.join(['%s'] * len(statuses))})")
+            params.extend(statuses)
+        if since is not None:
+            conditions.append("created_at >= %s")
+            params.append(since)
+        if before_id is not None:
+            conditions.append("id < %s")
+            params.append(before_id)
+        query = "SELECT id, order_number, status, total_price, created_at, updated_at FROM orders"
+        query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY id DESC"
+        if limit is not None:
+            query += " LIMIT %s"
+            params.append(limit)
+        return (self.execute_rows if rows else self.execute_query)(query, tuple(params))
     
-    def get_order_by_id(self, order_id):
-        """Recupera un ordine per ID"""
-        query = "SELECT id, order_number, status, total_price, created_at, updated_at FROM orders WHERE id = %s"
-        result = self.execute_query(query, (order_id,))
+    def get_order_by_id(self, order_id, store_id=DEFAULT_STORE_ID):
+        """Recupera un ordine del negozio per ID"""
+        query = """
+            SELECT id, order_number, status, total_price, created_at, updated_at
+            FROM orders WHERE id = %s AND store_id = %s
+        """
+        result = self.execute_query(query, (order_id, store_id))
         return result[0] if result else None
     
     def get_order_items(self, order_id):
@@ -180,49 +596,261 @@ class DatabaseWrapper:
         """
         return self.execute_query(query, (order_id,))
     
-    def create_order(self, total_price, items):
-        """Crea un nuovo ordine con gli articoli"""
-        try:
-            # Generiamo il numero ordine
-            query_order_num = "SELECT COALESCE(MAX(order_number), 0) + 1 as next_number FROM orders"
-            result = self.execute_query(query_order_num)
-            order_number = result[0]['next_number'] if result else 1
-            
-            # Creiamo l'ordine
-            query_order = """
-                INSERT INTO orders (order_number, status, total_price)
-                VALUES (%s, %s, %s)
-            """
-            order_id = self.execute_insert(query_order, (order_number, 'pending', total_price))
-            
-            # Aggiungiamo gli articoli
-            query_item = """
-                INSERT INTO order_items (order_id, product_id, quantity, unit_price)
-                VALUES (%s, %s, %s, %s)
+    def get_order_items_bulk(self, order_ids):
+        """Recupera gli articoli di più ordini con una sola query, raggruppati per ordine"""
+        items_by_order = {order_id: [] for order_id in order_ids}
+        if not items_by_order:
+            return items_by_order
+        placeholders = ", ".join(["%s"] * len(items_by_order))
+        query = f"""
+            SELECT oi.order_id, oi.id, oi.product_id, oi.quantity, oi.unit_price, p.name, p.description
+            FROM order_items oi
+            LEFT JOIN products p ON oi.product_id = p.id
+            WHERE oi.order_id IN ({placeholders})
+            ORDER BY oi.order_id, oi.id
+        """
+        for item in self.execute_query(query, tuple(items_by_order)):
+            items_by_order[item.pop('order_id')].append(item)
+        return items_by_order
+    
+    def get_order_items_rows(self, order_ids):
+        """Come get_order_items_bulk, con gli articoli come tuple: ritorna (colonne, {order_id: [tuple]})"""
+        items_by_order = {order_id: [] for order_id in order_ids}
+        if items_by_order:
+            placeholders = ", ".join(["%s"] * len(items_by_order))
+            query = f"""
+                SELECT oi.order_id, oi.id, oi.product_id, oi.quantity, oi.unit_price, p.name, p.description
+                FROM order_items oi
+                LEFT JOIN products p ON oi.product_id = p.id
+                WHERE oi.order_id IN ({placeholders})
+                ORDER BY oi.order_id, oi.id
             """
-            for item in items:
-                self.execute_insert(query_item, (order_id, item['product_id'], item['quantity'], item['unit_price']))
-            
-            return order_id
-        except Exception as e:
-            logger.error(f"Error creating order: {e}")
-            raise
+            for row in self.execute_rows(query, tuple(items_by_order)):
+                items_by_order[row[0]].append(row[1:])
+        return list(ORDER_ITEM_COLUMNS), items_by_order
     
-    def update_order_status(self, order_id, status):
-        """Aggiorna lo stato di un ordine"""
-        query = "UPDATE orders SET status = %s, updated_at = NOW() WHERE id = %s"
-        return self.execute_update(query, (status, order_id))
+    def create_order(self, total_price, items, store_id=DEFAULT_STORE_ID):
+        """Crea un nuovo ordine con gli articoli in un'unica transazione"""
+        return self.run_in_transaction(lambda cursor: self._insert_order(cursor, store_id, total_price, items))
     
-    def delete_order(self, order_id):
-        """Elimina un ordine e i suoi articoli"""
-        try:
+    def create_order_idempotent(self, idempotency_key, fingerprint, total_price, items, store_id=DEFAULT_STORE_ID):
+        """Come create_order, ma una chiave già usata ritorna l'ordine originale.
+        Ritorna (order_id, creato); IdempotencyKeyMismatch se la chiave è di un'altra richiesta."""
+        def work(cursor):
+            # Una chiave scaduta può essere riutilizzata
+            cursor.execute(
+                """DELETE FROM idempotency_keys
+                   WHERE store_id = %s AND idempotency_key = %s AND created_at < NOW() - INTERVAL %s SECOND""",
+                (store_id, idempotency_key, int(Config.IDEMPOTENCY_TTL))
+            )
+            # Con una richiesta concorrente sulla stessa chiave l'INSERT attende il suo commit,
+            # poi la trova e la ignora: un solo ordine per chiave anche tra worker diversi
+            cursor.execute(
+                "INSERT IGNORE INTO idempotency_keys (store_id, idempotency_key, fingerprint) VALUES (%s, %s, %s)",
+                (store_id, idempotency_key, fingerprint)
+            )
+            if not cursor.rowcount:
+                cursor.execute(
+                    "SELECT order_id, fingerprint FROM idempotency_keys WHERE store_id = %s AND idempotency_key = %s",
+                    (store_id, idempotency_key)
+                )
+                existing = cursor.fetchone()
+                if existing['fingerprint'] != fingerprint:
+                    raise IdempotencyKeyMismatch()
+                return existing['order_id'], False
+            order_id = self._insert_order(cursor, store_id, total_price, items)
+            cursor.execute("UPDATE idempotency_keys SET order_id = %s WHERE store_id = %s AND idempotency_key = %s",
+                           (order_id, store_id, idempotency_key))
+            return order_id, True
+        
+        return self.run_in_transaction(work)
+    
+    def _insert_order(self, cursor, store_id, total_price, items):
+        # Numero ordine dal contatore del negozio: LAST_INSERT_ID(expr) lo rende leggibile solo
+        # da questa connessione e il lock sulla riga serializza i totem concorrenti
+        counter = f"orders:{store_id}"
+        next_number = "UPDATE order_counters SET value = LAST_INSERT_ID(value + 1) WHERE name = %s"
+        cursor.execute(next_number, (counter,))
+        if not cursor.rowcount:
+            # Primo ordine del negozio su questo shard: si riparte dal numero più alto già usato
+            cursor.execute(
+                "INSERT IGNORE INTO order_counters (name, value) SELECT %s, COALESCE(MAX(order_number), 0) FROM orders WHERE store_id = %s",
+                (counter, store_id)
+            )
+            cursor.execute(next_number, (counter,))
+        cursor.execute("SELECT LAST_INSERT_ID() AS next_number")
+        order_number = cursor.fetchone()['next_number']
+        
+        # Creiamo l'ordine
+        cursor.execute(
+            "INSERT INTO orders (store_id, order_number, status, total_price) VALUES (%s, %s, %s, %s)",
+            (store_id, order_number, 'pending', total_price)
+        )
+        order_id = cursor.lastrowid
+        
+        # Aggiungiamo gli articoli con un unico INSERT multi-riga
+        cursor.executemany(
+            "INSERT INTO order_items (order_id, product_id, quantity, unit_price) VALUES (%s, %s, %s, %s)",
+            [(order_id, item['product_id'], item['quantity'], item['unit_price']) for item in items]
+        )
+        
+        # Aggiorniamo i rollup delle vendite nella stessa transazione
+        apply_rollups(cursor, self.dialect, order_id, 1)
+        return order_id
+    
+    def purge_idempotency_keys(self):
+        """Elimina le chiavi di idempotenza scadute e ritorna quante sono"""
+        return self.execute_update(
+            "DELETE FROM idempotency_keys WHERE created_at < NOW() - INTERVAL %s SECOND",
+            (int(Config.IDEMPOTENCY_TTL),)
+        )
+    
+    def update_order_status(self, order_id, status, store_id=DEFAULT_STORE_ID):
+        """Aggiorna lo stato di un ordine del negozio"""
+        status = normalize_status(status)
+        def work(cursor):
+            cursor.execute("SELECT status FROM orders WHERE id = %s AND store_id = %s FOR UPDATE", (order_id, store_id))
+            order = cursor.fetchone()
+            if order is None:
+                return 0
+            check_transition(order['status'], status)
+            # Aggiornamento condizionale: vale solo se lo stato è ancora quello letto
+            cursor.execute("UPDATE orders SET status = %s, updated_at = NOW() WHERE id = %s AND status = %s",
+                           (status, order_id, order['status']))
+            updated = cursor.rowcount
+            if not updated:
+                # Lo stato è cambiato dopo la lettura
+                raise InvalidStatusTransition(order['status'], status)
+            # Cancellare un ordine lo toglie dai rollup
+            sign = status_change_sign(order['status'], status)
+            if sign:
+                apply_rollups(cursor, self.dialect, order_id, sign)
+            return updated
+        
+        return self.run_in_transaction(work)
+    
+    def delete_order(self, order_id, store_id=DEFAULT_STORE_ID):
+        """Elimina un ordine del negozio e i suoi articoli"""
+        def work(cursor):
+            # Togliamo l'ordine dai rollup finché i suoi articoli esistono ancora
+            cursor.execute("SELECT status FROM orders WHERE id = %s AND store_id = %s FOR UPDATE", (order_id, store_id))
+            order = cursor.fetchone()
+            if order is None:
+                return 0
+            if status_change_sign(order['status'], 'cancelled'):
+                apply_rollups(cursor, self.dialect, order_id, -1)
+            
             # Eliminiamo gli articoli
-            query_items = "DELETE FROM order_items WHERE order_id = %s"
-            self.execute_update(query_items, (order_id,))
+            cursor.execute("DELETE FROM order_items WHERE order_id = %s", (order_id,))
             
             # Eliminiamo l'ordine
-            query_order = "DELETE FROM orders WHERE id = %s"
-            return self.execute_update(query_order, (order_id,))
-        except Exception as e:
-            logger.error(f"Error deleting order: {e}")
-            raise
+            cursor.execute("DELETE FROM orders WHERE id = %s", (order_id,))
+            return cursor.rowcount
+        
+        return self.run_in_transaction(work)
+    
+    # === ANALYTICS ===
+    def get_sales(self, granularity='day', start=None, end=None, store_id=DEFAULT_STORE_ID):
+        """Vendite del negozio per ora o per giorno dai rollup, per i bucket che iniziano in [start, end)"""
+        table, column = ('sales_hourly', 'hour') if granularity == 'hour' else ('sales_daily', 'day')
+        conditions, params = self._bucket_range(column, start, end)
+        # Un bucket i cui ordini sono stati tutti cancellati resta a zero: non lo mostriamo
+        conditions.append("orders <> 0")
+        conditions.append("store_id = %s")
+        params.append(store_id)
+        query = f"SELECT {column} AS period, orders, quantity, revenue FROM {table}"
+        query += " WHERE " + " AND ".join(conditions) + f" ORDER BY {column}"
+        return self.execute_query(query, tuple(params))
+    
+    def get_product_sales(self, start=None, end=None, limit=None, store_id=DEFAULT_STORE_ID):
+        """Quantità e ricavi del negozio per prodotto nei giorni in [start, end), dal più venduto"""
+        conditions, params = self._bucket_range('s.day', start, end)
+        query = """
+            SELECT s.product_id, p.name, SUM(s.quantity) AS quantity, SUM(s.revenue) AS revenue
+            FROM sales_products_daily s
+            LEFT JOIN products p ON p.id = s.product_id
+        """
+        conditions.append("s.store_id = %s")
+        params.append(store_id)
+        query += " WHERE " + " AND ".join(conditions)
+        query += " GROUP BY s.product_id, p.name HAVING SUM(s.quantity) <> 0 ORDER BY revenue DESC"
+        if limit is not None:
+            query += " LIMIT %s"
+            params.append(limit)
+        return self.execute_query(query, tuple(params))
+    
+    def get_category_sales(self, start=None, end=None, store_id=DEFAULT_STORE_ID):
+        """Quantità e ricavi del negozio per categoria nei giorni in [start, end)"""
+        conditions, params = self._bucket_range('s.day', start, end)
+        query = """
+            SELECT s.category_id, c.name, SUM(s.quantity) AS quantity, SUM(s.revenue) AS revenue
+            FROM sales_categories_daily s
+            LEFT JOIN categories c ON c.id = s.category_id
+        """
+        conditions.append("s.store_id = %s")
+        params.append(store_id)
+        query += " WHERE " + " AND ".join(conditions)
+        query += " GROUP BY s.category_id, c.name HAVING SUM(s.quantity) <> 0 ORDER BY revenue DESC"
+        return self.execute_query(query, tuple(params))
+    
+    @staticmethod
+    def _bucket_range(column, start, end):
+        conditions, params = [], []
+        if start is not None:
+            conditions.append(f"{column} >= %s")
+            params.append(start)
+        if end is not None:
+            conditions.append(f"{column} < %s")
+            params.append(end)
+        return conditions, params
+    
+    def rebuild_analytics(self):
+        """Ricalcola da zero i rollup delle vendite dagli ordini esistenti"""
+        def work(cursor):
+            for statement in rebuild_statements(self.dialect):
+                cursor.execute(statement)
+        
+        self.run_in_transaction(work)
+    
+    # === EXPORT ORDINI ===
+    def iter_orders_export(self, start=None, end=None, batch_size=1000, store_id=DEFAULT_STORE_ID):
+        """Scorre gli ordini del negozio (una riga per articolo, ordinate per ordine) nell'intervallo
+        [start, end) senza caricarli tutti in memoria. Va consumato dentro una session()"""
+        conditions = ["o.store_id = %s"]
+        params = [store_id]
+        if start is not None:
+            conditions.append("o.created_at >= %s")
+            params.append(start)
+        if end is not None:
+            conditions.append("o.created_at < %s")
+            params.append(end)
+        query = """
+            SELECT o.id AS order_id, o.order_number, o.status, o.total_price, o.created_at, o.updated_at,
+                   oi.product_id, p.name AS product_name, oi.quantity, oi.unit_price
+            FROM orders o
+            LEFT JOIN order_items oi ON oi.order_id = o.id
+            LEFT JOIN products p ON oi.product_id = p.id
+        """
+        query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY o.id, oi.id"
+        return self._stream_query(query, tuple(params), batch_size)
+    
+    def _stream_query(self, query, params, batch_size):
+        """Esegue una query con un cursore lato server (SSDictCursor) e ne ritorna le righe a blocchi"""
+        # Anche le letture in streaming preferiscono una replica
+        if self._replica_cursor() is not None:
+            connection = self._local.replica_connection
+        else:
+            self.connect()
+            connection = self.connection
+        cursor = connection.cursor(pymysql.cursors.SSDictCursor)
+        try:
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            # Chiudere un SSCursor scarta le righe non lette e libera la connessione
+            cursor.close()
@@ -1,124 +1,119 @@
 import sqlite3
 import os
+from pathlib import Path
+from decimal import Decimal
+import threading
+from contextlib import contextmanager
 from typing import List, Dict, Any
+from config import Config
+from metrics import timed_query
+from connection_pool import ConnectionPool
+from sqlite_writer import SQLiteWriter, apply_pragmas
+from cache import MenuCache
+from pricing import build_price_index
+from catalog_io import resolve_categories
+from analytics import apply_rollups, day_bound, rebuild_statements, status_change_sign
+from idempotency import IdempotencyKeyMismatch
+from order_status import InvalidStatusTransition, check_transition, normalize_status
+from stores import DEFAULT_STORE_ID
+from encoding import Rows
+from images import ORIGINAL, attach_images
+
+MAX_QUERY_PARAMS = 999
+
+# Immagini dei prodotti, aggiunte alle letture del catalogo come URL per variante
+PRODUCT_IMAGES_QUERY = "SELECT product_id, variant, file FROM product_images"
+
+# Colonne degli articoli restituite da get_order_items_rows
+ORDER_ITEM_COLUMNS = ('id', 'product_id', 'quantity', 'unit_price', 'name', 'description')
+
+# I prezzi calcolati dal server sono Decimal, le colonne SQLite sono REAL
+sqlite3.register_adapter(Decimal, float)
 
 class DatabaseWrapper:
-    """SQLite Wrapper - Versione di sviluppo locale"""
+    """SQLite Wrapper - sviluppo locale o uno shard di negozi (un file per shard).
+    
+    Il database è in modalità WAL: le letture usano un pool di connessioni
+    in sola lettura, tutte le scritture passano dal thread di scrittura
+    (`SQLiteWriter`) che le raggruppa in poche transazioni. Schema e dati di
+    esempio sono creati dalle migrazioni (`migrations.apply_migrations`).
+    """
+    
+    dialect = 'sqlite'
     
     def __init__(self, db_file="hamburgeria.db"):
         self.db_file = db_file
-        self.connection = None
-        self.cursor = None
-        self._init_db()
+        self.writer = SQLiteWriter(db_file, max_batch=Config.SQLITE_WRITE_BATCH)
+        self.pool = ConnectionPool(
+            self._create_connection,
+            size=Config.DB_POOL_SIZE,
+            timeout=Config.DB_POOL_TIMEOUT,
+            idle_timeout=Config.DB_POOL_IDLE_TIMEOUT,
+            ping=lambda connection: connection.execute("SELECT 1"),
+            pre_ping=Config.DB_POOL_PRE_PING
+        )
+        # Connessione e cursore sono per-thread: ogni richiesta usa i propri
+        self._local = threading.local()
+        # Cache in memoria delle letture del menu, invalidata dalle scritture sul catalogo
+        self.menu_cache = MenuCache(maxsize=Config.MENU_CACHE_SIZE, ttl=Config.MENU_CACHE_TTL)
     
-    def _init_db(self):
-        """Inizializza il database con schema e dati di esempio"""
-        self.connect()
-        
-        # Creiamo le tabelle
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS categories (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT UNIQUE NOT NULL,
-                description TEXT
-            )
-        ''')
-        
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS products (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                description TEXT,
-                price REAL NOT NULL,
-                image_url TEXT,
-                category_id INTEGER NOT NULL,
-                FOREIGN KEY(category_id) REFERENCES categories(id)
-            )
-        ''')
-        
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS orders (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                order_number INTEGER UNIQUE NOT NULL,
-                status TEXT DEFAULT 'pending',
-                total_price REAL NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS order_items (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                order_id INTEGER NOT NULL,
-                product_id INTEGER NOT NULL,
-                quantity INTEGER NOT NULL DEFAULT 1,
-                unit_price REAL NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY(order_id) REFERENCES orders(id),
-                FOREIGN KEY(product_id) REFERENCES products(id)
-            )
-        ''')
-        
-        # Inseriamo dati di esempio
-        try:
-            self.cursor.execute('INSERT INTO categories (name, description) VALUES (?, ?)',
-                               ('Panini', 'Panini freschi e gustosi'))
-            self.cursor.execute('INSERT INTO categories (name, description) VALUES (?, ?)',
-                               ('Bevande', 'Bevande fredde e calde'))
-            self.cursor.execute('INSERT INTO categories (name, description) VALUES (?, ?)',
-                               ('Menu', 'Menu completi'))
-            self.cursor.execute('INSERT INTO categories (name, description) VALUES (?, ?)',
-                               ('Dolci', 'Dolci e dessert'))
-            
-            # Panini
-            self.cursor.execute('INSERT INTO products (name, description, price, category_id) VALUES (?, ?, ?, ?)',
-                               ('Hamburger Classico', 'Pane, carne, pomodoro, lattuga, cipolla', 7.50, 1))
-            self.cursor.execute('INSERT INTO products (name, description, price, category_id) VALUES (?, ?, ?, ?)',
-                               ('Cheeseburger', 'Con formaggio cheddar premium', 8.50, 1))
-            self.cursor.execute('INSERT INTO products (name, description, price, category_id) VALUES (?, ?, ?, ?)',
-                               ('Veggie Burger', 'Panino vegetariano con verdure grigliate', 7.00, 1))
-            
-            # Bevande
-            self.cursor.execute('INSERT INTO products (name, description, price, category_id) VALUES (?, ?, ?, ?)',
-                               ('Coca Cola', 'Lattina 33cl', 2.50, 2))
-            self.cursor.execute('INSERT INTO products (name, description, price, category_id) VALUES (?, ?, ?, ?)',
-                               ('Acqua Naturale', 'Bottiglia 50cl', 1.50, 2))
-            self.cursor.execute('INSERT INTO products (name, description, price, category_id) VALUES (?, ?, ?, ?)',
-                               ('Birra', 'Birra artigianale 33cl', 4.00, 2))
-            
-            # Menu
-            self.cursor.execute('INSERT INTO products (name, description, price, category_id) VALUES (?, ?, ?, ?)',
-                               ('Menu Combo', 'Hamburger + Patatine + Bevanda', 12.00, 3))
-            self.cursor.execute('INSERT INTO products (name, description, price, category_id) VALUES (?, ?, ?, ?)',
-                               ('Menu Deluxe', 'Cheeseburger + Patatine + Bevanda + Dolce', 15.00, 3))
-            
-            # Dolci
-            self.cursor.execute('INSERT INTO products (name, description, price, category_id) VALUES (?, ?, ?, ?)',
-                               ('Tiramisù', 'Dolce tradizionale italiano', 4.50, 4))
-            self.cursor.execute('INSERT INTO products (name, description, price, category_id) VALUES (?, ?, ?, ?)',
-                               ('Gelato', 'Gelato assortito', 3.50, 4))
-            
-            self.connection.commit()
-        except sqlite3.IntegrityError:
-            # Dati già inseriti
-            pass
-        
-        self.disconnect()
+    @property
+    def connection(self):
+        return getattr(self._local, 'connection', None)
+    
+    @property
+    def cursor(self):
+        # Dentro una session() la connessione viene presa dal pool al primo utilizzo
+        if getattr(self._local, 'cursor', None) is None and getattr(self._local, 'depth', 0):
+            self.connect()
+        return getattr(self._local, 'cursor', None)
+    
+    def _create_connection(self):
+        """Apre una nuova connessione in sola lettura (usata dal pool)"""
+        # Le connessioni del pool passano da un thread all'altro
+        uri = Path(self.db_file).resolve().as_uri() + '?mode=ro'
+        connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        connection.row_factory = sqlite3.Row
+        apply_pragmas(connection)
+        return connection
     
     def connect(self):
-        """Connette al database"""
-        self.connection = sqlite3.connect(self.db_file)
-        self.connection.row_factory = sqlite3.Row
-        self.cursor = self.connection.cursor()
+        """Prende una connessione dal pool per il thread corrente"""
+        if getattr(self._local, 'connection', None) is not None:
+            return
+        self._local.connection = self.pool.acquire()
+        self._local.cursor = self._local.connection.cursor()
     
     def disconnect(self):
-        """Chiude la connessione"""
-        if self.cursor:
-            self.cursor.close()
-        if self.connection:
-            self.connection.close()
+        """Restituisce la connessione del thread corrente al pool"""
+        connection = getattr(self._local, 'connection', None)
+        cursor = getattr(self._local, 'cursor', None)
+        self._local.connection = None
+        self._local.cursor = None
+        if connection is None:
+            return
+        discard = False
+        try:
+            if cursor:
+                cursor.close()
+            # Non lasciamo transazioni aperte su una connessione condivisa
+            connection.rollback()
+        except sqlite3.Error:
+            discard = True
+        self.pool.release(connection, discard=discard)
+    
+    @contextmanager
+    def session(self):
+        """Contesto per-richiesta: la connessione viene restituita al pool all'uscita"""
+        self._local.depth = getattr(self._local, 'depth', 0) + 1
+        try:
+            yield self
+        finally:
+            self._local.depth -= 1
+            if not self._local.depth:
+                self.disconnect()
     
+    @timed_query
     def execute_query(self, query, params=None):
         """Esegue una query e ritorna i risultati"""
         if params:
@@ -127,40 +122,59 @@ class DatabaseWrapper:
             self.cursor.execute(query)
         return [dict(row) for row in self.cursor.fetchall()]
     
+    @timed_query
+    def execute_rows(self, query, params=None):
+        """Come execute_query, ma ritorna Rows (nomi delle colonne e tuple) senza creare un dict per riga"""
+        cursor = self.cursor
+        cursor.row_factory = None
+        try:
+            cursor.execute(query, params or ())
+            return Rows([column[0] for column in cursor.description], cursor.fetchall())
+        finally:
+            cursor.row_factory = sqlite3.Row
+    
+    @timed_query
     def execute_update(self, query, params=None):
-        """Esegue un INSERT/UPDATE/DELETE"""
-        if params:
-            self.cursor.execute(query, params)
-        else:
-            self.cursor.execute(query)
-        self.connection.commit()
-        return self.cursor.rowcount
+        """Esegue un INSERT/UPDATE/DELETE (sul thread di scrittura)"""
+        return self.writer.submit(lambda cursor: cursor.execute(query, params or ()).rowcount)
     
+    @timed_query
     def execute_insert(self, query, params=None):
-        """Esegue un INSERT e ritorna l'ID"""
-        if params:
-            self.cursor.execute(query, params)
-        else:
-            self.cursor.execute(query)
-        self.connection.commit()
-        return self.cursor.lastrowid
+        """Esegue un INSERT e ritorna l'ID (sul thread di scrittura)"""
+        return self.writer.submit(lambda cursor: cursor.execute(query, params or ()).lastrowid)
+    
+    @timed_query
+    def run_in_transaction(self, work):
+        """Esegue work(cursor) in un'unica transazione: commit alla fine, rollback in caso di errore"""
+        # Il thread di scrittura esegue work() dentro un SAVEPOINT della transazione di gruppo,
+        # che tiene il lock di scrittura: le letture fatte da work() non possono essere superate
+        return self.writer.submit(work)
     
     # === CATEGORIE ===
     def get_all_categories(self):
-        return self.execute_query("SELECT id, name, description FROM categories ORDER BY name")
+        return self.menu_cache.get_or_load(
+            ('categories',),
+            lambda: self.execute_query("SELECT id, name, description FROM categories ORDER BY name")
+        )
     
     def get_category_by_id(self, category_id):
         result = self.execute_query("SELECT id, name, description FROM categories WHERE id = ?", (category_id,))
         return result[0] if result else None
     
     def create_category(self, name, description=""):
-        return self.execute_insert("INSERT INTO categories (name, description) VALUES (?, ?)", (name, description))
+        category_id = self.execute_insert("INSERT INTO categories (name, description) VALUES (?, ?)", (name, description))
+        self.menu_cache.invalidate_categories()
+        return category_id
     
     def update_category(self, category_id, name, description):
-        return self.execute_update("UPDATE categories SET name = ?, description = ? WHERE id = ?", (name, description, category_id))
+        result = self.execute_update("UPDATE categories SET name = ?, description = ? WHERE id = ?", (name, description, category_id))
+        self.menu_cache.invalidate_categories()
+        return result
     
     def delete_category(self, category_id):
-        return self.execute_update("DELETE FROM categories WHERE id = ?", (category_id,))
+        result = self.execute_update("DELETE FROM categories WHERE id = ?", (category_id,))
+        self.menu_cache.invalidate_categories()
+        return result
     
     # === PRODOTTI ===
     def get_all_products(self):
@@ -170,7 +184,10 @@ class DatabaseWrapper:
             LEFT JOIN categories c ON p.category_id = c.id
             ORDER BY c.name, p.name
         """
-        return self.execute_query(query)
+        return self.menu_cache.get_or_load(
+            ('products',),
+            lambda: attach_images(self.execute_query(query), self.execute_query(PRODUCT_IMAGES_QUERY), Config.IMAGES_BASE_URL)
+        )
     
     def get_products_by_category(self, category_id):
         query = """
@@ -179,31 +196,221 @@ class DatabaseWrapper:
             WHERE category_id = ?
             ORDER BY name
         """
-        return self.execute_query(query, (category_id,))
+        images_query = PRODUCT_IMAGES_QUERY + " WHERE product_id IN (SELECT id FROM products WHERE category_id = ?)"
+        return self.menu_cache.get_or_load(
+            ('products_by_category', category_id),
+            lambda: attach_images(
+                self.execute_query(query, (category_id,)),
+                self.execute_query(images_query, (category_id,)),
+                Config.IMAGES_BASE_URL
+            )
+        )
     
     def get_product_by_id(self, product_id):
-        result = self.execute_query("SELECT id, name, description, price, image_url, category_id FROM products WHERE id = ?", (product_id,))
-        return result[0] if result else None
+        def load():
+            result = self.execute_query("SELECT id, name, description, price, image_url, category_id FROM products WHERE id = ?", (product_id,))
+            if not result:
+                return None
+            images = self.execute_query(PRODUCT_IMAGES_QUERY + " WHERE product_id = ?", (product_id,))
+            return attach_images(result, images, Config.IMAGES_BASE_URL)[0]
+        return self.menu_cache.get_or_load(('product', product_id), load)
+    
+    def get_price_index(self):
+        return self.menu_cache.get_or_load(
+            ('price_index',),
+            lambda: build_price_index(self.execute_query("SELECT id, price FROM products"))
+        )
     
     def create_product(self, name, description, price, category_id, image_url=""):
         query = "INSERT INTO products (name, description, price, category_id, image_url) VALUES (?, ?, ?, ?, ?)"
-        return self.execute_insert(query, (name, description, price, category_id, image_url))
+        product_id = self.execute_insert(query, (name, description, price, category_id, image_url))
+        self.menu_cache.invalidate_products(product_id)
+        return product_id
     
     def update_product(self, product_id, name, description, price, category_id, image_url):
         query = "UPDATE products SET name = ?, description = ?, price = ?, category_id = ?, image_url = ? WHERE id = ?"
-        return self.execute_update(query, (name, description, price, category_id, image_url, product_id))
+        result = self.execute_update(query, (name, description, price, category_id, image_url, product_id))
+        self.menu_cache.invalidate_products(product_id)
+        return result
     
     def delete_product(self, product_id):
-        return self.execute_update("DELETE FROM products WHERE id = ?", (product_id,))
+        result = self.execute_update("DELETE FROM products WHERE id = ?", (product_id,))
+        self.menu_cache.invalidate_products(product_id)
+        return result
     
-    # === ORDINI ===
-    def get_all_orders(self):
-        query = "SELECT id, order_number, status, total_price, created_at, updated_at FROM orders ORDER BY created_at DESC"
+    # === IMMAGINI DEI PRODOTTI ===
+    def get_product_originals(self):
+        """Immagine originale di ogni prodotto: {product_id: file}"""
+        rows = self.execute_query("SELECT product_id, file FROM product_images WHERE variant = ?", (ORIGINAL,))
+        return {row['product_id']: row['file'] for row in rows}
+    
+    def set_product_image(self, product_id, original):
+        """Nuova immagine originale del prodotto: le varianti della precedente vengono rimosse"""
+        def work(cursor):
+            cursor.execute("DELETE FROM product_images WHERE product_id = ?", (product_id,))
+            cursor.execute("INSERT INTO product_images (product_id, variant, file) VALUES (?, ?, ?)",
+                           (product_id, ORIGINAL, original))
+        self.run_in_transaction(work)
+        self.menu_cache.invalidate_products(product_id)
+    
+    def set_product_variants(self, product_id, original, variants):
+        """Salva le varianti {variante: (file, larghezza, altezza)} generate da `original`.
+        Ritorna False se nel frattempo il prodotto ha cambiato immagine."""
+        def work(cursor):
+            cursor.execute("SELECT file FROM product_images WHERE product_id = ? AND variant = ?", (product_id, ORIGINAL))
+            row = cursor.fetchone()
+            if row is None or row['file'] != original:
+                return False
+            cursor.execute("DELETE FROM product_images WHERE product_id = ? AND variant <> ?", (product_id, ORIGINAL))
+            cursor.executemany(
+                "INSERT INTO product_images (product_id, variant, file, width, height) VALUES (?, ?, ?, ?, ?)",
+                [(product_id, variant, name, width, height) for variant, (name, width, height) in variants.items()]
+            )
+            return True
+        updated = self.run_in_transaction(work)
+        if updated:
+            self.menu_cache.invalidate_products(product_id)
+        return updated
+    
+    def delete_product_image(self, product_id):
+        result = self.execute_update("DELETE FROM product_images WHERE product_id = ?", (product_id,))
+        self.menu_cache.invalidate_products(product_id)
+        return result
+    
+    # === IMPORT/EXPORT CATALOGO ===
+    def import_categories(self, categories):
+        """Inserisce o aggiorna (per nome) le categorie in un'unica transazione"""
+        def work(cursor):
+            cursor.executemany("""
+                INSERT INTO categories (name, description) VALUES (?, ?)
+                ON CONFLICT(name) DO UPDATE SET description = COALESCE(excluded.description, description)
+            """, categories)
+            return len(categories)
+        
+        count = self.run_in_transaction(work) if categories else 0
+        self.menu_cache.invalidate_categories()
+        return count
+    
+    def import_products(self, products):
+        """Inserisce o aggiorna (per nome e categoria) i prodotti in un'unica transazione.
+        Ritorna il numero di prodotti importati e gli errori delle righe scartate"""
+        def work(cursor):
+            # Le categorie sono lette nella stessa transazione delle scritture
+            cursor.execute("SELECT id, name FROM categories")
+            rows, errors = resolve_categories(products, cursor.fetchall())
+            if rows:
+                cursor.executemany("""
+                INSERT INTO products (name, description, price, image_url, category_id)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(name, category_id) DO UPDATE SET
+                    description = COALESCE(excluded.description, description), price = excluded.price,
+                    image_url = COALESCE(excluded.image_url, image_url)
+            """, rows)
+            return len(rows), errors
+        
+        result = self.run_in_transaction(work)
+        self.menu_cache.invalidate_products()
+        return result
+    
+    def export_categories(self):
+        """Recupera tutte le categorie per l'export"""
+        return self.execute_query("SELECT id, name, description FROM categories ORDER BY id")
+    
+    def export_products(self):
+        """Recupera tutti i prodotti con il nome della categoria per l'export"""
+        query = """
+            SELECT p.id, p.name, p.description, p.price, p.image_url, p.category_id, c.name as category
+            FROM products p
+            LEFT JOIN categories c ON p.category_id = c.id
+            ORDER BY p.id
+        """
         return self.execute_query(query)
     
-    def get_order_by_id(self, order_id):
-        query = "SELECT id, order_number, status, total_price, created_at, updated_at FROM orders WHERE id = ?"
-        result = self.execute_query(query, (order_id,))
+    def replace_catalog(self, categories, products):
+        """Allinea categorie e prodotti (con i loro id) a quelli dello shard master"""
+        def work(cursor):
+            category_ids = [category['id'] for category in categories]
+            product_ids = [product['id'] for product in products]
+            # Prima le eliminazioni, così un nome riusato da un nuovo id non va in conflitto
+            cursor.execute(f"DELETE FROM products WHERE id NOT IN ({', '.join('?' * len(product_ids))})", product_ids)
+            cursor.execute(f"DELETE FROM categories WHERE id NOT IN ({', '.join('?' * len(category_ids))})", category_ids)
+            cursor.executemany("""
+                INSERT INTO categories (id, name, description) VALUES (?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET name = excluded.name, description = excluded.description
+            """, [(c['id'], c['name'], c['description']) for c in categories])
+            cursor.executemany("""
+                INSERT INTO products (id, name, description, price, image_url, category_id) VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET name = excluded.name, description = excluded.description,
+                    price = excluded.price, image_url = excluded.image_url, category_id = excluded.category_id
+            """, [(p['id'], p['name'], p['description'], p['price'], p['image_url'], p['category_id']) for p in products])
+        
+        self.run_in_transaction(work)
+        self.menu_cache.invalidate_categories()
+    
+    # === PREZZI PER NEGOZIO ===
+    def get_store_overrides(self, store_id):
+        """Prezzi e disponibilità personalizzati del negozio: {product_id: {price, available}}"""
+        query = "SELECT product_id, price, available FROM store_products WHERE store_id = ?"
+        return self.menu_cache.get_or_load(
+            ('store_overrides', store_id),
+            lambda: {row['product_id']: {"price": row['price'], "available": bool(row['available'])}
+                     for row in self.execute_query(query, (store_id,))}
+        )
+    
+    def set_store_override(self, store_id, product_id, price=None, available=True):
+        query = """
+            INSERT INTO store_products (store_id, product_id, price, available) VALUES (?, ?, ?, ?)
+            ON CONFLICT(store_id, product_id) DO UPDATE SET price = excluded.price, available = excluded.available
+        """
+        result = self.execute_update(query, (store_id, product_id, price, int(available)))
+        self.menu_cache.invalidate_store(store_id)
+        return result
+    
+    def delete_store_override(self, store_id, product_id):
+        result = self.execute_update("DELETE FROM store_products WHERE store_id = ? AND product_id = ?",
+                                     (store_id, product_id))
+        self.menu_cache.invalidate_store(store_id)
+        return result
+    
+    # === ORDINI ===
+    def get_all_orders(self, store_id=DEFAULT_STORE_ID, rows=False):
+        query = """
+            SELECT id, order_number, status, total_price, created_at, updated_at
+            FROM orders WHERE store_id = ? ORDER BY created_at DESC
+        """
+        return (self.execute_rows if rows else self.execute_query)(query, (store_id,))
+    
+    def get_orders(self, statuses=None, since=None, limit=None, before_id=None, store_id=DEFAULT_STORE_ID, rows=False):
+        """Recupera gli ordini del negozio filtrati per stato e data, paginati per id decrescente (keyset).
+        Con rows=True ritorna Rows (tuple) invece di una lista di dict."""
+        conditions = ["store_id = ?"]
+        params = [store_id]
+        if statuses:
+            conditions.append(f"status IN ({', '.join(['?'] * len(statuses))})")
+            params.extend(statuses)
+        if since is not None:
+            # created_at è salvato come testo 'YYYY-MM-DD HH:MM:SS' (UTC)
+            conditions.append("created_at >= ?")
+            params.append(since.strftime('%Y-%m-%d %H:%M:%S') if hasattr(since, 'strftime') else since)
+        if before_id is not None:
+            conditions.append("id < ?")
+            params.append(before_id)
+        query = "SELECT id, order_number, status, total_price, created_at, updated_at FROM orders"
+        query += " WHERE " + " AND ".join(conditions)
+        # Con una finestra temporale "+id" impedisce al planner di scorrere tutta la tabella
+        # in ordine di id: usa idx_orders_store_created_at e ordina solo le righe della finestra
+        query += " ORDER BY +id DESC" if since is not None else " ORDER BY id DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        return (self.execute_rows if rows else self.execute_query)(query, tuple(params))
+    
+    def get_order_by_id(self, order_id, store_id=DEFAULT_STORE_ID):
+        query = """
+            SELECT id, order_number, status, total_price, created_at, updated_at
+            FROM orders WHERE id = ? AND store_id = ?
+        """
+        result = self.execute_query(query, (order_id, store_id))
         return result[0] if result else None
     
     def get_order_items(self, order_id):
@@ -216,36 +423,249 @@ class DatabaseWrapper:
         """
         return self.execute_query(query, (order_id,))
     
-    def create_order(self, total_price, items):
-        try:
-            # Generiamo il numero ordine
-            result = self.execute_query("SELECT MAX(order_number) as max_order FROM orders")
-            order_number = (result[0]['max_order'] or 0) + 1 if result else 1
-            
-            # Creiamo l'ordine
-            order_id = self.execute_insert(
-                "INSERT INTO orders (order_number, status, total_price) VALUES (?, ?, ?)",
-                (order_number, 'pending', total_price)
+    def get_order_items_bulk(self, order_ids):
+        """Recupera gli articoli di più ordini con una sola query, raggruppati per ordine"""
+        items_by_order = {order_id: [] for order_id in order_ids}
+        if not items_by_order:
+            return items_by_order
+        ids = list(items_by_order)
+        # Le build SQLite più vecchie accettano al massimo 999 parametri per query
+        for start in range(0, len(ids), MAX_QUERY_PARAMS):
+            chunk = ids[start:start + MAX_QUERY_PARAMS]
+            query = f"""
+                SELECT oi.order_id, oi.id, oi.product_id, oi.quantity, oi.unit_price, p.name, p.description
+                FROM order_items oi
+                LEFT JOIN products p ON oi.product_id = p.id
+                WHERE oi.order_id IN ({", ".join("?" * len(chunk))})
+                ORDER BY oi.order_id, oi.id
+            """
+            for item in self.execute_query(query, chunk):
+                items_by_order[item.pop('order_id')].append(item)
+        return items_by_order
+    
+    def get_order_items_rows(self, order_ids):
+        """Come get_order_items_bulk, con gli articoli come tuple: ritorna (colonne, {order_id: [tuple]})"""
+        items_by_order = {order_id: [] for order_id in order_ids}
+        ids = list(items_by_order)
+        for start in range(0, len(ids), MAX_QUERY_PARAMS):
+            chunk = ids[start:start + MAX_QUERY_PARAMS]
+            query = f"""
+                SELECT oi.order_id, oi.id, oi.product_id, oi.quantity, oi.unit_price, p.name, p.description
+                FROM order_items oi
+                LEFT JOIN products p ON oi.product_id = p.id
+                WHERE oi.order_id IN ({", ".join("?" * len(chunk))})
+                ORDER BY oi.order_id, oi.id
+            """
+            for row in self.execute_rows(query, chunk):
+                items_by_order[row[0]].append(row[1:])
+        return list(ORDER_ITEM_COLUMNS), items_by_order
+    
+    def create_order(self, total_price, items, store_id=DEFAULT_STORE_ID):
+        return self.run_in_transaction(lambda cursor: self._insert_order(cursor, store_id, total_price, items))
+    
+    def create_order_idempotent(self, idempotency_key, fingerprint, total_price, items, store_id=DEFAULT_STORE_ID):
+        """Come create_order, ma una chiave già usata ritorna l'ordine originale.
+        Ritorna (order_id, creato); IdempotencyKeyMismatch se la chiave è di un'altra richiesta."""
+        def work(cursor):
+            # Una chiave scaduta può essere riutilizzata
+            cursor.execute(
+                """DELETE FROM idempotency_keys
+                   WHERE store_id = ? AND idempotency_key = ? AND created_at < datetime('now', ?)""",
+                (store_id, idempotency_key, f"-{int(Config.IDEMPOTENCY_TTL)} seconds")
+            )
+            cursor.execute(
+                "INSERT OR IGNORE INTO idempotency_keys (store_id, idempotency_key, fingerprint) VALUES (?, ?, ?)",
+                (store_id, idempotency_key, fingerprint)
             )
-            
-            # Aggiungiamo gli articoli
-            for item in items:
-                self.execute_insert(
-                    "INSERT INTO order_items (order_id, product_id, quantity, unit_price) VALUES (?, ?, ?, ?)",
-                    (order_id, item['product_id'], item['quantity'], item['unit_price'])
+            if not cursor.rowcount:
+                cursor.execute(
+                    "SELECT order_id, fingerprint FROM idempotency_keys WHERE store_id = ? AND idempotency_key = ?",
+                    (store_id, idempotency_key)
                 )
-            
-            return order_id
-        except Exception as e:
-            raise e
+                existing = cursor.fetchone()
+                if existing['fingerprint'] != fingerprint:
+                    raise IdempotencyKeyMismatch()
+                return existing['order_id'], False
+            order_id = self._insert_order(cursor, store_id, total_price, items)
+            cursor.execute("UPDATE idempotency_keys SET order_id = ? WHERE store_id = ? AND idempotency_key = ?",
+                           (order_id, store_id, idempotency_key))
+            return order_id, True
+        
+        return self.run_in_transaction(work)
     
-    def update_order_status(self, order_id, status):
-        query = "UPDATE orders SET status = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?"
-        return self.execute_update(query, (status, order_id))
+    def _insert_order(self, cursor, store_id, total_price, items):
+        # Numero ordine dal contatore del negozio, sotto il lock di scrittura della transazione
+        counter = f"orders:{store_id}"
+        cursor.execute("UPDATE order_counters SET value = value + 1 WHERE name = ?", (counter,))
+        if not cursor.rowcount:
+            # Primo ordine del negozio su questo shard: si riparte dal numero più alto già usato
+            cursor.execute(
+                "INSERT INTO order_counters (name, value) SELECT ?, COALESCE(MAX(order_number), 0) + 1 FROM orders WHERE store_id = ?",
+                (counter, store_id)
+            )
+        cursor.execute("SELECT value FROM order_counters WHERE name = ?", (counter,))
+        order_number = cursor.fetchone()['value']
+        
+        # Creiamo l'ordine
+        cursor.execute(
+            "INSERT INTO orders (store_id, order_number, status, total_price) VALUES (?, ?, ?, ?)",
+            (store_id, order_number, 'pending', total_price)
+        )
+        order_id = cursor.lastrowid
+        
+        # Aggiungiamo gli articoli
+        cursor.executemany(
+            "INSERT INTO order_items (order_id, product_id, quantity, unit_price) VALUES (?, ?, ?, ?)",
+            [(order_id, item['product_id'], item['quantity'], item['unit_price']) for item in items]
+        )
+        
+        # Aggiorniamo i rollup delle vendite nella stessa transazione
+        apply_rollups(cursor, self.dialect, order_id, 1)
+        return order_id
+    
+    def purge_idempotency_keys(self):
+        """Elimina le chiavi di idempotenza scadute e ritorna quante sono"""
+        return self.execute_update(
+            "DELETE FROM idempotency_keys WHERE created_at < datetime('now', ?)",
+            (f"-{int(Config.IDEMPOTENCY_TTL)} seconds",)
+        )
+    
+    def update_order_status(self, order_id, status, store_id=DEFAULT_STORE_ID):
+        status = normalize_status(status)
+        def work(cursor):
+            cursor.execute("SELECT status FROM orders WHERE id = ? AND store_id = ?", (order_id, store_id))
+            order = cursor.fetchone()
+            if order is None:
+                return 0
+            check_transition(order['status'], status)
+            # Aggiornamento condizionale: vale solo se lo stato è ancora quello letto
+            cursor.execute("UPDATE orders SET status = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ? AND status = ?",
+                           (status, order_id, order['status']))
+            updated = cursor.rowcount
+            if not updated:
+                # Lo stato è cambiato dopo la lettura
+                raise InvalidStatusTransition(order['status'], status)
+            # Cancellare un ordine lo toglie dai rollup
+            sign = status_change_sign(order['status'], status)
+            if sign:
+                apply_rollups(cursor, self.dialect, order_id, sign)
+            return updated
+        
+        return self.run_in_transaction(work)
+    
+    def delete_order(self, order_id, store_id=DEFAULT_STORE_ID):
+        def work(cursor):
+            cursor.execute("SELECT status FROM orders WHERE id = ? AND store_id = ?", (order_id, store_id))
+            order = cursor.fetchone()
+            if order is None:
+                return 0
+            if status_change_sign(order['status'], 'cancelled'):
+                apply_rollups(cursor, self.dialect, order_id, -1)
+            cursor.execute("DELETE FROM order_items WHERE order_id = ?", (order_id,))
+            cursor.execute("DELETE FROM orders WHERE id = ?", (order_id,))
+            return cursor.rowcount
+        
+        return self.run_in_transaction(work)
+    
+    # === ANALYTICS ===
+    def get_sales(self, granularity='day', start=None, end=None, store_id=DEFAULT_STORE_ID):
+        """Vendite del negozio per ora o per giorno dai rollup, per i bucket che iniziano in [start, end)"""
+        table, column = ('sales_hourly', 'hour') if granularity == 'hour' else ('sales_daily', 'day')
+        bound = (lambda timestamp: timestamp.strftime('%Y-%m-%d %H:%M:%S')) if granularity == 'hour' else day_bound
+        conditions, params = self._bucket_range(column, bound, start, end)
+        # Un bucket i cui ordini sono stati tutti cancellati resta a zero: non lo mostriamo
+        conditions.append("orders <> 0")
+        conditions.append("store_id = ?")
+        params.append(store_id)
+        query = f"SELECT {column} AS period, orders, quantity, ROUND(revenue, 2) AS revenue FROM {table}"
+        query += " WHERE " + " AND ".join(conditions) + f" ORDER BY {column}"
+        return self.execute_query(query, tuple(params))
+    
+    def get_product_sales(self, start=None, end=None, limit=None, store_id=DEFAULT_STORE_ID):
+        """Quantità e ricavi del negozio per prodotto nei giorni in [start, end), dal più venduto"""
+        conditions, params = self._bucket_range('s.day', day_bound, start, end)
+        query = """
+            SELECT s.product_id, p.name, SUM(s.quantity) AS quantity, ROUND(SUM(s.revenue), 2) AS revenue
+            FROM sales_products_daily s
+            LEFT JOIN products p ON p.id = s.product_id
+        """
+        conditions.append("s.store_id = ?")
+        params.append(store_id)
+        query += " WHERE " + " AND ".join(conditions)
+        query += " GROUP BY s.product_id, p.name HAVING SUM(s.quantity) <> 0 ORDER BY revenue DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        return self.execute_query(query, tuple(params))
+    
+    def get_category_sales(self, start=None, end=None, store_id=DEFAULT_STORE_ID):
+        """Quantità e ricavi del negozio per categoria nei giorni in [start, end)"""
+        conditions, params = self._bucket_range('s.day', day_bound, start, end)
+        query = """
+            SELECT s.category_id, c.name, SUM(s.quantity) AS quantity, ROUND(SUM(s.revenue), 2) AS revenue
+            FROM sales_categories_daily s
+            LEFT JOIN categories c ON c.id = s.category_id
+        """
+        conditions.append("s.store_id = ?")
+        params.append(store_id)
+        query += " WHERE " + " AND ".join(conditions)
+        query += " GROUP BY s.category_id, c.name HAVING SUM(s.quantity) <> 0 ORDER BY revenue DESC"
+        return self.execute_query(query, tuple(params))
+    
+    @staticmethod
+    def _bucket_range(column, bound, start, end):
+        # I bucket sono testo ('YYYY-MM-DD [HH:00:00]'): i limiti vanno nello stesso formato
+        conditions, params = [], []
+        if start is not None:
+            conditions.append(f"{column} >= ?")
+            params.append(bound(start))
+        if end is not None:
+            conditions.append(f"{column} < ?")
+            params.append(bound(end))
+        return conditions, params
+    
+    def rebuild_analytics(self):
+        """Ricalcola da zero i rollup delle vendite dagli ordini esistenti"""
+        def work(cursor):
+            for statement in rebuild_statements(self.dialect):
+                cursor.execute(statement)
+        
+        self.run_in_transaction(work)
+    
+    # === EXPORT ORDINI ===
+    def iter_orders_export(self, start=None, end=None, batch_size=1000, store_id=DEFAULT_STORE_ID):
+        """Scorre gli ordini del negozio (una riga per articolo, ordinate per ordine) nell'intervallo
+        [start, end) senza caricarli tutti in memoria. Va consumato dentro una session()"""
+        conditions = ["o.store_id = ?"]
+        params = [store_id]
+        if start is not None:
+            conditions.append("o.created_at >= ?")
+            params.append(start.strftime('%Y-%m-%d %H:%M:%S') if hasattr(start, 'strftime') else start)
+        if end is not None:
+            conditions.append("o.created_at < ?")
+            params.append(end.strftime('%Y-%m-%d %H:%M:%S') if hasattr(end, 'strftime') else end)
+        query = """
+            SELECT o.id AS order_id, o.order_number, o.status, o.total_price, o.created_at, o.updated_at,
+                   oi.product_id, p.name AS product_name, oi.quantity, oi.unit_price
+            FROM orders o
+            LEFT JOIN order_items oi ON oi.order_id = o.id
+            LEFT JOIN products p ON oi.product_id = p.id
+        """
+        query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY o.id, oi.id"
+        return self._stream_query(query, tuple(params), batch_size)
     
-    def delete_order(self, order_id):
+    def _stream_query(self, query, params, batch_size):
+        """Esegue una query con un cursore dedicato e ne ritorna le righe a blocchi (fetchmany)"""
+        self.connect()
+        cursor = self.connection.cursor()
         try:
-            self.execute_update("DELETE FROM order_items WHERE order_id = ?", (order_id,))
-            return self.execute_update("DELETE FROM orders WHERE id = ?", (order_id,))
-        except Exception as e:
-            raise e
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield dict(row)
+        finally:
+            cursor.close()
@@ -0,0 +1,104 @@
+"""Codifica delle risposte: JSON veloce (orjson) e MessagePack negoziato con Accept.
+
+orjson e msgpack sono opzionali: senza orjson si usa il modulo json della
+libreria standard, senza msgpack le risposte sono sempre JSON. I tipi non
+nativi (Decimal, datetime, ...) sono convertiti come fa Flask, quindi il
+contenuto delle risposte non dipende dalle librerie installate.
+"""
+
+from flask import has_request_context, request
+from flask.json.provider import DefaultJSONProvider
+from config import Config
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK_MIMETYPES = ('application/msgpack', 'application/x-msgpack')
+MSGPACK = msgpack is not None
+
+
+class Rows:
+    """Risultato di una query come nomi delle colonne e tuple, senza un dict per riga.
+    Viene codificato come {"columns": [...], "rows": [[...], ...]}."""
+
+    __slots__ = ('columns', 'rows')
+
+    def __init__(self, columns, rows):
+        self.columns = columns
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+def default(value):
+    """Conversione dei tipi non nativi: Rows più quelli di Flask (Decimal come stringa, date HTTP)"""
+    if isinstance(value, Rows):
+        return {"columns": value.columns, "rows": value.rows}
+    return DefaultJSONProvider.default(value)
+
+
+def packb(obj):
+    """Codifica MessagePack (richiede msgpack)"""
+    return msgpack.packb(obj, default=default, use_bin_type=True)
+
+
+def wants_msgpack():
+    """True se l'header Accept della richiesta preferisce MessagePack a JSON"""
+    if not MSGPACK or not has_request_context():
+        return False
+    best = request.accept_mimetypes.best_match(('application/json',) + MSGPACK_MIMETYPES)
+    return best in MSGPACK_MIMETYPES
+
+
+class JSONProvider(DefaultJSONProvider):
+    """Provider JSON di Flask basato su orjson, con MessagePack per i client che lo chiedono"""
+
+    default = staticmethod(default)
+    # Con Flask 3 JSON_SORT_KEYS va impostato sul provider
+    sort_keys = Config.JSON_SORT_KEYS
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or set(kwargs) - {'separators', 'indent'}:
+            return super().dumps(obj, **kwargs)
+        return self.dumpb(obj, kwargs.get('indent')).decode('utf-8')
+
+    def dumpb(self, obj, indent=None):
+        """Come dumps() in forma compatta, ma ritorna direttamente i byte UTF-8"""
+        if orjson is None:
+            separators = None if indent else (',', ':')
+            return super().dumps(obj, indent=indent, separators=separators).encode('utf-8')
+        # Le date passano da default() per restare nel formato di Flask
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=self.default, option=option)
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        if wants_msgpack():
+            response = self._app.response_class(packb(obj), mimetype=MSGPACK_MIMETYPES[0])
+        else:
+            indent = 2 if self.compact is False or (self.compact is None and self._app.debug) else None
+            response = self._app.response_class(self.dumpb(obj, indent) + b'\n', mimetype=self.mimetype)
+        if MSGPACK:
+            # La stessa URL può rispondere in due formati: le cache devono distinguerli
+            response.vary.add('Accept')
+        return response
@@ -0,0 +1,66 @@
+import queue
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    """Coda di eventi di un singolo client, con capacità limitata"""
+
+    def __init__(self, buffer_size):
+        self.queue = queue.Queue(maxsize=buffer_size)
+        self.closed = False
+
+    def get(self, timeout=None):
+        """Ritorna il prossimo evento o None se non arriva nulla entro `timeout`"""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class EventBroker:
+    """Pub/sub in-process per gli eventi degli ordini.
+
+    Ogni evento viene serializzato una sola volta in `publish` e lo stesso
+    payload viene accodato a tutti gli iscritti. Un client troppo lento da
+    svuotare la propria coda viene disconnesso (closed=True): al riconnettersi
+    riceverà un nuovo snapshot invece di bloccare gli altri.
+    """
+
+    def __init__(self, buffer_size=100):
+        self.buffer_size = buffer_size
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self):
+        subscription = Subscription(self.buffer_size)
+        with self._lock:
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def publish(self, payload):
+        """Accoda un evento già serializzato a tutti gli iscritti"""
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            try:
+                subscription.queue.put_nowait(payload)
+            except queue.Full:
+                logger.warning("Dropping slow event subscriber")
+                subscription.closed = True
+                self.unsubscribe(subscription)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+
+def format_sse(event, data):
+    """Formatta un evento Server-Sent Events (data è già una stringa JSON)"""
+    return f"event: {event}\ndata: {data}\n\n"
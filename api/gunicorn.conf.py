@@ -0,0 +1,46 @@
+# Configurazione gunicorn: gunicorn -c gunicorn.conf.py wsgi:app
+# Ricarica senza downtime: kill -HUP <pid master> (i worker terminano le richieste in corso)
+import os
+import subprocess
+import sys
+
+# Il master non deve tenere app, config né le variabili di .env: i worker nati da un
+# kill -HUP devono importare il codice nuovo e rileggere .env (load_dotenv non sovrascrive)
+_environ = dict(os.environ)
+from config import Config  # noqa: E402
+sys.modules.pop('config')
+os.environ.clear()
+os.environ.update(_environ)
+
+bind = f"{Config.HOST}:{Config.PORT}"
+# Default 1: gli eventi SSE sono pubblicati solo agli stream aperti sullo stesso worker
+workers = Config.WEB_WORKERS
+# gthread: ogni worker serve più richieste in parallelo (anche gli stream SSE occupano un thread)
+worker_class = 'gthread'
+threads = Config.WEB_THREADS
+keepalive = Config.WEB_KEEPALIVE
+timeout = Config.WEB_TIMEOUT
+graceful_timeout = Config.WEB_GRACEFUL_TIMEOUT
+# Riciclo periodico dei worker (0 = disattivato), con jitter per non riavviarli tutti insieme
+max_requests = Config.WEB_MAX_REQUESTS
+max_requests_jitter = Config.WEB_MAX_REQUESTS // 10
+accesslog = '-'
+
+
+def migrate():
+    """Applica le migrazioni (su tutti gli shard) in un processo separato, senza importare app nel master"""
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'migrate'],
+                   cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+
+
+def on_starting(server):
+    """Migrazioni una sola volta, prima di avviare i worker: se falliscono il server non parte"""
+    migrate()
+
+
+def on_reload(server):
+    """Dopo kill -HUP i nuovi worker possono portare nuove migrazioni"""
+    try:
+        migrate()
+    except subprocess.CalledProcessError as e:
+        server.log.error(f"Migrations failed on reload, new workers use the current schema: {e}")
@@ -0,0 +1,53 @@
+"""Header Idempotency-Key per POST /api/orders.
+
+Un totem che ripete un ordine dopo un timeout invia la stessa chiave: la
+prima richiesta crea l'ordine, le successive ricevono la stessa risposta
+senza rieseguire gli INSERT. La chiave è registrata nella tabella
+`idempotency_keys` (per negozio) nella stessa transazione dell'ordine (valida per tutti i
+worker); una cache in memoria limitata risponde ai retry senza database.
+"""
+
+import hashlib
+import json
+from cache import TTLCache
+
+HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+MAX_KEY_LENGTH = 255
+
+
+class IdempotencyKeyMismatch(Exception):
+    """La chiave è già stata usata per una richiesta con un corpo diverso"""
+
+    def __init__(self):
+        super().__init__(f"{HEADER} already used for a different request")
+
+
+def validate_key(key):
+    """Ritorna la chiave ripulita; ValueError se vuota o troppo lunga"""
+    key = key.strip()
+    if not key or len(key) > MAX_KEY_LENGTH or not key.isprintable():
+        raise ValueError(f"{HEADER} must be 1-{MAX_KEY_LENGTH} printable characters")
+    return key
+
+
+def fingerprint(payload):
+    """Impronta del corpo della richiesta: la stessa chiave con un corpo diverso è un errore del client"""
+    canonical = json.dumps(payload, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class IdempotencyCache(TTLCache):
+    """Risposte già inviate per negozio e chiave: LRU limitata con scadenza (TTL)"""
+
+    def lookup(self, store_id, key, request_fingerprint):
+        """Ritorna il corpo della risposta originale o None; IdempotencyKeyMismatch se il corpo differisce"""
+        entry = self.get(('key', store_id, key))
+        if entry is None:
+            return None
+        if entry[0] != request_fingerprint:
+            raise IdempotencyKeyMismatch()
+        return entry[1]
+
+    def remember(self, store_id, key, request_fingerprint, body):
+        self.set(('key', store_id, key), (request_fingerprint, body))
@@ -0,0 +1,163 @@
+"""Immagini dei prodotti: archivio indirizzato per contenuto e varianti ridimensionate.
+
+L'immagine caricata e le sue varianti (miniatura, riquadro del totem, WebP) sono
+file il cui nome è lo SHA-256 del contenuto: un file non cambia mai, quindi può
+essere servito con cache immutabile. Le varianti sono generate in background da
+un pool di thread. Pillow è opzionale: senza, viene salvato solo l'originale.
+"""
+
+import hashlib
+import io
+import logging
+import os
+import re
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+PILLOW = Image is not None
+
+logger = logging.getLogger(__name__)
+
+ORIGINAL = 'original'
+
+# Variante -> (lato massimo in pixel, formato Pillow)
+VARIANTS = {
+    'thumb': (160, 'JPEG'),
+    'tile': (480, 'JPEG'),
+    'tile_webp': (480, 'WEBP'),
+}
+
+# Formato -> (estensione, mimetype)
+FORMATS = {
+    'JPEG': ('jpg', 'image/jpeg'),
+    'PNG': ('png', 'image/png'),
+    'WEBP': ('webp', 'image/webp'),
+}
+MIMETYPES = {extension: mimetype for extension, mimetype in FORMATS.values()}
+
+NAME_PATTERN = re.compile(r'^[0-9a-f]{64}\.(jpg|png|webp)$')
+
+
+def sniff_format(data):
+    """Formato dell'immagine dai primi byte (None se non è JPEG, PNG o WebP)"""
+    if data.startswith(b'\xff\xd8\xff'):
+        return 'JPEG'
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'PNG'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'WEBP'
+    return None
+
+
+def image_urls(base_url, files):
+    """{variante: file} -> {variante: URL}"""
+    return {variant: f"{base_url}/{name}" for variant, name in files.items()}
+
+
+def attach_images(products, rows, base_url):
+    """Aggiunge a ogni prodotto `images` ({variante: URL}) dalle righe di product_images"""
+    files = {}
+    for row in rows:
+        files.setdefault(row['product_id'], {})[row['variant']] = row['file']
+    for product in products:
+        product['images'] = image_urls(base_url, files.get(product['id'], {}))
+    return products
+
+
+class ImageStore:
+    """File su disco con nome = SHA-256 del contenuto, in sottocartelle per prefisso"""
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def path(self, name):
+        """Percorso del file `name`, o None se il nome non è valido"""
+        if not NAME_PATTERN.match(name):
+            return None
+        return os.path.join(self.root, name[:2], name)
+
+    def put(self, data, image_format):
+        """Salva i byte (se non già presenti) e ritorna il nome del file"""
+        name = f"{hashlib.sha256(data).hexdigest()}.{FORMATS[image_format][0]}"
+        path = self.path(name)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Scrittura atomica: un lettore non vede mai un file a metà
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        return name
+
+    def read(self, name):
+        with open(self.path(name), 'rb') as f:
+            return f.read()
+
+
+def render_variants(store, name):
+    """Genera le varianti dell'originale `name`: {variante: (file, larghezza, altezza)}"""
+    if not PILLOW:
+        return {}
+    with Image.open(io.BytesIO(store.read(name))) as source:
+        # Le foto dei telefoni sono spesso ruotate solo tramite EXIF
+        image = ImageOps.exif_transpose(source)
+        image.load()
+    if image.mode in ('RGBA', 'LA', 'P'):
+        # JPEG non ha trasparenza: sfondo bianco
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        image = background
+    elif image.mode != 'RGB':
+        image = image.convert('RGB')
+    variants = {}
+    for variant, (size, image_format) in VARIANTS.items():
+        resized = image.copy()
+        resized.thumbnail((size, size), Image.LANCZOS)
+        buffer = io.BytesIO()
+        if image_format == 'JPEG':
+            resized.save(buffer, 'JPEG', quality=82, optimize=True, progressive=True)
+        else:
+            resized.save(buffer, image_format, quality=80, method=4)
+        variants[variant] = (store.put(buffer.getvalue(), image_format), resized.width, resized.height)
+    return variants
+
+
+class ImagePipeline:
+    """Pool di thread che genera le varianti e le passa a `on_done(product_id, originale, varianti)`"""
+
+    def __init__(self, store, on_done, workers=2):
+        self.store = store
+        self.on_done = on_done
+        self.workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def submit(self, product_id, name):
+        # Il pool viene creato al primo utilizzo: con gunicorn ogni worker (dopo la fork) ha il proprio
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='images')
+        return self._executor.submit(self.process, product_id, name)
+
+    def process(self, product_id, name):
+        """Genera le varianti di un originale (nel thread chiamante)"""
+        try:
+            variants = render_variants(self.store, name)
+            if variants:
+                self.on_done(product_id, name, variants)
+            return variants
+        except Exception as e:
+            # L'originale resta servito: le varianti si possono rigenerare con `flask rebuild-images`
+            logger.error(f"Error processing image {name} of product {product_id}: {e}")
+            return None
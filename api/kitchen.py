@@ -0,0 +1,100 @@
+import threading
+import time
+from order_status import ACTIVE_STATUSES
+
+
+class KitchenQueue:
+    """Ordini attivi (pending/preparing/ready) tenuti in memoria per la cucina.
+
+    Le route aggiornano la coda a ogni creazione, cambio di stato o
+    eliminazione, così leggere la coda costa O(ordini attivi) e non
+    dipende dallo storico. Ogni `resync_interval` secondi la coda viene
+    ricaricata con `loader()` (una query sugli stati attivi, eseguita fuori dal
+    lock): con più worker gunicorn ognuno ha la propria copia e vede le
+    modifiche degli altri al più tardi alla risincronizzazione.
+    """
+
+    def __init__(self, loader, resync_interval=5):
+        self.loader = loader
+        self.resync_interval = resync_interval
+        self._orders = {}  # order_id -> ordine con articoli
+        self._synced_at = None
+        self._loaded = False
+        self._generation = 0  # cresce a ogni invalidate
+        self._pending = None  # modifiche arrivate durante una ricarica (None = nessuna ricarica)
+        self._lock = threading.Lock()
+        self._reloaded = threading.Condition(self._lock)
+
+    def snapshot(self):
+        """Ordini attivi ordinati per numero d'ordine"""
+        with self._lock:
+            stale = self._synced_at is None or time.monotonic() - self._synced_at >= self.resync_interval
+            reload = stale and self._pending is None
+            if reload:
+                self._pending = []
+                generation = self._generation
+            elif not self._loaded:
+                # Prima ricarica in corso in un altro thread: non c'è ancora una coda da mostrare
+                self._reloaded.wait_for(lambda: self._loaded or self._pending is None)
+        if reload:
+            self._reload(generation)
+        with self._lock:
+            return sorted(self._orders.values(), key=lambda order: order['order_number'])
+
+    def _reload(self, generation):
+        # La query gira senza lock: add/update_status/remove non aspettano il database.
+        # Le modifiche arrivate nel frattempo vengono riapplicate sopra lo stato ricaricato
+        try:
+            orders = {order['id']: order for order in self.loader()}
+        except BaseException:
+            with self._lock:
+                self._pending = None
+                self._reloaded.notify_all()
+            raise
+        with self._lock:
+            for change in self._pending:
+                change(orders)
+            self._orders = orders
+            self._pending = None
+            self._loaded = True
+            # Un invalidate durante la lettura può riguardare dati già letti: si ricarica ancora
+            self._synced_at = time.monotonic() if generation == self._generation else None
+            self._reloaded.notify_all()
+
+    def _apply(self, change):
+        # Da chiamare con il lock
+        change(self._orders)
+        if self._pending is not None:
+            self._pending.append(change)
+
+    def add(self, order):
+        """Aggiunge (o sostituisce) un ordine appena creato"""
+        if order['status'] not in ACTIVE_STATUSES:
+            return
+        def change(orders):
+            orders[order['id']] = order
+        with self._lock:
+            self._apply(change)
+
+    def update_status(self, order_id, status):
+        """Applica un cambio di stato: gli ordini conclusi o cancellati escono dalla coda"""
+        def change(orders):
+            order = orders.get(order_id)
+            if order is None:
+                return
+            if status in ACTIVE_STATUSES:
+                orders[order_id] = dict(order, status=status)
+            else:
+                del orders[order_id]
+        with self._lock:
+            self._apply(change)
+
+    def remove(self, order_id):
+        with self._lock:
+            self._apply(lambda orders: orders.pop(order_id, None))
+
+    def invalidate(self):
+        """Forza la ricarica alla prossima lettura"""
+        with self._lock:
+            self._synced_at = None
+            self._generation += 1
@@ -0,0 +1,70 @@
+import gzip
+import hashlib
+import threading
+import time
+
+
+class SnapshotEntry:
+    """Corpo JSON già serializzato (ed eventualmente compresso) con il suo ETag.
+    Il corpo gzip e `packed` (la stessa risposta in MessagePack) hanno ETag distinti:
+    un ETag forte identifica i byte inviati, non solo il contenuto."""
+
+    def __init__(self, body, compress, packed=None):
+        self.body = body
+        self.gzip_body = gzip.compress(body, compresslevel=6) if compress else None
+        self.etag = hashlib.sha256(body).hexdigest()[:32]
+        self.gzip_etag = f"{self.etag}-gz" if compress else None
+        self.packed = packed
+        self.packed_etag = hashlib.sha256(packed).hexdigest()[:32] if packed is not None else None
+        self.created_at = time.monotonic()
+
+
+class MenuSnapshot:
+    """Risposte del menu pre-serializzate, ricostruite solo dopo una scrittura sul catalogo.
+
+    Le voci sono legate alla `version` della MenuCache del wrapper: quando cambia
+    (create/update/delete su categorie o prodotti) lo snapshot viene scartato.
+    Il TTL limita il ritardo con cui si vedono le scritture fatte da altri processi.
+    """
+
+    def __init__(self, menu_cache, dumps, ttl=300, compress=True, packb=None):
+        self.menu_cache = menu_cache
+        self.dumps = dumps
+        # Con packb lo snapshot viene serializzato anche in MessagePack
+        self.packb = packb
+        self.ttl = ttl
+        self.compress = compress
+        self._entries = {}
+        self._version = menu_cache.version
+        self._lock = threading.Lock()
+
+    def get(self, key, loader):
+        """Ritorna lo SnapshotEntry di `key`, costruendolo con `loader()` se necessario.
+        Ritorna None se il loader non trova dati."""
+        entry, version = self._lookup(key)
+        if entry is not None:
+            return entry
+        return self._store(key, loader(), version)
+
+    def _lookup(self, key):
+        version = self.menu_cache.version
+        with self._lock:
+            if version != self._version:
+                self._entries.clear()
+                self._version = version
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry.created_at < self.ttl:
+                return entry, version
+        return None, version
+
+    def _store(self, key, data, version):
+        if data is None:
+            return None
+        body = self.dumps(data)
+        packed = self.packb(data) if self.packb is not None else None
+        entry = SnapshotEntry(body.encode('utf-8') if isinstance(body, str) else body, self.compress, packed)
+        with self._lock:
+            # Se il catalogo è cambiato durante il caricamento non salviamo dati vecchi
+            if self.menu_cache.version == version == self._version:
+                self._entries[key] = entry
+        return entry
@@ -0,0 +1,219 @@
+"""Strumentazione delle richieste: query al database, tempi e metriche Prometheus.
+
+Ogni richiesta ha un `RequestStats` (in un ContextVar, così lo vedono anche le
+view async) in cui i wrapper del database sommano numero di query e tempo.
+Le metriche sono per processo: con gunicorn ogni worker espone le proprie.
+"""
+
+import functools
+import inspect
+import threading
+import time
+import logging
+from bisect import bisect_left
+from contextvars import ContextVar
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Bucket (secondi) degli istogrammi di latenza, come i default di prometheus_client
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class RequestStats:
+    """Contatori della richiesta corrente"""
+
+    __slots__ = ('started', 'queries', 'db_time')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+
+_current = ContextVar('request_stats', default=None)
+
+
+def start_request():
+    """Inizia la raccolta per la richiesta corrente e ritorna i suoi contatori"""
+    stats = RequestStats()
+    _current.set(stats)
+    return stats
+
+
+def current_request():
+    return _current.get()
+
+
+def record_query(label, elapsed):
+    """Somma una query alla richiesta corrente e la registra se supera SLOW_QUERY_MS"""
+    stats = _current.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_time += elapsed
+    db_queries.inc()
+    db_query_seconds.inc(elapsed)
+    if Config.SLOW_QUERY_MS and elapsed * 1000 >= Config.SLOW_QUERY_MS:
+        logger.warning(f"Slow query ({elapsed * 1000:.1f} ms): {' '.join(label.split())[:500]}")
+
+
+def _label(args):
+    # execute_*(query, ...) o run_in_transaction(work): il testo SQL o il nome della funzione
+    target = args[0] if args else None
+    if isinstance(target, str):
+        return target
+    return f"transaction {getattr(target, '__qualname__', target)}"
+
+
+def timed_query(method):
+    """Decoratore per i metodi execute_*/run_in_transaction dei wrapper: misura ogni chiamata"""
+    if inspect.iscoroutinefunction(method):
+        @functools.wraps(method)
+        async def async_wrapper(self, *args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await method(self, *args, **kwargs)
+            finally:
+                record_query(_label(args), time.perf_counter() - started)
+        return async_wrapper
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            record_query(_label(args), time.perf_counter() - started)
+    return wrapper
+
+
+def server_timing(stats):
+    """Valore dell'header Server-Timing (millisecondi)"""
+    return (f'db;dur={stats.db_time * 1000:.1f};desc="{stats.queries} queries", '
+            f'app;dur={stats.elapsed * 1000:.1f}')
+
+
+# ==================== METRICHE PROMETHEUS ====================
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Contatore monotono con etichette"""
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, *values):
+        with self._lock:
+            self._values[values] = self._values.get(values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for values, total in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, values)} {_number(total)}")
+        return lines
+
+
+class Histogram:
+    """Istogramma cumulativo con etichette (bucket fissi)"""
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}  # etichette -> [conteggi per bucket (+Inf incluso), somma]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *values):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(values)
+            if series is None:
+                series = self._series[values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        names = self.labels + ('le',)
+        with self._lock:
+            for values, (counts, total) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{_format_labels(names, values + (_number(bound),))} {cumulative}")
+                labels = _format_labels(self.labels, values)
+                lines.append(f"{self.name}_sum{labels} {_number(total)}")
+                lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+def collected(name, help, samples, labels=(), kind='gauge'):
+    """Righe di una metrica letta al momento dello scrape: samples è [(valori etichette, valore)]"""
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    for values, value in samples:
+        lines.append(f"{name}{_format_labels(labels, values)} {_number(value)}")
+    return lines
+
+
+# Totali di processo delle query (anche fuori dalle richieste, es. migrazioni)
+db_queries = Counter('db_queries_total', 'Database calls made through the wrappers')
+db_query_seconds = Counter('db_query_seconds_total', 'Time spent in database calls')
+
+request_latency = Histogram(
+    'http_request_duration_seconds', 'HTTP request latency by route',
+    labels=('method', 'route', 'status')
+)
+request_queries = Histogram(
+    'http_request_db_queries', 'Database calls per HTTP request by route',
+    labels=('method', 'route'), buckets=QUERY_BUCKETS
+)
+request_db_time = Histogram(
+    'http_request_db_seconds', 'Database time per HTTP request by route',
+    labels=('method', 'route')
+)
+
+
+def observe_request(method, route, status, stats):
+    """Registra negli istogrammi una richiesta conclusa"""
+    request_latency.observe(stats.elapsed, method, route, str(status))
+    request_queries.observe(stats.queries, method, route)
+    request_db_time.observe(stats.db_time, method, route)
+
+
+def render(*extra):
+    """Testo Prometheus delle metriche di processo più i blocchi in `extra` (liste di righe)"""
+    lines = []
+    for metric in (request_latency, request_queries, request_db_time, db_queries, db_query_seconds):
+        lines.extend(metric.render())
+    for block in extra:
+        lines.extend(block)
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,370 @@
+import logging
+from analytics import TABLES as ANALYTICS_TABLES, TABLE_NAMES as ANALYTICS_TABLE_NAMES, rebuild_statements
+
+logger = logging.getLogger(__name__)
+
+PLACEHOLDERS = {'mysql': '%s', 'sqlite': '?'}
+
+# Dati di esempio di un database nuovo: (nome, descrizione) e (nome, descrizione, prezzo, categoria)
+SAMPLE_CATEGORIES = [
+    ('Panini', 'Panini freschi e gustosi'),
+    ('Bevande', 'Bevande fredde e calde'),
+    ('Menu', 'Menu completi'),
+    ('Dolci', 'Dolci e dessert'),
+]
+SAMPLE_PRODUCTS = [
+    ('Hamburger Classico', 'Pane, carne, pomodoro, lattuga, cipolla', 7.50, 'Panini'),
+    ('Cheeseburger', 'Con formaggio cheddar premium', 8.50, 'Panini'),
+    ('Veggie Burger', 'Panino vegetariano con verdure grigliate', 7.00, 'Panini'),
+    ('Coca Cola', 'Lattina 33cl', 2.50, 'Bevande'),
+    ('Acqua Naturale', 'Bottiglia 50cl', 1.50, 'Bevande'),
+    ('Birra', 'Birra artigianale 33cl', 4.00, 'Bevande'),
+    ('Menu Combo', 'Hamburger + Patatine + Bevanda', 12.00, 'Menu'),
+    ('Menu Deluxe', 'Cheeseburger + Patatine + Bevanda + Dolce', 15.00, 'Menu'),
+    ('Tiramisù', 'Dolce tradizionale italiano', 4.50, 'Dolci'),
+    ('Gelato', 'Gelato assortito', 3.50, 'Dolci'),
+]
+
+
+def _literal(value):
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    return repr(value)
+
+
+def _rows(rows, columns):
+    """SELECT ... UNION ALL SELECT ... con una riga per tupla (stessa sintassi in SQLite e MySQL)"""
+    return " UNION ALL ".join(
+        "SELECT " + ", ".join(f"{_literal(value)} AS {column}" for value, column in zip(row, columns))
+        for row in rows
+    )
+
+
+# Le tabelle vuote ricevono i dati di esempio; un database esistente non viene toccato
+SAMPLE_DATA = [
+    f"""INSERT INTO categories (name, description)
+        SELECT s.name, s.description FROM ({_rows(SAMPLE_CATEGORIES, ('name', 'description'))}) s
+        WHERE NOT EXISTS (SELECT 1 FROM categories)""",
+    f"""INSERT INTO products (name, description, price, category_id)
+        SELECT s.name, s.description, s.price, c.id
+        FROM ({_rows(SAMPLE_PRODUCTS, ('name', 'description', 'price', 'category'))}) s
+        JOIN categories c ON c.name = s.category
+        WHERE NOT EXISTS (SELECT 1 FROM products)""",
+]
+
+# Ogni migrazione ha una versione crescente e le istruzioni per ciascun dialetto.
+# Le migrazioni già applicate sono registrate in schema_migrations e non vengono rieseguite.
+MIGRATIONS = [
+    {
+        'version': 1,
+        'description': 'Schema di base, dati di esempio e indici per le query più frequenti',
+        # Le tabelle di base esistono già nei database creati prima delle migrazioni
+        'sqlite': [
+            """CREATE TABLE IF NOT EXISTS categories (
+                   id INTEGER PRIMARY KEY AUTOINCREMENT,
+                   name TEXT UNIQUE NOT NULL,
+                   description TEXT
+               )""",
+            """CREATE TABLE IF NOT EXISTS products (
+                   id INTEGER PRIMARY KEY AUTOINCREMENT,
+                   name TEXT NOT NULL,
+                   description TEXT,
+                   price REAL NOT NULL,
+                   image_url TEXT,
+                   category_id INTEGER NOT NULL,
+                   FOREIGN KEY(category_id) REFERENCES categories(id)
+               )""",
+            """CREATE TABLE IF NOT EXISTS orders (
+                   id INTEGER PRIMARY KEY AUTOINCREMENT,
+                   order_number INTEGER UNIQUE NOT NULL,
+                   status TEXT DEFAULT 'pending',
+                   total_price REAL NOT NULL,
+                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                   updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+               )""",
+            """CREATE TABLE IF NOT EXISTS order_items (
+                   id INTEGER PRIMARY KEY AUTOINCREMENT,
+                   order_id INTEGER NOT NULL,
+                   product_id INTEGER NOT NULL,
+                   quantity INTEGER NOT NULL DEFAULT 1,
+                   unit_price REAL NOT NULL,
+                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                   FOREIGN KEY(order_id) REFERENCES orders(id),
+                   FOREIGN KEY(product_id) REFERENCES products(id)
+               )""",
+            *SAMPLE_DATA,
+            "CREATE INDEX IF NOT EXISTS idx_order_items_order_id ON order_items(order_id)",
+            "CREATE INDEX IF NOT EXISTS idx_products_category_id ON products(category_id)",
+            "CREATE INDEX IF NOT EXISTS idx_orders_created_at ON orders(created_at)",
+            "CREATE INDEX IF NOT EXISTS idx_orders_status ON orders(status)",
+            # orders.order_number è UNIQUE: SQLite lo indicizza già (sqlite_autoindex_orders_1)
+        ],
+        # In MySQL gli indici sono nelle CREATE TABLE (idx_status, idx_created_at, idx_product_category,
+        # UNIQUE su order_number) o vengono dalle foreign key (order_items.order_id). Il nome
+        # dell'indice UNIQUE su order_number (quello della colonna) è usato dalla migrazione 6
+        'mysql': [
+            """CREATE TABLE IF NOT EXISTS categories (
+                   id INT AUTO_INCREMENT PRIMARY KEY,
+                   name VARCHAR(100) NOT NULL UNIQUE,
+                   description TEXT,
+                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                   updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+               ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci""",
+            """CREATE TABLE IF NOT EXISTS products (
+                   id INT AUTO_INCREMENT PRIMARY KEY,
+                   name VARCHAR(150) NOT NULL,
+                   description TEXT,
+                   price DECIMAL(10, 2) NOT NULL,
+                   image_url VARCHAR(255),
+                   category_id INT NOT NULL,
+                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                   updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                   FOREIGN KEY (category_id) REFERENCES categories(id) ON DELETE CASCADE,
+                   UNIQUE KEY unique_product_per_category (name, category_id),
+                   INDEX idx_product_category (category_id)
+               ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci""",
+            """CREATE TABLE IF NOT EXISTS orders (
+                   id INT AUTO_INCREMENT PRIMARY KEY,
+                   order_number INT UNIQUE NOT NULL,
+                   status ENUM('pending', 'preparing', 'ready', 'completed', 'cancelled') DEFAULT 'pending',
+                   total_price DECIMAL(10, 2) NOT NULL,
+                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                   updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                   INDEX idx_status (status),
+                   INDEX idx_created_at (created_at)
+               ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci""",
+            """CREATE TABLE IF NOT EXISTS order_items (
+                   id INT AUTO_INCREMENT PRIMARY KEY,
+                   order_id INT NOT NULL,
+                   product_id INT NOT NULL,
+                   quantity INT NOT NULL DEFAULT 1,
+                   unit_price DECIMAL(10, 2) NOT NULL,
+                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                   FOREIGN KEY (order_id) REFERENCES orders(id) ON DELETE CASCADE,
+                   FOREIGN KEY (product_id) REFERENCES products(id) ON DELETE RESTRICT
+               ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci""",
+            *SAMPLE_DATA,
+        ],
+    },
+    {
+        'version': 2,
+        'description': 'Contatore dei numeri ordine',
+        'sqlite': [
+            "CREATE TABLE IF NOT EXISTS order_counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)",
+            """INSERT OR IGNORE INTO order_counters (name, value)
+               SELECT 'orders', COALESCE(MAX(order_number), 0) FROM orders""",
+        ],
+        'mysql': [
+            """CREATE TABLE IF NOT EXISTS order_counters (
+                   name VARCHAR(50) PRIMARY KEY,
+                   value INT NOT NULL
+               ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4""",
+            """INSERT IGNORE INTO order_counters (name, value)
+               SELECT 'orders', COALESCE(MAX(order_number), 0) FROM orders""",
+        ],
+    },
+    {
+        'version': 3,
+        'description': 'Prodotti univoci per nome e categoria (upsert dell\'import del catalogo)',
+        'sqlite': [
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_products_name_category ON products(name, category_id)",
+        ],
+        # In MySQL c'è già UNIQUE KEY unique_product_per_category (name, category_id) dalla migrazione 1
+        'mysql': [],
+    },
+    {
+        'version': 4,
+        'description': 'Rollup delle vendite (analytics)',
+        # Le tabelle sono ora create (per negozio) dalla migrazione 8: gli ordini hanno
+        # store_id solo dalla migrazione 6
+        'sqlite': [],
+        'mysql': [],
+    },
+    {
+        'version': 5,
+        'description': 'Chiavi di idempotenza degli ordini',
+        'sqlite': [
+            """CREATE TABLE IF NOT EXISTS idempotency_keys (
+                   idempotency_key TEXT PRIMARY KEY,
+                   fingerprint TEXT NOT NULL,
+                   order_id INTEGER,
+                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+               )""",
+            "CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created_at ON idempotency_keys(created_at)",
+        ],
+        'mysql': [
+            """CREATE TABLE IF NOT EXISTS idempotency_keys (
+                   idempotency_key VARCHAR(255) PRIMARY KEY,
+                   fingerprint CHAR(64) NOT NULL,
+                   order_id INT NULL,
+                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                   INDEX idx_created_at (created_at)
+               ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4""",
+        ],
+    },
+    {
+        'version': 6,
+        'description': 'Negozi: store_id su ordini e chiavi di idempotenza, prezzi per negozio',
+        # Gli ordini esistenti appartengono al negozio 1. SQLite non può modificare un vincolo
+        # UNIQUE: le tabelle vengono ricreate e copiate (con i loro indici)
+        'sqlite': [
+            """CREATE TABLE orders_new (
+                   id INTEGER PRIMARY KEY AUTOINCREMENT,
+                   store_id INTEGER NOT NULL DEFAULT 1,
+                   order_number INTEGER NOT NULL,
+                   status TEXT DEFAULT 'pending',
+                   total_price REAL NOT NULL,
+                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                   updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                   UNIQUE (store_id, order_number)
+               )""",
+            """INSERT INTO orders_new (id, store_id, order_number, status, total_price, created_at, updated_at)
+               SELECT id, 1, order_number, status, total_price, created_at, updated_at FROM orders""",
+            # Gli id degli ordini eliminati non vanno riassegnati
+            """UPDATE sqlite_sequence SET seq = (SELECT seq FROM sqlite_sequence WHERE name = 'orders')
+               WHERE name = 'orders_new' AND EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'orders')""",
+            "DROP TABLE orders",
+            "ALTER TABLE orders_new RENAME TO orders",
+            "CREATE INDEX IF NOT EXISTS idx_orders_store_status ON orders(store_id, status)",
+            "CREATE INDEX IF NOT EXISTS idx_orders_store_created_at ON orders(store_id, created_at)",
+            "UPDATE order_counters SET name = 'orders:1' WHERE name = 'orders'",
+            """CREATE TABLE idempotency_keys_new (
+                   store_id INTEGER NOT NULL DEFAULT 1,
+                   idempotency_key TEXT NOT NULL,
+                   fingerprint TEXT NOT NULL,
+                   order_id INTEGER,
+                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                   PRIMARY KEY (store_id, idempotency_key)
+               )""",
+            """INSERT INTO idempotency_keys_new (store_id, idempotency_key, fingerprint, order_id, created_at)
+               SELECT 1, idempotency_key, fingerprint, order_id, created_at FROM idempotency_keys""",
+            "DROP TABLE idempotency_keys",
+            "ALTER TABLE idempotency_keys_new RENAME TO idempotency_keys",
+            "CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created_at ON idempotency_keys(created_at)",
+            # Prezzo (NULL = quello del catalogo) e disponibilità di un prodotto in un negozio
+            """CREATE TABLE IF NOT EXISTS store_products (
+                   store_id INTEGER NOT NULL,
+                   product_id INTEGER NOT NULL,
+                   price REAL,
+                   available INTEGER NOT NULL DEFAULT 1,
+                   PRIMARY KEY (store_id, product_id),
+                   FOREIGN KEY(product_id) REFERENCES products(id)
+               )""",
+        ],
+        'mysql': [
+            # L'indice UNIQUE su order_number creato dalla migrazione 1 ha il nome della colonna
+            """ALTER TABLE orders
+                   ADD COLUMN store_id INT NOT NULL DEFAULT 1 AFTER id,
+                   DROP INDEX order_number,
+                   ADD UNIQUE KEY unique_order_number_per_store (store_id, order_number),
+                   ADD INDEX idx_store_status (store_id, status),
+                   ADD INDEX idx_store_created_at (store_id, created_at)""",
+            "UPDATE order_counters SET name = 'orders:1' WHERE name = 'orders'",
+            """ALTER TABLE idempotency_keys
+                   ADD COLUMN store_id INT NOT NULL DEFAULT 1 FIRST,
+                   DROP PRIMARY KEY,
+                   ADD PRIMARY KEY (store_id, idempotency_key)""",
+            """CREATE TABLE IF NOT EXISTS store_products (
+                   store_id INT NOT NULL,
+                   product_id INT NOT NULL,
+                   price DECIMAL(10, 2) NULL,
+                   available BOOLEAN NOT NULL DEFAULT TRUE,
+                   PRIMARY KEY (store_id, product_id),
+                   FOREIGN KEY (product_id) REFERENCES products(id) ON DELETE CASCADE
+               ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4""",
+        ],
+    },
+    {
+        'version': 7,
+        'description': 'Immagini dei prodotti e loro varianti',
+        # Una riga per variante ('original', 'thumb', ...): `file` è il nome nell'archivio immagini
+        'sqlite': [
+            """CREATE TABLE IF NOT EXISTS product_images (
+                   product_id INTEGER NOT NULL,
+                   variant TEXT NOT NULL,
+                   file TEXT NOT NULL,
+                   width INTEGER,
+                   height INTEGER,
+                   PRIMARY KEY (product_id, variant),
+                   FOREIGN KEY(product_id) REFERENCES products(id)
+               )""",
+        ],
+        'mysql': [
+            """CREATE TABLE IF NOT EXISTS product_images (
+                   product_id INT NOT NULL,
+                   variant VARCHAR(20) NOT NULL,
+                   file VARCHAR(80) NOT NULL,
+                   width INT NULL,
+                   height INT NULL,
+                   PRIMARY KEY (product_id, variant),
+                   FOREIGN KEY (product_id) REFERENCES products(id) ON DELETE CASCADE
+               ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4""",
+        ],
+    },
+    {
+        'version': 8,
+        'description': 'Rollup delle vendite per negozio',
+        # Le tabelle della migrazione 4 sommavano tutti i negozi dello shard: vengono ricreate
+        # con store_id nella chiave e ripopolate con lo storico degli ordini
+        'sqlite': [f"DROP TABLE IF EXISTS {table}" for table in ANALYTICS_TABLE_NAMES]
+                  + ANALYTICS_TABLES['sqlite'] + rebuild_statements('sqlite'),
+        'mysql': [f"DROP TABLE IF EXISTS {table}" for table in ANALYTICS_TABLE_NAMES]
+                 + ANALYTICS_TABLES['mysql'] + rebuild_statements('mysql'),
+    },
+]
+
+
+def _create_migrations_table(db):
+    if db.dialect == 'mysql':
+        db.execute_update("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INT PRIMARY KEY,
+                description VARCHAR(255) NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+        """)
+    else:
+        db.execute_update("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+
+def _apply(db, migration):
+    record = (
+        f"INSERT INTO schema_migrations (version, description) VALUES ({PLACEHOLDERS[db.dialect]}, "
+        f"{PLACEHOLDERS[db.dialect]})",
+        (migration['version'], migration['description'])
+    )
+    if db.dialect == 'sqlite':
+        # In SQLite anche il DDL è transazionale: istruzioni e registrazione della versione
+        # vengono salvate insieme, una migrazione interrotta non lascia lo schema a metà
+        def work(cursor):
+            for statement in migration['sqlite']:
+                cursor.execute(statement)
+            cursor.execute(*record)
+
+        db.run_in_transaction(work)
+        return
+    # MySQL fa un COMMIT implicito a ogni istruzione DDL: non c'è una transazione da usare
+    for statement in migration[db.dialect]:
+        db.execute_update(statement)
+    db.execute_update(*record)
+
+
+def apply_migrations(db):
+    """Applica le migrazioni mancanti e ritorna le versioni applicate"""
+    applied = []
+    with db.session():
+        _create_migrations_table(db)
+        done = {row['version'] for row in db.execute_query("SELECT version FROM schema_migrations")}
+        for migration in MIGRATIONS:
+            if migration['version'] in done:
+                continue
+            logger.info(f"Applying migration {migration['version']}: {migration['description']}")
+            _apply(db, migration)
+            applied.append(migration['version'])
+    return applied
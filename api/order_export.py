@@ -0,0 +1,49 @@
+import zlib
+
+# Colonne dell'export: NDJSON ha un oggetto per ordine con gli articoli annidati,
+# CSV una riga per articolo con i dati dell'ordine ripetuti
+ORDER_FIELDS = ['id', 'order_number', 'status', 'total_price', 'created_at', 'updated_at', 'items']
+ITEM_FIELDS = ['product_id', 'product_name', 'quantity', 'unit_price']
+CSV_FIELDS = ['order_id', 'order_number', 'status', 'total_price', 'created_at', 'updated_at'] + ITEM_FIELDS
+
+CHUNK_SIZE = 64 * 1024
+
+
+def group_orders(rows):
+    """Raggruppa le righe ordine+articolo (ordinate per ordine) in un dict per ordine.
+    Tiene in memoria un solo ordine alla volta."""
+    order = None
+    for row in rows:
+        if order is None or order['id'] != row['order_id']:
+            if order is not None:
+                yield order
+            order = {'id': row['order_id'], **{field: row[field] for field in ORDER_FIELDS[1:-1]}, 'items': []}
+        # Un ordine senza articoli ha una sola riga con le colonne dell'articolo a NULL
+        if row['product_id'] is not None:
+            order['items'].append({field: row[field] for field in ITEM_FIELDS})
+    if order is not None:
+        yield order
+
+
+def chunked(lines, size=CHUNK_SIZE):
+    """Accorpa le righe in blocchi da ~64 KB: una scrittura sul socket per blocco, non per riga"""
+    buffer = []
+    length = 0
+    for line in lines:
+        buffer.append(line)
+        length += len(line)
+        if length >= size:
+            yield ''.join(buffer)
+            buffer, length = [], 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+def gzip_stream(chunks, level=6):
+    """Comprime in streaming (formato gzip) i blocchi di testo"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk.encode('utf-8'))
+        if compressed:
+            yield compressed
+    yield compressor.flush()
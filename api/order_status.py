@@ -0,0 +1,43 @@
+"""Stati di un ordine e transizioni ammesse.
+
+pending → preparing → ready → completed, con `cancelled` raggiungibile da ogni
+stato attivo. `completed` e `cancelled` sono finali. `delivered` è accettato
+come sinonimo di `completed` (la colonna MySQL è un ENUM senza `delivered`).
+"""
+
+STATUSES = ('pending', 'preparing', 'ready', 'completed', 'cancelled')
+ACTIVE_STATUSES = ('pending', 'preparing', 'ready')
+ALIASES = {'delivered': 'completed'}
+
+TRANSITIONS = {
+    'pending': ('preparing', 'cancelled'),
+    'preparing': ('ready', 'cancelled'),
+    'ready': ('completed', 'cancelled'),
+    'completed': (),
+    'cancelled': (),
+}
+
+
+class InvalidStatusTransition(Exception):
+    """Cambio di stato non ammesso dallo stato attuale dell'ordine"""
+
+    def __init__(self, current, requested):
+        super().__init__(f"Cannot change order status from '{current}' to '{requested}'")
+        self.current = current
+        self.requested = requested
+
+
+def normalize_status(status):
+    """Ritorna lo stato canonico (risolvendo i sinonimi); ValueError se sconosciuto"""
+    if not isinstance(status, str):
+        raise ValueError("status must be a string")
+    status = ALIASES.get(status, status)
+    if status not in STATUSES:
+        raise ValueError(f"Unknown status: {status}")
+    return status
+
+
+def check_transition(current, requested):
+    """Solleva InvalidStatusTransition se da `current` non si può passare a `requested`"""
+    if requested not in TRANSITIONS.get(current, ()):
+        raise InvalidStatusTransition(current, requested)
@@ -0,0 +1,314 @@
+"""Outbox locale degli ordini (modalità write-behind).
+
+Con ORDER_OUTBOX=True, POST /api/orders non aspetta il database degli ordini:
+l'ordine già prezzato viene aggiunto a un file SQLite locale (WAL con
+synchronous=FULL, sopravvive a crash e cadute di corrente) e il totem riceve
+subito un numero provvisorio. Un thread di consegna scrive gli ordini sugli
+shard a blocchi, nell'ordine di arrivo di ogni negozio: se la scrittura di un
+ordine fallisce, quelli successivi dello stesso negozio aspettano il suo
+retry. Tra tutti i worker consegna uno solo, quello che tiene il lease nel
+file. Ogni ordine porta una Idempotency-Key: una consegna ripetuta (es. dopo
+un crash tra la scrittura e la conferma) non duplica l'ordine, finché la
+chiave è valida sul server: per questo un ordine non consegnato entro
+`max_age` secondi (da tenere sotto IDEMPOTENCY_TTL) non viene più ritentato.
+
+Nello stesso file resta l'ultimo listino valido di ogni negozio: se il catalogo
+non è raggiungibile (anche oltre la scadenza della cache del menu o dopo il
+riavvio di un worker) gli ordini vengono prezzati con quello.
+"""
+
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+import weakref
+from decimal import Decimal
+from idempotency import IdempotencyKeyMismatch
+from sqlite_writer import SQLiteWriter
+
+logger = logging.getLogger(__name__)
+
+QUEUED, DELIVERED, FAILED = 'queued', 'delivered', 'failed'
+PROVISIONAL_PREFIX = 'P-'
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS outbox (
+           seq INTEGER PRIMARY KEY AUTOINCREMENT,
+           store_id INTEGER NOT NULL,
+           idempotency_key TEXT NOT NULL,
+           fingerprint TEXT NOT NULL,
+           total_price TEXT NOT NULL,
+           items TEXT NOT NULL,
+           status TEXT NOT NULL DEFAULT 'queued',
+           attempts INTEGER NOT NULL DEFAULT 0,
+           next_attempt_at REAL NOT NULL DEFAULT 0,
+           last_error TEXT,
+           order_id INTEGER,
+           order_number INTEGER,
+           created_at REAL NOT NULL,
+           delivered_at REAL,
+           UNIQUE (store_id, idempotency_key)
+       )""",
+    "CREATE INDEX IF NOT EXISTS idx_outbox_status_seq ON outbox(status, seq)",
+    # Un solo worker alla volta consegna: chi tiene il lease lo rinnova prima che scada
+    """CREATE TABLE IF NOT EXISTS outbox_lease (
+           id INTEGER PRIMARY KEY CHECK (id = 1),
+           owner TEXT,
+           expires_at REAL NOT NULL
+       )""",
+    "INSERT OR IGNORE INTO outbox_lease (id, owner, expires_at) VALUES (1, NULL, 0)",
+    # Ultimo listino {product_id: prezzo} letto dal catalogo per ogni negozio
+    """CREATE TABLE IF NOT EXISTS outbox_prices (
+           store_id INTEGER PRIMARY KEY,
+           prices TEXT NOT NULL,
+           saved_at REAL NOT NULL
+       )""",
+]
+
+
+def provisional_number(seq):
+    return f"{PROVISIONAL_PREFIX}{seq}"
+
+
+def entry_body(entry):
+    """Stato pubblico di un ordine dell'outbox: `id` e `order_number` arrivano con la consegna"""
+    return {
+        "provisional_number": entry['provisional_number'],
+        "status": entry['status'],
+        "id": entry['order_id'],
+        "order_number": entry['order_number'],
+        "total_price": float(entry['total_price']),
+        "attempts": entry['attempts'],
+        "error": entry['last_error'],
+    }
+
+
+def _decode(row):
+    entry = dict(row)
+    entry['provisional_number'] = provisional_number(entry['seq'])
+    entry['total_price'] = Decimal(entry['total_price'])
+    entry['items'] = [dict(item, unit_price=Decimal(item['unit_price'])) for item in json.loads(entry['items'])]
+    return entry
+
+
+class OrderOutbox:
+    """Coda durevole degli ordini da scrivere e thread che li consegna con `deliver(entry)`.
+
+    `deliver` scrive l'ordine (con la sua Idempotency-Key) e ritorna l'ordine creato;
+    un'eccezione è un errore temporaneo da ritentare con backoff esponenziale, tranne
+    IdempotencyKeyMismatch che scarta l'ordine (status 'failed'). Gli ordini arrivati da più
+    di `max_age` secondi vanno in 'failed' invece di essere consegnati: dopo la scadenza
+    della Idempotency-Key una consegna già avvenuta ma non confermata verrebbe duplicata.
+    I consegnati restano nel file per `retention` secondi, i falliti per `failed_retention`
+    secondi dall'arrivo.
+    """
+
+    def __init__(self, db_file, deliver, batch_size=50, retry_base=1.0, retry_max=60.0,
+                 lease_ttl=30.0, poll_interval=1.0, retention=86400, failed_retention=604800,
+                 max_age=None):
+        self.db_file = db_file
+        self.deliver = deliver
+        self.batch_size = batch_size
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.lease_ttl = lease_ttl
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.failed_retention = failed_retention
+        self.max_age = max_age
+        self.writer = SQLiteWriter(db_file, synchronous='FULL')
+        self._schema_ready = False
+        self._prices = {}  # store_id -> ultimo listino salvato nel file
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            reset = weakref.WeakMethod(self._reset)
+            os.register_at_fork(after_in_child=lambda: reset() and reset()())
+
+    def _reset(self):
+        # Il thread di consegna non sopravvive alla fork: il figlio ne avvia uno nuovo
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._thread = None
+        self._context = None
+        self._lease_until = 0.0
+        self._purged_at = 0.0
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+
+    def _submit(self, work):
+        if not self._schema_ready:
+            self.writer.submit(lambda cursor: [cursor.execute(statement) for statement in SCHEMA])
+            self._schema_ready = True
+        return self.writer.submit(work)
+
+    def start(self, context=None):
+        """Avvia il thread di consegna; `context()` (es. app.app_context) avvolge ogni blocco"""
+        with self._lock:
+            if self._thread is None:
+                self._context = context
+                self._thread = threading.Thread(target=self._run, name='order-outbox', daemon=True)
+                self._thread.start()
+
+    def enqueue(self, store_id, key, request_fingerprint, total_price, items):
+        """Aggiunge un ordine prezzato e ritorna (voce, creata); senza chiave ne viene generata una.
+        IdempotencyKeyMismatch se la chiave è già stata usata per un altro ordine."""
+        key = key or f"outbox-{uuid.uuid4()}"
+        encoded_items = json.dumps(
+            [dict(item, unit_price=str(item['unit_price'])) for item in items], separators=(',', ':')
+        )
+
+        def work(cursor):
+            row = cursor.execute("SELECT * FROM outbox WHERE store_id = ? AND idempotency_key = ?",
+                                 (store_id, key)).fetchone()
+            if row is not None:
+                if row['fingerprint'] != request_fingerprint:
+                    raise IdempotencyKeyMismatch()
+                return row, False
+            cursor.execute(
+                """INSERT INTO outbox (store_id, idempotency_key, fingerprint, total_price, items, created_at)
+                   VALUES (?, ?, ?, ?, ?, ?)""",
+                (store_id, key, request_fingerprint, str(total_price), encoded_items, time.time())
+            )
+            return cursor.execute("SELECT * FROM outbox WHERE seq = ?", (cursor.lastrowid,)).fetchone(), True
+
+        row, created = self._submit(work)
+        self._wakeup.set()
+        return _decode(row), created
+
+    def remember_prices(self, store_id, price_index):
+        """Salva il listino del negozio appena letto dal catalogo (solo se è cambiato)"""
+        if self._prices.get(store_id) == price_index:
+            return
+        encoded = json.dumps({str(product_id): str(price) for product_id, price in price_index.items()},
+                             separators=(',', ':'))
+        self._submit(lambda cursor: cursor.execute(
+            "INSERT OR REPLACE INTO outbox_prices (store_id, prices, saved_at) VALUES (?, ?, ?)",
+            (store_id, encoded, time.time())
+        ))
+        self._prices[store_id] = price_index
+
+    def last_prices(self, store_id):
+        """Ultimo listino valido del negozio (anche salvato da un altro processo), o None"""
+        price_index = self._prices.get(store_id)
+        if price_index is None:
+            row = self._submit(lambda cursor: cursor.execute(
+                "SELECT prices FROM outbox_prices WHERE store_id = ?", (store_id,)
+            ).fetchone())
+            if row is None:
+                return None
+            price_index = {int(product_id): Decimal(price) for product_id, price in json.loads(row['prices']).items()}
+            self._prices[store_id] = price_index
+        return price_index
+
+    def get(self, number):
+        """Voce con il numero provvisorio indicato, o None"""
+        if not number.startswith(PROVISIONAL_PREFIX) or not number[len(PROVISIONAL_PREFIX):].isdigit():
+            return None
+        seq = int(number[len(PROVISIONAL_PREFIX):])
+        row = self._submit(lambda cursor: cursor.execute("SELECT * FROM outbox WHERE seq = ?", (seq,)).fetchone())
+        return _decode(row) if row is not None else None
+
+    def stats(self):
+        """Numero di voci per stato"""
+        rows = self._submit(
+            lambda cursor: cursor.execute("SELECT status, COUNT(*) AS count FROM outbox GROUP BY status").fetchall()
+        )
+        counts = {QUEUED: 0, DELIVERED: 0, FAILED: 0}
+        counts.update({row['status']: row['count'] for row in rows})
+        return counts
+
+    def drain_once(self):
+        """Consegna un blocco di ordini in attesa (se questo processo tiene il lease).
+        Ritorna il numero di ordini consegnati."""
+        if not self._renew_lease():
+            return 0
+        now = time.time()
+        # I negozi il cui primo ordine aspetta un retry restano fermi: l'ordine di arrivo è garantito
+        rows = self._submit(lambda cursor: cursor.execute(
+            """SELECT * FROM outbox WHERE status = ? AND store_id NOT IN (
+                   SELECT store_id FROM outbox WHERE status = ? AND next_attempt_at > ?)
+               ORDER BY seq LIMIT ?""",
+            (QUEUED, QUEUED, now, self.batch_size)
+        ).fetchall())
+        blocked = set()
+        updates = []
+        for row in rows:
+            entry = _decode(row)
+            if entry['store_id'] in blocked:
+                continue
+            if time.time() > self._lease_until - self.lease_ttl / 2 and not self._renew_lease():
+                break
+            if self.max_age is not None and time.time() - entry['created_at'] > self.max_age:
+                error = f"Not delivered within {self.max_age:g}s"
+                logger.error(f"Discarding outbox order {entry['provisional_number']}: {error}")
+                updates.append(("UPDATE outbox SET status = ?, last_error = ? WHERE seq = ?",
+                                (FAILED, error, entry['seq'])))
+                continue
+            try:
+                order = self.deliver(entry)
+            except IdempotencyKeyMismatch as e:
+                logger.error(f"Discarding outbox order {entry['provisional_number']}: {e}")
+                updates.append(("UPDATE outbox SET status = ?, last_error = ? WHERE seq = ?",
+                                (FAILED, str(e), entry['seq'])))
+                continue
+            except Exception as e:
+                attempts = entry['attempts'] + 1
+                delay = min(self.retry_max, self.retry_base * 2 ** (attempts - 1))
+                logger.warning(f"Outbox order {entry['provisional_number']} not delivered "
+                               f"(attempt {attempts}, retry in {delay:g}s): {e}")
+                updates.append(("UPDATE outbox SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE seq = ?",
+                                (attempts, time.time() + delay, str(e), entry['seq'])))
+                blocked.add(entry['store_id'])
+                continue
+            updates.append((
+                "UPDATE outbox SET status = ?, order_id = ?, order_number = ?, delivered_at = ?, last_error = NULL WHERE seq = ?",
+                (DELIVERED, order['id'], order.get('order_number'), time.time(), entry['seq'])
+            ))
+        if updates:
+            self._submit(lambda cursor: [cursor.execute(query, params) for query, params in updates])
+        if time.time() - self._purged_at > 60:
+            self._purged_at = time.time()
+            # Gli ordini consegnati restano per le richieste di stato, i falliti anche per
+            # le verifiche del personale; poi vengono eliminati
+            now = time.time()
+            self._submit(lambda cursor: [
+                cursor.execute("DELETE FROM outbox WHERE status = ? AND delivered_at < ?",
+                               (DELIVERED, now - self.retention)),
+                cursor.execute("DELETE FROM outbox WHERE status = ? AND created_at < ?",
+                               (FAILED, now - self.failed_retention)),
+            ])
+        return sum(1 for query, params in updates if params[0] == DELIVERED)
+
+    def _renew_lease(self):
+        now = time.time()
+
+        def work(cursor):
+            cursor.execute(
+                "UPDATE outbox_lease SET owner = ?, expires_at = ? WHERE id = 1 AND (owner = ? OR expires_at < ?)",
+                (self.owner, now + self.lease_ttl, self.owner, now)
+            )
+            return cursor.rowcount == 1
+
+        if self._submit(work):
+            self._lease_until = now + self.lease_ttl
+            return True
+        self._lease_until = 0.0
+        return False
+
+    def _run(self):
+        while True:
+            try:
+                if self._context is not None:
+                    with self._context():
+                        delivered = self.drain_once()
+                else:
+                    delivered = self.drain_once()
+            except Exception as e:
+                logger.error(f"Order outbox error: {e}")
+                delivered = 0
+            # Blocco pieno: probabilmente ci sono altri ordini, si continua subito
+            if delivered < self.batch_size:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
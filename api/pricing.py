@@ -0,0 +1,38 @@
+from decimal import Decimal
+
+CENT = Decimal('0.01')
+
+
+class PricingError(ValueError):
+    """Riga d'ordine non valida (prodotto inesistente o quantità errata)"""
+
+
+def build_price_index(rows):
+    """Costruisce il listino {product_id: prezzo} dalle righe di products"""
+    return {row['id']: Decimal(str(row['price'])) for row in rows}
+
+
+def price_order(items, price_index):
+    """Calcola prezzi unitari e totale di un ordine dal listino del server.
+    Ritorna (totale, righe) dove ogni riga ha product_id, quantity e unit_price."""
+    if not isinstance(items, list) or not items:
+        raise PricingError("items must be a non-empty list")
+    total = Decimal('0')
+    priced_items = []
+    for line in items:
+        try:
+            product_id = int(line['product_id'])
+            quantity = line.get('quantity', 1)
+        except (KeyError, TypeError, ValueError):
+            raise PricingError(f"Invalid order line: {line}")
+        # int() accetterebbe 2.7 (troncato a 2), "3" e True: la quantità deve essere un intero JSON
+        if not isinstance(quantity, int) or isinstance(quantity, bool):
+            raise PricingError(f"Invalid order line: {line}")
+        if quantity < 1:
+            raise PricingError(f"Invalid quantity for product {product_id}: {quantity}")
+        unit_price = price_index.get(product_id)
+        if unit_price is None:
+            raise PricingError(f"Unknown product: {product_id}")
+        total += unit_price * quantity
+        priced_items.append({"product_id": product_id, "quantity": quantity, "unit_price": unit_price})
+    return total.quantize(CENT), priced_items
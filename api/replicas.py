@@ -0,0 +1,100 @@
+import itertools
+import threading
+import time
+import logging
+from connection_pool import ConnectionPool
+
+logger = logging.getLogger(__name__)
+
+
+def parse_endpoint(endpoint, default_port):
+    """Converte 'host' o 'host:porta' in (host, porta)"""
+    host, _, port = endpoint.strip().rpartition(':')
+    if not host:
+        return port, default_port
+    return host, int(port)
+
+
+class PrimaryHold:
+    """Finestra in cui le letture restano sul primario (dopo una modifica al catalogo)"""
+
+    def __init__(self):
+        self.until = 0.0
+
+    def hold(self, seconds):
+        self.until = time.monotonic() + seconds
+
+    @property
+    def active(self):
+        return time.monotonic() < self.until
+
+
+_holds = {}
+_holds_lock = threading.Lock()
+
+
+def primary_hold(database):
+    """PrimaryHold del database, condiviso dal wrapper sincrono e da quello asincrono:
+    una modifica al catalogo fatta da uno tiene sul primario anche le letture dell'altro"""
+    with _holds_lock:
+        return _holds.setdefault(database, PrimaryHold())
+
+
+class Replica:
+    """Una replica di sola lettura con il proprio pool di connessioni"""
+
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        self.down_until = 0.0
+
+    @property
+    def healthy(self):
+        return time.monotonic() >= self.down_until
+
+
+class ReplicaSet:
+    """Insieme di repliche di lettura scelte a rotazione.
+
+    Una replica che fallisce viene esclusa per `retry_after` secondi, poi
+    torna candidata: se è ancora giù viene esclusa di nuovo al primo errore.
+    Senza repliche sane `choose()` ritorna None e le letture vanno al primario.
+    """
+
+    def __init__(self, endpoints, factory, retry_after=30, pool_class=ConnectionPool, **pool_options):
+        self.retry_after = retry_after
+        # pool_class=AsyncConnectionPool per il wrapper asincrono (factory è allora una coroutine)
+        self.replicas = [
+            Replica(f"{host}:{port}", pool_class(lambda host=host, port=port: factory(host, port), **pool_options))
+            for host, port in endpoints
+        ]
+        self._next = itertools.count()
+        self._lock = threading.Lock()
+
+    def __bool__(self):
+        return bool(self.replicas)
+
+    def choose(self):
+        """Ritorna la prossima replica sana (round robin) o None"""
+        with self._lock:
+            start = next(self._next)
+        for offset in range(len(self.replicas)):
+            replica = self.replicas[(start + offset) % len(self.replicas)]
+            if replica.healthy:
+                return replica
+        return None
+
+    def mark_down(self, replica, error):
+        """Esclude temporaneamente una replica dopo un errore"""
+        logger.warning(f"Replica {replica.name} unavailable, reading from primary for {self.retry_after}s: {error}")
+        replica.down_until = time.monotonic() + self.retry_after
+
+    def close(self):
+        for replica in self.replicas:
+            replica.pool.close()
+
+    def stats(self):
+        return {
+            replica.name: dict(replica.pool.stats(), healthy=replica.healthy)
+            for replica in self.replicas
+        }
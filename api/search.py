@@ -0,0 +1,259 @@
+"""Ricerca dei prodotti per il totem con un indice in memoria.
+
+Nome, descrizione e nome della categoria sono normalizzati (minuscole, senza
+accenti: "Tiramisù" -> "tiramisu") e spezzati in parole. L'indice invertito
+associa ogni parola ai prodotti che la contengono; il vocabolario ordinato
+permette la ricerca per prefisso mentre si digita e un indice delle
+cancellazioni (SymSpell) trova le parole con uno o due errori di battitura.
+Una ricerca non accede al database.
+"""
+
+import bisect
+import re
+import threading
+import time
+import unicodedata
+
+# Peso di una parola in base al campo in cui compare
+FIELD_WEIGHTS = {'name': 3.0, 'category_name': 1.5, 'description': 1.0}
+
+# Qualità della corrispondenza: parola esatta, prefisso, con errori di battitura
+EXACT, PREFIX, FUZZY = 1.0, 0.8, 0.6
+
+MIN_PREFIX = 2
+# Errori indicizzati per ogni parola del vocabolario (il massimo di max_distance)
+MAX_DISTANCE = 2
+MAX_PREFIX_EXPANSIONS = 50
+
+# Parole troppo comuni per distinguere un prodotto
+STOPWORDS = frozenset("""
+    a ad ai al alla alle allo agli all c con d da dal dalla dalle dallo dai dagli
+    de dei del della delle dello degli di e ed gli i il in l la le lo nel nella
+    o per su sul sulla un una uno
+""".split())
+
+WORD = re.compile(r'[^\W_]+')
+
+
+def normalize(text):
+    """Minuscole e senza accenti"""
+    decomposed = unicodedata.normalize('NFKD', text or '')
+    return ''.join(c for c in decomposed if not unicodedata.combining(c)).casefold()
+
+
+def tokenize(text):
+    """Parole normalizzate del testo, senza stopword ("dell'acqua" -> ["acqua"])"""
+    return [word for word in WORD.findall(normalize(text)) if word not in STOPWORDS]
+
+
+def max_distance(word):
+    """Errori di battitura tollerati: nessuno per le parole corte"""
+    if len(word) < 4:
+        return 0
+    return 1 if len(word) < 8 else 2
+
+
+def deletes(word, distance):
+    """La parola e tutte le varianti con fino a `distance` lettere in meno"""
+    result = {word}
+    frontier = {word}
+    for _ in range(distance):
+        frontier = {w[:i] + w[i + 1:] for w in frontier for i in range(len(w))}
+        result |= frontier
+    return result
+
+
+def edit_distance(a, b, limit):
+    """Distanza di Damerau-Levenshtein (trasposizioni adiacenti), limit + 1 se la supera"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous2, previous = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+class _Index:
+    """Strutture dell'indice; ricostruite in una nuova istanza e sostituite in blocco"""
+
+    def __init__(self):
+        self.products = {}   # product_id -> prodotto
+        self.terms = {}      # product_id -> {parola: peso}
+        self.postings = {}   # parola -> {product_id: peso}
+        self.vocabulary = []  # parole ordinate, per i prefissi
+        self.deletes = {}    # variante senza qualche lettera -> parole
+
+    def match(self, word):
+        """{product_id: punteggio} dei prodotti che contengono la parola, un suo prefisso o una variante"""
+        qualities = {}
+        if word in self.postings:
+            qualities[word] = EXACT
+        if len(word) >= MIN_PREFIX:
+            start = bisect.bisect_left(self.vocabulary, word)
+            for term in self.vocabulary[start:start + MAX_PREFIX_EXPANSIONS]:
+                if not term.startswith(word):
+                    break
+                qualities.setdefault(term, PREFIX)
+        if not qualities:
+            # Solo se la parola non esiste: "tiramsu" -> "tiramisu"
+            limit = max_distance(word)
+            candidates = set()
+            for variant in deletes(word, limit):
+                candidates |= self.deletes.get(variant, set())
+            for term in candidates:
+                if edit_distance(word, term, limit) <= limit:
+                    qualities[term] = FUZZY
+        scores = {}
+        for term, quality in qualities.items():
+            for product_id, weight in self.postings[term].items():
+                scores[product_id] = max(scores.get(product_id, 0.0), quality * weight)
+        return scores
+
+    def add(self, product):
+        terms = {}
+        for field, weight in FIELD_WEIGHTS.items():
+            for word in tokenize(product.get(field)):
+                terms[word] = max(terms.get(word, 0.0), weight)
+        self.products[product['id']] = product
+        self.terms[product['id']] = terms
+        for word, weight in terms.items():
+            postings = self.postings.get(word)
+            if postings is None:
+                postings = self.postings[word] = {}
+                bisect.insort(self.vocabulary, word)
+                for variant in deletes(word, MAX_DISTANCE):
+                    self.deletes.setdefault(variant, set()).add(word)
+            postings[product['id']] = weight
+
+    def remove(self, product_id):
+        self.products.pop(product_id, None)
+        for word in self.terms.pop(product_id, {}):
+            postings = self.postings[word]
+            del postings[product_id]
+            if postings:
+                continue
+            # Ultimo prodotto con questa parola: esce dal vocabolario
+            del self.postings[word]
+            del self.vocabulary[bisect.bisect_left(self.vocabulary, word)]
+            for variant in deletes(word, MAX_DISTANCE):
+                words = self.deletes.get(variant)
+                if words is not None:
+                    words.discard(word)
+                    if not words:
+                        del self.deletes[variant]
+
+
+class ProductSearchIndex:
+    """Indice di ricerca dei prodotti del catalogo.
+
+    Le route lo aggiornano a ogni creazione, modifica o eliminazione di un
+    prodotto (`upsert`/`remove`); le modifiche alle categorie e gli import
+    lo invalidano (`invalidate`). Ogni `resync_interval` secondi l'indice
+    viene ricostruito con `loader()`, fuori dal lock: le ricerche continuano
+    sull'indice precedente. Con più worker gunicorn ognuno ha la propria
+    copia e vede le modifiche degli altri al più tardi alla ricostruzione.
+    """
+
+    def __init__(self, loader, resync_interval=300):
+        self.loader = loader
+        self.resync_interval = resync_interval
+        self._index = _Index()
+        self._synced_at = None
+        self._loaded = False
+        self._generation = 0  # cresce a ogni invalidate
+        self._pending = None  # modifiche arrivate durante una ricostruzione (None = nessuna ricostruzione)
+        self._lock = threading.Lock()
+        self._rebuilt = threading.Condition(self._lock)
+
+    def search(self, query, limit=20):
+        """Prodotti che contengono tutte le parole della ricerca, dal più rilevante"""
+        words = tokenize(query)
+        if not words:
+            return []
+        self._sync()
+        with self._lock:
+            index = self._index
+            scores = None
+            for word in words:
+                word_scores = index.match(word)
+                if scores is None:
+                    scores = word_scores
+                else:
+                    # Tutte le parole devono trovare una corrispondenza
+                    scores = {product_id: score + word_scores[product_id]
+                              for product_id, score in scores.items() if product_id in word_scores}
+                if not scores:
+                    return []
+            ranked = sorted(scores, key=lambda product_id: (-scores[product_id], normalize(index.products[product_id]['name'])))
+            return [index.products[product_id] for product_id in ranked[:limit]]
+
+    def upsert(self, product):
+        """Aggiunge o aggiorna un prodotto (serve anche `category_name`)"""
+        def change(index):
+            index.remove(product['id'])
+            index.add(product)
+        with self._lock:
+            self._apply(change)
+
+    def remove(self, product_id):
+        with self._lock:
+            self._apply(lambda index: index.remove(product_id))
+
+    def invalidate(self):
+        """Forza la ricostruzione dell'indice alla prossima ricerca"""
+        with self._lock:
+            self._synced_at = None
+            self._generation += 1
+
+    def size(self):
+        with self._lock:
+            return len(self._index.products)
+
+    def _apply(self, change):
+        # Da chiamare con il lock
+        change(self._index)
+        if self._pending is not None:
+            self._pending.append(change)
+
+    def _sync(self):
+        with self._lock:
+            stale = self._synced_at is None or time.monotonic() - self._synced_at >= self.resync_interval
+            rebuild = stale and self._pending is None
+            if rebuild:
+                self._pending = []
+                generation = self._generation
+            elif not self._loaded:
+                # Prima ricostruzione in corso in un altro thread: non c'è ancora un indice
+                self._rebuilt.wait_for(lambda: self._loaded or self._pending is None)
+        if rebuild:
+            self._rebuild(generation)
+
+    def _rebuild(self, generation):
+        # Lettura del catalogo e costruzione del nuovo indice girano senza lock; le modifiche
+        # arrivate nel frattempo vengono riapplicate sul nuovo indice prima di sostituirlo
+        try:
+            index = _Index()
+            for product in self.loader():
+                index.add(product)
+        except BaseException:
+            with self._lock:
+                self._pending = None
+                self._rebuilt.notify_all()
+            raise
+        with self._lock:
+            for change in self._pending:
+                change(index)
+            self._index = index
+            self._pending = None
+            self._loaded = True
+            # Un invalidate durante la lettura può riguardare dati già letti: si ricostruisce ancora
+            self._synced_at = time.monotonic() if generation == self._generation else None
+            self._rebuilt.notify_all()
@@ -0,0 +1,87 @@
+"""Shard degli ordini per negozio.
+
+Gli ordini di ogni negozio vivono su uno shard (un file SQLite o un database
+MySQL) scelto dalla mappa STORE_SHARDS: il picco di un negozio non rallenta
+lock e indici degli altri. Lo shard 'default' (SQLITE_DB / DB_NAME) ospita il
+catalogo master e i negozi non mappati; gli altri shard ne tengono una copia,
+allineata da `sync_catalog()`, che serve alle JOIN degli articoli e ai rollup.
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SHARD = 'default'
+
+
+def parse_shards(value):
+    """'nome=destinazione,...' -> {nome: destinazione}; ValueError se malformato"""
+    shards = {}
+    for entry in value.split(','):
+        if not entry.strip():
+            continue
+        name, separator, target = entry.partition('=')
+        name, target = name.strip(), target.strip()
+        if not separator or not name or not target:
+            raise ValueError(f"Invalid shard '{entry}', expected name=target")
+        if name == DEFAULT_SHARD:
+            raise ValueError(f"Shard '{DEFAULT_SHARD}' is SQLITE_DB / DB_NAME and cannot be redefined")
+        shards[name] = target
+    return shards
+
+
+def parse_store_shards(value, shard_names):
+    """'negozio:shard,...' -> {store_id: nome}; ValueError se il negozio o lo shard non sono validi"""
+    store_shards = {}
+    for entry in value.split(','):
+        if not entry.strip():
+            continue
+        store, separator, name = entry.partition(':')
+        name = name.strip()
+        if not separator or not store.strip().isdigit():
+            raise ValueError(f"Invalid store mapping '{entry}', expected store_id:shard")
+        if name not in shard_names:
+            raise ValueError(f"Unknown shard '{name}' for store {store.strip()}")
+        store_shards[int(store)] = name
+    return store_shards
+
+
+class Shard:
+    """Wrapper sincrono e asincrono di un database degli ordini"""
+
+    def __init__(self, name, db, adb):
+        self.name = name
+        self.db = db
+        self.adb = adb
+
+
+class ShardRouter:
+    """Sceglie lo shard di un negozio; i negozi non mappati vanno sullo shard 'default'"""
+
+    def __init__(self, shards, store_shards):
+        self.shards = {shard.name: shard for shard in shards}
+        self.store_shards = store_shards
+        self.default = self.shards[DEFAULT_SHARD]
+
+    def __iter__(self):
+        return iter(self.shards.values())
+
+    def for_store(self, store_id):
+        return self.shards[self.store_shards.get(store_id, DEFAULT_SHARD)]
+
+    def sync_catalog(self):
+        """Copia categorie e prodotti dello shard 'default' sugli altri shard"""
+        if len(self.shards) == 1:
+            return
+        with self.default.db.session():
+            categories = self.default.db.export_categories()
+            products = self.default.db.export_products()
+        for shard in self:
+            if shard is self.default:
+                continue
+            try:
+                with shard.db.session():
+                    shard.db.replace_catalog(categories, products)
+            except Exception as e:
+                # Lo shard resta con la copia precedente fino alla prossima sincronizzazione
+                logger.error(f"Error syncing catalog to shard {shard.name}: {e}")
@@ -0,0 +1,129 @@
+import os
+import queue
+import sqlite3
+import threading
+import weakref
+import logging
+from concurrent.futures import Future
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+
+def pragma_statements(writer=False, synchronous=None):
+    """PRAGMA di produzione (da Config) per una connessione SQLite"""
+    statements = [
+        f"PRAGMA busy_timeout = {int(Config.SQLITE_BUSY_TIMEOUT)}",
+        f"PRAGMA cache_size = {int(Config.SQLITE_CACHE_SIZE)}",
+        f"PRAGMA mmap_size = {int(Config.SQLITE_MMAP_SIZE)}",
+    ]
+    if writer:
+        # journal_mode è persistente nel file: basta impostarlo dalla connessione di scrittura
+        statements.append(f"PRAGMA journal_mode = {Config.SQLITE_JOURNAL_MODE}")
+        statements.append(f"PRAGMA synchronous = {synchronous or Config.SQLITE_SYNCHRONOUS}")
+    return statements
+
+
+def apply_pragmas(connection, writer=False, synchronous=None):
+    for statement in pragma_statements(writer, synchronous):
+        connection.execute(statement)
+
+
+class SQLiteWriter:
+    """Thread unico di scrittura con group commit.
+
+    SQLite ammette un solo scrittore alla volta: invece di far competere le
+    connessioni per il lock (`database is locked`), tutte le scritture vengono
+    accodate a questo thread, che ha l'unica connessione di scrittura. Le
+    operazioni in coda vengono eseguite insieme in una sola transazione (un
+    solo fsync), ognuna dentro un proprio SAVEPOINT: se una fallisce viene
+    annullata solo lei. Il chiamante riceve il risultato dopo il COMMIT.
+    """
+
+    def __init__(self, db_file, max_batch=100, synchronous=None):
+        self.db_file = db_file
+        self.max_batch = max_batch
+        # Di default SQLITE_SYNCHRONOUS; FULL rende durevole ogni COMMIT anche a una caduta di corrente
+        self.synchronous = synchronous
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            reset = weakref.WeakMethod(self._reset)
+            os.register_at_fork(after_in_child=lambda: reset() and reset()())
+
+    def _reset(self):
+        # Il thread di scrittura non sopravvive alla fork: il figlio ne avvia uno nuovo
+        self._queue = queue.Queue()
+        self._thread = None
+        self._cursor = None
+        self._lock = threading.Lock()
+
+    def submit(self, work):
+        """Esegue work(cursor) nella prossima transazione di gruppo e ne ritorna il risultato"""
+        if threading.current_thread() is self._thread:
+            # Chiamata annidata da un'altra operazione: è già dentro la transazione
+            return work(self._cursor)
+        self._ensure_started()
+        future = Future()
+        self._queue.put((work, future))
+        return future.result()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='sqlite-writer', daemon=True)
+                self._thread.start()
+
+    def _open(self):
+        # Transazioni gestite esplicitamente (isolation_level=None): BEGIN/SAVEPOINT/COMMIT
+        connection = sqlite3.connect(self.db_file, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        apply_pragmas(connection, writer=True, synchronous=self.synchronous)
+        return connection
+
+    def _run(self):
+        connection = None
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if connection is None:
+                try:
+                    connection = self._open()
+                    self._cursor = connection.cursor()
+                except Exception as e:
+                    # Database non apribile: falliamo il gruppo e riproviamo al prossimo
+                    logger.error(f"SQLite writer connection error: {e}")
+                    for _, future in batch:
+                        future.set_exception(e)
+                    continue
+            self._run_batch(connection, batch)
+
+    def _run_batch(self, connection, batch):
+        cursor = self._cursor
+        results = []
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            for work, future in batch:
+                cursor.execute("SAVEPOINT job")
+                try:
+                    results.append((future, work(cursor), None))
+                    cursor.execute("RELEASE job")
+                except Exception as e:
+                    cursor.execute("ROLLBACK TO job")
+                    cursor.execute("RELEASE job")
+                    results.append((future, None, e))
+            cursor.execute("COMMIT")
+        except Exception as e:
+            # Errore della transazione (I/O, disco pieno...): nessuna operazione del gruppo è salvata
+            logger.error(f"SQLite write batch failed: {e}")
+            if connection.in_transaction:
+                connection.rollback()
+            results = [(future, None, e) for _, future in batch]
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
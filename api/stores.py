@@ -0,0 +1,68 @@
+"""Negozi: identificazione della richiesta e prezzi personalizzati.
+
+Il negozio arriva nell'header X-Store-Id (o nel parametro store_id); senza
+indicazioni è il negozio 1, quello a cui appartengono gli ordini creati prima
+del multi-negozio. Ogni negozio può cambiare il prezzo di un prodotto del
+catalogo o renderlo non disponibile (tabella `store_products`).
+"""
+
+import threading
+from decimal import Decimal
+
+HEADER = 'X-Store-Id'
+DEFAULT_STORE_ID = 1
+
+
+def parse_store_id(value):
+    """Converte l'id del negozio (ValueError se non è un intero positivo)"""
+    store_id = int(value)
+    if store_id < 1:
+        raise ValueError("store id must be a positive integer")
+    return store_id
+
+
+def apply_overrides(products, overrides):
+    """Prodotti del catalogo con i prezzi del negozio, senza quelli non disponibili"""
+    if not overrides:
+        return products
+    result = []
+    for product in products:
+        override = overrides.get(product['id'])
+        if override is None:
+            result.append(product)
+        elif override['available']:
+            result.append(product if override['price'] is None else dict(product, price=override['price']))
+    return result
+
+
+def apply_price_overrides(price_index, overrides):
+    """Listino {product_id: prezzo} del negozio: i prodotti non disponibili non si possono ordinare"""
+    if not overrides:
+        return price_index
+    price_index = dict(price_index)
+    for product_id, override in overrides.items():
+        if not override['available']:
+            price_index.pop(product_id, None)
+        elif override['price'] is not None and product_id in price_index:
+            price_index[product_id] = Decimal(str(override['price']))
+    return price_index
+
+
+class StoreRegistry:
+    """Oggetti per negozio (code della cucina, broker degli eventi) creati al primo utilizzo"""
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def get(self, store_id):
+        with self._lock:
+            item = self._items.get(store_id)
+            if item is None:
+                item = self._items[store_id] = self.factory(store_id)
+            return item
+
+    def values(self):
+        with self._lock:
+            return list(self._items.values())
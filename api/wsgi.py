@@ -0,0 +1,4 @@
+from app import create_app
+
+# Entry point WSGI per i server di produzione: gunicorn -c gunicorn.conf.py wsgi:app
+app = create_app()
@@ -1,9 +1,10 @@
-import { Component, OnInit, inject } from '@angular/core';
+import { Component, OnDestroy, OnInit, inject } from '@angular/core';
 import { CommonModule } from '@angular/common';
 import { FormsModule } from '@angular/forms';
 import { RouterModule, Router } from '@angular/router';
 import { ApiService } from '../services/api.service';
-import { Order, OrderStatus } from '../models/order';
+import { Subscription } from 'rxjs';
+import { Order, OrderEvent, OrderStatus } from '../models/order';
 
 @Component({
   selector: 'app-orders',
@@ -12,7 +13,7 @@ import { Order, OrderStatus } from '../models/order';
   templateUrl: './orders.component.html',
   styleUrls: ['./orders.component.css']
 })
-export class OrdersComponent implements OnInit {
+export class OrdersComponent implements OnInit, OnDestroy {
   orders: Order[] = [];
   filteredOrders: Order[] = [];
   isLoading = true;
@@ -20,6 +21,7 @@ export class OrdersComponent implements OnInit {
   selectedStatus: 'all' | OrderStatus = 'all';
 
   private apiService = inject(ApiService);
+  private stream?: Subscription;
 
   statusOptions: OrderStatus[] = ['pending', 'preparing', 'ready', 'completed', 'cancelled'];
   
@@ -49,13 +51,41 @@ export class OrdersComponent implements OnInit {
   };
 
   ngOnInit() {
-    this.loadOrders();
-    // Ricarica ordini ogni 5 secondi
-    setInterval(() => this.loadOrders(), 5000);
+    // Gli ordini arrivano in streaming dal server invece che con il polling
+    const since = new Date(Date.now() - 24 * 60 * 60 * 1000);
+    this.stream = this.apiService.streamOrders({ since }).subscribe({
+      next: (event) => this.applyEvent(event)
+    });
+  }
+
+  ngOnDestroy() {
+    this.stream?.unsubscribe();
+  }
+
+  applyEvent(event: OrderEvent) {
+    switch (event.type) {
+      case 'snapshot':
+        this.orders = event.orders;
+        this.isLoading = false;
+        this.errorMessage = '';
+        break;
+      case 'order_created':
+        this.orders = [event.order, ...this.orders.filter(o => o.id !== event.order.id)];
+        break;
+      case 'order_updated':
+        this.orders = this.orders.map(o => o.id === event.id ? { ...o, status: event.status } : o);
+        break;
+      case 'order_deleted':
+        this.orders = this.orders.filter(o => o.id !== event.id);
+        break;
+    }
+    this.filterOrders();
   }
 
   loadOrders() {
-    this.apiService.getOrders().subscribe({
+    // La dashboard mostra solo gli ordini delle ultime 24 ore
+    const since = new Date(Date.now() - 24 * 60 * 60 * 1000);
+    this.apiService.getOrders({ since }).subscribe({
       next: (data) => {
         this.orders = data;
         this.filterOrders();
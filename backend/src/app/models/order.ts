@@ -18,3 +18,16 @@ export interface Order {
   updated_at?: string;
   items?: OrderItem[];
 }
+
+export interface OrderFilters {
+  status?: OrderStatus[];
+  since?: Date;
+  limit?: number;
+  beforeId?: number;
+}
+
+export type OrderEvent =
+  | { type: 'snapshot'; orders: Order[] }
+  | { type: 'order_created'; order: Order }
+  | { type: 'order_updated'; id: number; status: OrderStatus }
+  | { type: 'order_deleted'; id: number };
@@ -1,9 +1,9 @@
 import { Injectable } from '@angular/core';
-import { HttpClient } from '@angular/common/http';
+import { HttpClient, HttpParams } from '@angular/common/http';
 import { Observable } from 'rxjs';
 import { Category } from '../models/category';
 import { Product } from '../models/product';
-import { Order } from '../models/order';
+import { Order, OrderEvent, OrderFilters } from '../models/order';
 
 @Injectable({
   providedIn: 'root'
@@ -61,8 +61,34 @@ export class ApiService {
   }
 
   // === ORDINI ===
-  getOrders(): Observable<Order[]> {
-    return this.http.get<Order[]>(`${this.baseUrl}/orders`);
+  getOrders(filters: OrderFilters = {}): Observable<Order[]> {
+    return this.http.get<Order[]>(`${this.baseUrl}/orders`, { params: this.orderParams(filters) });
+  }
+
+  // Stream SSE: uno snapshot iniziale e poi gli eventi dei singoli ordini.
+  // EventSource si riconnette da solo e ad ogni riconnessione arriva un nuovo snapshot.
+  streamOrders(filters: OrderFilters = {}): Observable<OrderEvent> {
+    return new Observable<OrderEvent>(subscriber => {
+      const source = new EventSource(`${this.baseUrl}/orders/stream?${this.orderParams(filters).toString()}`);
+      source.addEventListener('snapshot', e =>
+        subscriber.next({ type: 'snapshot', orders: JSON.parse((e as MessageEvent).data) }));
+      source.addEventListener('order_created', e =>
+        subscriber.next({ type: 'order_created', order: JSON.parse((e as MessageEvent).data) }));
+      source.addEventListener('order_updated', e =>
+        subscriber.next({ type: 'order_updated', ...JSON.parse((e as MessageEvent).data) }));
+      source.addEventListener('order_deleted', e =>
+        subscriber.next({ type: 'order_deleted', ...JSON.parse((e as MessageEvent).data) }));
+      return () => source.close();
+    });
+  }
+
+  private orderParams(filters: OrderFilters): HttpParams {
+    let params = new HttpParams();
+    if (filters.status?.length) params = params.set('status', filters.status.join(','));
+    if (filters.since) params = params.set('since', filters.since.toISOString());
+    if (filters.limit) params = params.set('limit', filters.limit);
+    if (filters.beforeId) params = params.set('before_id', filters.beforeId);
+    return params;
   }
 
   getOrder(id: number): Observable<Order> {
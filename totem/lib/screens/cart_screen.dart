@@ -239,6 +239,7 @@ class _CartScreenState extends State<CartScreen> {
       final orderId = await ApiService.createOrder(
         cartProvider.getOrderItems(),
         cartProvider.totalPrice,
+        cartProvider.checkoutKey,
       );
 
       cartProvider.clear();
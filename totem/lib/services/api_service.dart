@@ -7,6 +7,8 @@ class ApiService {
   // Configurare questo URL secondo il vostro setup
   static const String baseUrl = 'https://automatic-happiness-q7vq7767q66r24g97-5000.app.github.dev/api';
   static const Duration timeout = Duration(seconds: 10);
+  // Tentativi di invio di un ordine: i retry riusano la stessa Idempotency-Key
+  static const int orderAttempts = 3;
 
   // === CATEGORIE ===
   static Future<List<Category>> getCategories() async {
@@ -62,27 +64,43 @@ class ApiService {
   }
 
   // === ORDINI ===
-  static Future<int> createOrder(List<Map<String, dynamic>> items, double totalPrice) async {
-    try {
-      final response = await http
-          .post(
-            Uri.parse('$baseUrl/orders'),
-            headers: {'Content-Type': 'application/json'},
-            body: json.encode({
-              'items': items,
-              'total_price': totalPrice,
-            }),
-          )
-          .timeout(timeout);
+  // `idempotencyKey` identifica il checkout: il server crea un solo ordine anche se
+  // la richiesta arriva più volte (timeout, rete instabile, doppio tocco)
+  static Future<String> createOrder(
+    List<Map<String, dynamic>> items,
+    double totalPrice,
+    String idempotencyKey,
+  ) async {
+    final body = json.encode({
+      'items': items,
+      'total_price': totalPrice,
+    });
+    for (var attempt = 1; ; attempt++) {
+      http.Response response;
+      try {
+        response = await http
+            .post(
+              Uri.parse('$baseUrl/orders'),
+              headers: {
+                'Content-Type': 'application/json',
+                'Idempotency-Key': idempotencyKey,
+              },
+              body: body,
+            )
+            .timeout(timeout);
+      } catch (e) {
+        // La richiesta potrebbe essere arrivata: si ritenta con la stessa chiave
+        if (attempt < orderAttempts) continue;
+        throw Exception('Errore di connessione: $e');
+      }
 
-      if (response.statusCode == 201) {
+      // 202: ordine accettato nell'outbox del server, con numero provvisorio
+      if (response.statusCode == 201 || response.statusCode == 202) {
         final data = json.decode(response.body);
-        return data['id'];
-      } else {
-        throw Exception('Errore nella creazione ordine: ${response.statusCode}');
+        return (data['id'] ?? data['provisional_number']).toString();
       }
-    } catch (e) {
-      throw Exception('Errore di connessione: $e');
+      if (response.statusCode >= 500 && attempt < orderAttempts) continue;
+      throw Exception('Errore nella creazione ordine: ${response.statusCode}');
     }
   }
 
@@ -1,11 +1,21 @@
+import 'dart:math';
 import 'package:flutter/material.dart';
 import 'package:totem/models/cart_item.dart';
 
 class CartProvider extends ChangeNotifier {
   final Map<int, CartItem> _items = {};
+  // Idempotency-Key dell'ordine in corso: la stessa per ogni invio o retry dello stesso carrello
+  String? _checkoutKey;
 
   Map<int, CartItem> get items => _items;
 
+  String get checkoutKey => _checkoutKey ??= _newCheckoutKey();
+
+  static String _newCheckoutKey() {
+    final random = Random.secure();
+    return List.generate(16, (_) => random.nextInt(256).toRadixString(16).padLeft(2, '0')).join();
+  }
+
   double get totalPrice {
     return _items.values.fold(0, (sum, item) => sum + item.totalPrice);
   }
@@ -24,11 +34,13 @@ class CartProvider extends ChangeNotifier {
         unitPrice: price,
       );
     }
+    _checkoutKey = null;
     notifyListeners();
   }
 
   void removeItem(int productId) {
     _items.remove(productId);
+    _checkoutKey = null;
     notifyListeners();
   }
 
@@ -38,6 +50,7 @@ class CartProvider extends ChangeNotifier {
         removeItem(productId);
       } else {
         _items[productId]!.quantity = quantity;
+        _checkoutKey = null;
         notifyListeners();
       }
     }
@@ -45,6 +58,7 @@ class CartProvider extends ChangeNotifier {
 
   void clear() {
     _items.clear();
+    _checkoutKey = null;
     notifyListeners();
   }
 